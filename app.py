@@ -1,13 +1,21 @@
 import os
-import uuid
+import json
 import time
 import threading
+import multiprocessing
 from functools import wraps
-from flask import Flask, request, jsonify, render_template, send_from_directory, g
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, stream_with_context, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from recognizer import FormulaRecognizer
 from converter import FormulaConverter
+from final_converter import FormulaTooComplexError
+from jobs import JobQueue, QueueFullError
+from worker_pool import RecognitionWorkerPool
+from routing import InferenceRouter
+from documents import PDF_MAGIC, DocumentRecognizer, parse_page_ranges
+import metrics
+from profiling import RequestProfiler
 import logging
 
 # 配置日志
@@ -27,9 +35,18 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(32).hex())
 # 速率限制配置
 RATE_LIMIT_WINDOW = 60  # 60秒
 RATE_LIMIT_MAX_REQUESTS = 30  # 每窗口最大请求数
+RATE_LIMIT_BATCH_ITEM_WEIGHT = 0.2  # 批量接口中每个条目按0.2个请求计入速率限制
 rate_limit_store = {}
 rate_limit_lock = threading.Lock()
 
+# 批量接口配置
+BATCH_RECOGNIZE_MAX_ITEMS = 100  # 单次批量识别最大图片数
+BATCH_CONVERT_MAX_ITEMS = 1000  # 单次批量转换最大公式数
+
+# 单条LaTeX公式的最大长度；转换器的解析栈深度（含连续上下标的嵌套层数）、工作量和输出长度都有上限，
+# SymPy 只处理深度和长度较小的公式，此长度内的转换耗时与长度成线性关系
+MAX_FORMULA_LENGTH = 10000
+
 # 上传清理配置
 UPLOAD_MAX_AGE = 3600  # 1小时后清理
 
@@ -37,36 +54,93 @@ UPLOAD_MAX_AGE = 3600  # 1小时后清理
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('static', exist_ok=True)
 
-# 初始化识别器和转换器
-recognizer = FormulaRecognizer()
+# 初始化识别器和转换器（RECOGNITION_POOL=on 时推理在多进程工作池中执行）
+# 模型在后台线程中加载，HTTP服务无需等待即可启动，/api/convert 在OCR就绪前即可使用
+worker_pool = RecognitionWorkerPool.from_env()
+recognizer = FormulaRecognizer(worker_pool=worker_pool, load_model=False)
 converter = FormulaConverter()
 
+# PDF文档识别（逐页栅格化，按页并行定位和识别公式）
+document_recognizer = DocumentRecognizer.from_env(recognizer, converter)
+
+# 按请求剖析（REQUEST_PROFILING=on 时，带 X-Profile 请求头的请求会被剖析）
+profiler = RequestProfiler.from_env()
+
+# 异步识别任务队列（与同步接口共享识别器，但不占用请求线程）
+job_queue = JobQueue.from_env()
+SSE_HEARTBEAT_INTERVAL = 15  # SSE心跳间隔（秒）
+JOB_MODEL_WAIT_TIMEOUT = 300  # 异步任务等待模型加载的最长秒数
+
+
+def cache_samples(field):
+    """从识别缓存和转换缓存的统计中取出同一字段，供 /metrics 输出"""
+    def samples():
+        recognition = recognizer.cache.stats()
+        result = [({'cache': 'recognition'}, recognition[field]),
+                  ({'cache': 'conversion'}, converter.cache_stats()[field])]
+        if field == 'hits':
+            result.append(({'cache': 'recognition_disk'}, recognition['disk_hits']))
+        return result
+    return samples
+
+
+metrics.REGISTRY.register_callback('formula_cache_hits_total', '缓存命中次数（recognition_disk 为磁盘层命中）',
+                                   'counter', cache_samples('hits'))
+metrics.REGISTRY.register_callback('formula_cache_misses_total', '缓存未命中次数', 'counter', cache_samples('misses'))
+metrics.REGISTRY.register_callback('formula_job_queue_depth', '异步任务队列中等待的任务数', 'gauge',
+                                   lambda: [({}, job_queue.stats()['queue_depth'])])
+
+
+def start_model_loading():
+    """后台加载识别模型（含预热推理），并预先导入转换器的延迟加载后端"""
+    recognizer.start_background_load()
+    threading.Thread(target=converter.warm_up, name='converter-warmup', daemon=True).start()
+
+
+# spawn方式的子进程会重新导入本模块，只在主进程中触发加载
+if multiprocessing.parent_process() is None:
+    start_model_loading()
+
+
+def consume_rate_limit(weight=1.0):
+    """按权重扣减当前客户端的速率配额，超限时返回429响应，否则返回None"""
+    client_ip = request.remote_addr
+    current_time = time.time()
+    
+    with rate_limit_lock:
+        if client_ip not in rate_limit_store:
+            rate_limit_store[client_ip] = []
+        
+        # 清理过期请求记录（每条记录为 (时间, 权重)）
+        rate_limit_store[client_ip] = [
+            (t, w) for t, w in rate_limit_store[client_ip] 
+            if current_time - t < RATE_LIMIT_WINDOW
+        ]
+        
+        used = sum(w for _, w in rate_limit_store[client_ip])
+        if used + weight > RATE_LIMIT_MAX_REQUESTS:
+            return jsonify({
+                'error': '请求过于频繁，请稍后再试',
+                'retry_after': RATE_LIMIT_WINDOW
+            }), 429
+        
+        rate_limit_store[client_ip].append((current_time, weight))
+    
+    return None
+
+
+def batch_weight(item_count):
+    """批量请求计入速率限制的权重（至少按一个请求计）"""
+    return max(1.0, item_count * RATE_LIMIT_BATCH_ITEM_WEIGHT)
+
 
 def rate_limit(f):
     """速率限制装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        client_ip = request.remote_addr
-        current_time = time.time()
-        
-        with rate_limit_lock:
-            if client_ip not in rate_limit_store:
-                rate_limit_store[client_ip] = []
-            
-            # 清理过期请求记录
-            rate_limit_store[client_ip] = [
-                t for t in rate_limit_store[client_ip] 
-                if current_time - t < RATE_LIMIT_WINDOW
-            ]
-            
-            if len(rate_limit_store[client_ip]) >= RATE_LIMIT_MAX_REQUESTS:
-                return jsonify({
-                    'error': '请求过于频繁，请稍后再试',
-                    'retry_after': RATE_LIMIT_WINDOW
-                }), 429
-            
-            rate_limit_store[client_ip].append(current_time)
-        
+        limited = consume_rate_limit()
+        if limited:
+            return limited
         return f(*args, **kwargs)
     return decorated_function
 
@@ -98,43 +172,191 @@ def is_safe_path(basedir, path):
     return abs_path.startswith(abs_base + os.sep) or abs_path == abs_base
 
 
+# 图片文件魔数
+IMAGE_MAGIC_NUMBERS = {
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'\xff\xd8\xff': 'jpg',
+    b'GIF87a': 'gif',
+    b'GIF89a': 'gif',
+    b'BM': 'bmp',
+    b'II*\x00': 'tiff',
+    b'MM\x00*': 'tiff',
+    b'RIFF': 'webp',  # RIFF开头可能是webp
+}
+
+
+def detect_image_type(header):
+    """根据文件头魔数判断图片类型（直接检查内存中的字节）"""
+    header = bytes(header[:12])
+    
+    for magic, file_type in IMAGE_MAGIC_NUMBERS.items():
+        if header.startswith(magic):
+            return True, file_type
+    
+    # 额外检查 WEBP (RIFF....WEBP)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return True, 'webp'
+    
+    return False, None
+
+
 def validate_file_type(filepath):
     """验证文件真实类型（使用文件头魔数）"""
-    # 图片文件魔数
-    magic_numbers = {
-        b'\x89PNG\r\n\x1a\n': 'png',
-        b'\xff\xd8\xff': 'jpg',
-        b'GIF87a': 'gif',
-        b'GIF89a': 'gif',
-        b'BM': 'bmp',
-        b'II*\x00': 'tiff',
-        b'MM\x00*': 'tiff',
-        b'RIFF': 'webp',  # RIFF开头可能是webp
-    }
-    
     try:
         with open(filepath, 'rb') as f:
             header = f.read(12)
-        
-        for magic, file_type in magic_numbers.items():
-            if header.startswith(magic):
-                return True, file_type
-        
-        # 额外检查 WEBP (RIFF....WEBP)
-        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
-            return True, 'webp'
-        
-        return False, None
+        return detect_image_type(header)
     except Exception as e:
         logger.error(f"文件类型验证失败: {e}")
         return False, None
 
 
+def parse_outputs(data):
+    """从请求JSON中解析需要的输出格式，返回(格式集合, 错误信息)"""
+    try:
+        return converter.normalize_outputs(data.get('outputs')), None
+    except (TypeError, ValueError) as e:
+        return None, str(e)
+
+
+def parse_route(data):
+    """从请求中解析指定的推理路由（auto / formula / mixed），返回(路由, 错误信息)，未指定时路由为None"""
+    route = data.get('route') or request.args.get('route')
+    if route is None:
+        return None, None
+    if not isinstance(route, str):
+        return None, 'route必须是字符串'
+    try:
+        return InferenceRouter.normalize(route), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def conversion_payload(conversion_result, outputs):
+    """根据请求的输出格式组装转换结果"""
+    payload = {
+        'success': True,
+        'latex': conversion_result['latex'],
+        'latex_display': conversion_result['latex_display'],
+        'mathml_valid': conversion_result.get('mathml_valid', False)
+    }
+    for name in ('mathml', 'mathml_word_compatible'):
+        if name in outputs:
+            payload[name] = conversion_result.get(name, '')
+    return payload
+
+
+def recognizer_unavailable():
+    """识别模型未就绪时返回503响应，否则返回None"""
+    if recognizer.ready:
+        return None
+    if recognizer.state == 'failed':
+        return jsonify({'error': '识别模型加载失败，公式识别暂不可用', 'state': 'failed'}), 503
+    return jsonify({
+        'error': '识别模型正在加载，请稍后重试',
+        'state': recognizer.state,
+        'retry_after': 5
+    }), 503
+
+
+def read_uploaded_image():
+    """
+    读取请求中上传的图片并在内存中解码（不落盘）
+    
+    Returns:
+        (文件名, 图片数组, 错误响应)，成功时错误响应为None
+    """
+    # 检查是否有文件
+    if 'file' not in request.files:
+        return None, None, (jsonify({'error': '没有选择文件'}), 400)
+    
+    file = request.files['file']
+    if file.filename == '':
+        return None, None, (jsonify({'error': '没有选择文件'}), 400)
+    
+    # 检查文件类型（扩展名）
+    if not allowed_file(file.filename):
+        return None, None, (jsonify({'error': '不支持的文件类型'}), 400)
+    
+    filename = secure_filename(file.filename)
+    
+    # 一次性读入内存，后续嗅探、解码、预处理和识别均不落盘
+    with metrics.time_stage('upload'):
+        file_bytes = file.read()
+    
+    # 验证文件真实类型
+    with metrics.time_stage('validate'):
+        is_valid, detected_type = detect_image_type(file_bytes)
+    if not is_valid:
+        metrics.record_failure('validate')
+        logger.warning(f"文件类型验证失败: {filename}")
+        return None, None, (jsonify({'error': '文件类型验证失败，请上传有效的图片文件'}), 400)
+    
+    image = recognizer.decode_image(file_bytes)
+    if image is None:
+        return None, None, (jsonify({'error': '无法解码图片，请上传有效的图片文件'}), 400)
+    
+    return filename, image, None
+
+
+def ndjson_line(obj):
+    """序列化为一行NDJSON"""
+    return json.dumps(obj, ensure_ascii=False) + '\n'
+
+
 def allowed_file(filename):
     """检查文件类型是否允许"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
+@app.before_request
+def start_request_timing():
+    """开始收集本请求各阶段的耗时"""
+    g.request_started = time.perf_counter()
+    metrics.start_request_timing()
+
+
+@app.after_request
+def add_server_timing(response):
+    """通过 Server-Timing 响应头返回本请求各阶段的耗时（流式响应只包含首包前的阶段）"""
+    timings = metrics.request_timings()
+    started = g.get('request_started')
+    if timings is not None and started is not None:
+        response.headers['Server-Timing'] = metrics.server_timing_header(
+            timings, time.perf_counter() - started)
+    return response
+
+
+@app.before_request
+def start_profiling():
+    """请求头 X-Profile 为 cprofile 或 sample 时剖析本请求"""
+    mode = request.headers.get('X-Profile')
+    if not mode or not profiler.authorized(request.headers.get('X-Admin-Token')):
+        return None
+    try:
+        g.profile_session = profiler.start(mode.strip().lower(), f'{request.method} {request.path}')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return None
+
+
+@app.after_request
+def finish_profiling(response):
+    """结束剖析，通过 X-Profile-Id 响应头返回剖析记录ID（流式响应只覆盖首包之前）"""
+    session = g.pop('profile_session', None)
+    if session is not None:
+        response.headers['X-Profile-Id'] = profiler.finish(session)['id']
+    return response
+
+
+@app.teardown_request
+def release_profiling(exc):
+    """未经过 after_request 的请求（如未处理的异常）也要结束剖析"""
+    session = g.pop('profile_session', None)
+    if session is not None:
+        profiler.finish(session)
+
+
 @app.route('/')
 def index():
     """主页"""
@@ -146,56 +368,35 @@ def index():
 def upload_file():
     """处理文件上传和公式识别"""
     try:
-        # 定期清理旧文件
-        cleanup_old_uploads()
-        
-        # 检查是否有文件
-        if 'file' not in request.files:
-            return jsonify({'error': '没有选择文件'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': '没有选择文件'}), 400
-        
-        # 检查文件类型（扩展名）
-        if not allowed_file(file.filename):
-            return jsonify({'error': '不支持的文件类型'}), 400
-        
-        # 生成唯一文件名
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        unavailable = recognizer_unavailable()
+        if unavailable:
+            return unavailable
         
-        # 保存文件
-        file.save(filepath)
-        logger.info(f"文件已保存: {filepath}")
+        filename, image, error_response = read_uploaded_image()
+        if error_response:
+            return error_response
         
-        # 验证文件真实类型
-        is_valid, detected_type = validate_file_type(filepath)
-        if not is_valid:
-            os.remove(filepath)  # 删除非法文件
-            logger.warning(f"文件类型验证失败，已删除: {filepath}")
-            return jsonify({'error': '文件类型验证失败，请上传有效的图片文件'}), 400
+        route, error = parse_route(request.form)
+        if error:
+            return jsonify({'error': error}), 400
         
-        # 识别公式
-        latex_formula = recognizer.recognize_formula(filepath)
-        
-        # 识别完成后删除文件
-        try:
-            os.remove(filepath)
-        except Exception as e:
-            logger.warning(f"删除文件失败: {e}")
+        # 识别公式（details 中记录自动裁剪/缩放和路由的决策）
+        details = {}
+        latex_formula = recognizer.recognize_image(image, details=details, route=route)
         
         if latex_formula:
-            # 转换为MathML
-            conversion_result = converter.convert_formula(latex_formula)
+            # 转换为MathML（页面只展示Word兼容格式，无需运行 latex2mathml / SymPy）
+            conversion_result = converter.convert_formula(
+                latex_formula, ('latex', 'mathml_word_compatible'))
             
             result = {
                 'success': True,
                 'filename': filename,
                 'latex': conversion_result['latex'],
                 'mathml_word_compatible': conversion_result['mathml_word_compatible'],
-                'latex_display': conversion_result['latex_display']
+                'latex_display': conversion_result['latex_display'],
+                'auto_crop': details.get('auto_crop'),
+                'route': details.get('route')
             }
             
             logger.info(f"公式识别成功: {latex_formula[:50]}...")
@@ -204,7 +405,9 @@ def upload_file():
             logger.warning("公式识别失败")
             return jsonify({
                 'success': False,
-                'error': '无法识别图片中的公式，请确保图片清晰且包含有效的数学公式'
+                'error': '无法识别图片中的公式，请确保图片清晰且包含有效的数学公式',
+                'auto_crop': details.get('auto_crop'),
+                'route': details.get('route')
             }), 400
             
     except Exception as e:
@@ -223,6 +426,21 @@ def api_recognize():
         
         image_path = data['image_path']
         
+        outputs, error = parse_outputs(data)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        route, error = parse_route(data)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        unavailable = recognizer_unavailable()
+        if unavailable:
+            return unavailable
+        
+        # 定期清理旧文件
+        cleanup_old_uploads()
+        
         # 安全检查：路径必须在上传目录内
         if not is_safe_path(app.config['UPLOAD_FOLDER'], image_path):
             logger.warning(f"拒绝非法路径访问: {image_path}")
@@ -237,18 +455,15 @@ def api_recognize():
             return jsonify({'error': '无效的图片文件'}), 400
         
         # 识别公式
-        latex_formula = recognizer.recognize_formula(image_path)
+        details = {}
+        latex_formula = recognizer.recognize_formula(image_path, details=details, route=route)
         
         if latex_formula:
-            conversion_result = converter.convert_formula(latex_formula)
-            return jsonify({
-                'success': True,
-                'latex': conversion_result['latex'],
-                'mathml': conversion_result.get('mathml', ''),
-                'mathml_word_compatible': conversion_result['mathml_word_compatible'],
-                'latex_display': conversion_result['latex_display'],
-                'mathml_valid': conversion_result.get('mathml_valid', False)
-            })
+            conversion_result = converter.convert_formula(latex_formula, outputs)
+            payload = conversion_payload(conversion_result, outputs)
+            payload['auto_crop'] = details.get('auto_crop')
+            payload['route'] = details.get('route')
+            return jsonify(payload)
         else:
             return jsonify({
                 'success': False,
@@ -260,6 +475,67 @@ def api_recognize():
         return jsonify({'error': f'API调用出错: {str(e)}'}), 500
 
 
+@app.route('/api/recognize/regions', methods=['POST'])
+@rate_limit
+def api_recognize_regions():
+    """多公式识别接口：上传一张含多行公式的图片，逐行返回公式及其位置，可选拼接为 aligned"""
+    try:
+        unavailable = recognizer_unavailable()
+        if unavailable:
+            return unavailable
+        
+        filename, image, error_response = read_uploaded_image()
+        if error_response:
+            return error_response
+        
+        outputs, error = parse_outputs(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        route, error = parse_route(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        aligned = request.form.get('aligned', '').lower() in ('1', 'on', 'true', 'yes')
+        
+        try:
+            results = recognizer.recognize_regions(image, route=route)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        regions = []
+        formulas = []
+        for index, result in enumerate(results):
+            region = {'index': index, 'bbox': result['bbox'], 'route': result.get('route')}
+            if result['success']:
+                try:
+                    conversion_result = converter.convert_formula(result['formula'], outputs)
+                    region.update(conversion_payload(conversion_result, outputs))
+                    formulas.append(result['formula'])
+                except Exception as e:
+                    region.update(success=False, error=f'转换出错: {str(e)}')
+            else:
+                region.update(success=False, error=result.get('error') or '无法识别公式')
+            regions.append(region)
+        
+        payload = {
+            'success': bool(formulas),
+            'filename': filename,
+            'regions': regions,
+            'aligned': None
+        }
+        if aligned and formulas:
+            try:
+                payload['aligned'] = conversion_payload(converter.convert_aligned(formulas, outputs), outputs)
+            except Exception as e:
+                payload['aligned'] = {'success': False, 'error': f'转换出错: {str(e)}'}
+        return jsonify(payload)
+        
+    except Exception as e:
+        logger.error(f"多公式识别出错: {e}")
+        return jsonify({'error': f'多公式识别出错: {str(e)}'}), 500
+
+
 @app.route('/api/convert', methods=['POST'])
 @rate_limit
 def api_convert():
@@ -272,25 +548,294 @@ def api_convert():
         latex_formula = data['latex']
         
         # 基本输入验证
-        if len(latex_formula) > 10000:
+        if not isinstance(latex_formula, str):
+            return jsonify({'error': 'latex参数必须是字符串'}), 400
+        if len(latex_formula) > MAX_FORMULA_LENGTH:
             return jsonify({'error': 'LaTeX公式过长'}), 400
         
-        conversion_result = converter.convert_formula(latex_formula)
+        # 可选：只请求需要的输出格式（如仅 mathml_word_compatible）
+        outputs, error = parse_outputs(data)
+        if error:
+            return jsonify({'error': error}), 400
         
-        return jsonify({
-            'success': True,
-            'latex': conversion_result['latex'],
-            'mathml': conversion_result.get('mathml', ''),
-            'mathml_word_compatible': conversion_result['mathml_word_compatible'],
-            'latex_display': conversion_result['latex_display'],
-            'mathml_valid': conversion_result.get('mathml_valid', False)
-        })
+        conversion_result = converter.convert_formula(latex_formula, outputs)
         
+        return jsonify(conversion_payload(conversion_result, outputs))
+        
+    except FormulaTooComplexError as e:
+        return jsonify({'error': f'LaTeX公式过于复杂: {e}'}), 400
     except Exception as e:
         logger.error(f"转换API调用出错: {e}")
         return jsonify({'error': f'转换出错: {str(e)}'}), 500
 
 
+@app.route('/api/batch/recognize', methods=['POST'])
+def api_batch_recognize():
+    """批量识别接口：multipart上传多张图片，以NDJSON流式返回每张图片的结果"""
+    files = request.files.getlist('files') or request.files.getlist('file')
+    files = [file for file in files if file.filename]
+    if not files:
+        return jsonify({'error': '没有选择文件'}), 400
+    if len(files) > BATCH_RECOGNIZE_MAX_ITEMS:
+        return jsonify({'error': f'单次最多上传{BATCH_RECOGNIZE_MAX_ITEMS}张图片'}), 400
+    
+    outputs, error = parse_outputs(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    route, error = parse_route(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    unavailable = recognizer_unavailable()
+    if unavailable:
+        return unavailable
+    
+    limited = consume_rate_limit(batch_weight(len(files)))
+    if limited:
+        return limited
+    
+    # 在开始流式响应前读完请求体
+    filenames = []
+    rejected = {}
+    valid_indices = []
+    valid_images = []
+    for index, file in enumerate(files):
+        filename = secure_filename(file.filename)
+        filenames.append(filename)
+        if not allowed_file(file.filename):
+            rejected[index] = '不支持的文件类型'
+            continue
+        file_bytes = file.read()
+        if not detect_image_type(file_bytes)[0]:
+            rejected[index] = '文件类型验证失败，请上传有效的图片文件'
+            continue
+        valid_indices.append(index)
+        valid_images.append(file_bytes)
+    
+    def generate():
+        succeeded = 0
+        for index, error in rejected.items():
+            yield ndjson_line({'index': index, 'filename': filenames[index], 'success': False, 'error': error})
+        
+        try:
+            for sub_index, result in recognizer.iter_batch_recognize(valid_images, route=route):
+                index = valid_indices[sub_index]
+                line = {'index': index, 'filename': filenames[index], 'auto_crop': result.get('auto_crop'),
+                        'route': result.get('route')}
+                if result['success']:
+                    try:
+                        conversion_result = converter.convert_formula(result['formula'], outputs)
+                        line.update(conversion_payload(conversion_result, outputs))
+                        succeeded += 1
+                    except Exception as e:
+                        line.update(success=False, error=f'转换出错: {str(e)}')
+                else:
+                    line.update(success=False, error=result.get('error') or '无法识别公式')
+                yield ndjson_line(line)
+        except Exception as e:
+            logger.error(f"批量识别出错: {e}")
+            yield ndjson_line({'error': f'批量识别出错: {str(e)}'})
+        
+        yield ndjson_line({'done': True, 'total': len(files), 'succeeded': succeeded})
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/documents/recognize', methods=['POST'])
+def api_document_recognize():
+    """文档识别接口：上传PDF，逐页定位并识别公式，以NDJSON流式返回（每个公式一行，每页结束一行）"""
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'error': '没有选择文件'}), 400
+    
+    pdf_bytes = file.read()
+    if not pdf_bytes.startswith(PDF_MAGIC):
+        return jsonify({'error': '文件类型验证失败，请上传有效的PDF文件'}), 400
+    
+    outputs, error = parse_outputs(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    route, error = parse_route(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    unavailable = recognizer_unavailable()
+    if unavailable:
+        return unavailable
+    
+    pages = request.form.get('pages')
+    try:
+        document = document_recognizer.open(pdf_bytes)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 501
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        page_indices = parse_page_ranges(pages, document.page_count)
+    except ValueError as e:
+        document.close()
+        return jsonify({'error': str(e)}), 400
+    if len(page_indices) > document_recognizer.max_pages:
+        document.close()
+        return jsonify({'error': f'单个文档最多处理{document_recognizer.max_pages}页'}), 400
+    
+    # 每页按批量条目计入速率限制，单个文档最多占满一个窗口的配额
+    limited = consume_rate_limit(min(batch_weight(len(page_indices)), RATE_LIMIT_MAX_REQUESTS))
+    if limited:
+        document.close()
+        return limited
+    
+    def generate():
+        formulas = 0
+        succeeded = 0
+        try:
+            for record in document_recognizer.iter_pdf(document, pages, outputs, route or 'formula'):
+                if record['type'] == 'formula':
+                    formulas += 1
+                    succeeded += record['success']
+                yield ndjson_line(record)
+        except Exception as e:
+            logger.error(f"文档识别出错: {e}")
+            yield ndjson_line({'error': f'文档识别出错: {str(e)}'})
+        finally:
+            document.close()
+        
+        yield ndjson_line({'done': True, 'pages': len(page_indices), 'formulas': formulas, 'succeeded': succeeded})
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/batch/convert', methods=['POST'])
+def api_batch_convert():
+    """批量转换接口：接收LaTeX字符串数组，以NDJSON流式返回每条公式的结果"""
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        formulas, data = data, {}
+    elif isinstance(data, dict):
+        formulas = data.get('formulas')
+    else:
+        formulas = None
+    
+    if not isinstance(formulas, list) or not formulas:
+        return jsonify({'error': '缺少formulas参数（LaTeX字符串数组）'}), 400
+    if len(formulas) > BATCH_CONVERT_MAX_ITEMS:
+        return jsonify({'error': f'单次最多转换{BATCH_CONVERT_MAX_ITEMS}条公式'}), 400
+    if not all(isinstance(formula, str) for formula in formulas):
+        return jsonify({'error': 'formulas中的每一项都必须是字符串'}), 400
+    if any(len(formula) > MAX_FORMULA_LENGTH for formula in formulas):
+        return jsonify({'error': 'LaTeX公式过长'}), 400
+    
+    outputs, error = parse_outputs(data)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    limited = consume_rate_limit(batch_weight(len(formulas)))
+    if limited:
+        return limited
+    
+    def generate():
+        try:
+            for index, conversion_result in converter.iter_convert_batch(formulas, outputs):
+                line = {'index': index}
+                line.update(conversion_payload(conversion_result, outputs))
+                yield ndjson_line(line)
+        except Exception as e:
+            logger.error(f"批量转换出错: {e}")
+            yield ndjson_line({'error': f'批量转换出错: {str(e)}'})
+        
+        yield ndjson_line({'done': True, 'total': len(formulas)})
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def run_recognition_job(filename, image, outputs, route=None):
+    """异步任务：识别公式并转换格式（模型仍在加载时等待加载完成）"""
+    if not recognizer.wait_until_ready(JOB_MODEL_WAIT_TIMEOUT):
+        raise RuntimeError(f'识别模型不可用（{recognizer.state}）')
+    
+    details = {}
+    latex_formula = recognizer.recognize_image(image, details=details, route=route)
+    if not latex_formula:
+        raise ValueError('无法识别图片中的公式，请确保图片清晰且包含有效的数学公式')
+    
+    conversion_result = converter.convert_formula(latex_formula, outputs)
+    result = conversion_payload(conversion_result, outputs)
+    result['filename'] = filename
+    result['auto_crop'] = details.get('auto_crop')
+    result['route'] = details.get('route')
+    return result
+
+
+@app.route('/api/jobs', methods=['POST'])
+@rate_limit
+def api_submit_job():
+    """异步任务接口：提交图片后立即返回任务ID"""
+    try:
+        filename, image, error_response = read_uploaded_image()
+        if error_response:
+            return error_response
+        
+        outputs, error = parse_outputs(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        route, error = parse_route(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        try:
+            job = job_queue.submit(run_recognition_job, filename, image, outputs, route)
+        except QueueFullError as e:
+            return jsonify({'error': str(e), 'retry_after': 5}), 503
+        
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/api/jobs/{job.id}',
+            'events_url': f'/api/jobs/{job.id}/events'
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"提交异步任务出错: {e}")
+        return jsonify({'error': f'提交任务出错: {str(e)}'}), 500
+
+
+@app.route('/api/jobs/<job_id>')
+def api_job_status(job_id):
+    """异步任务接口：轮询任务状态"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/events')
+def api_job_events(job_id):
+    """异步任务接口：通过Server-Sent Events推送任务状态变化"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    
+    def generate():
+        version = -1
+        while True:
+            if job.version > version:
+                version = job.version
+                data = job.to_dict()
+                event = 'result' if job.finished else 'status'
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                if job.finished:
+                    return
+            elif not job_queue.wait_for_change(job, version, SSE_HEARTBEAT_INTERVAL):
+                yield ': heartbeat\n\n'
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """提供上传的文件（安全检查）"""
@@ -310,11 +855,64 @@ def health_check():
     """健康检查接口"""
     return jsonify({
         'status': 'healthy',
-        'recognizer_ready': recognizer.p2t is not None,
-        'converter_ready': True
+        'recognizer_ready': recognizer.ready,
+        'recognizer_state': recognizer.state,
+        'recognizer_load_mode': recognizer.load_mode,
+        'recognition_route': recognizer.router.default_route,
+        'converter_ready': True,
+        'recognition_cache': recognizer.cache.stats(),
+        'conversion_cache': converter.cache_stats(),
+        'job_queue': job_queue.stats(),
+        'worker_pool': worker_pool.stats() if worker_pool else None
     })
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的运行时指标"""
+    return Response(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def profiling_unavailable():
+    """剖析未开启或管理令牌无效时返回404响应，否则返回None"""
+    if profiler.authorized(request.headers.get('X-Admin-Token')):
+        return None
+    return jsonify({'error': '剖析未开启'}), 404
+
+
+@app.route('/admin/profiles')
+def list_profiles():
+    """最近的剖析记录"""
+    unavailable = profiling_unavailable()
+    if unavailable:
+        return unavailable
+    return jsonify({'profiles': profiler.list(), 'skipped': profiler.skipped})
+
+
+@app.route('/admin/profiles/<profile_id>')
+def get_profile(profile_id):
+    """导出剖析记录：format=text（默认）/ pstats / collapsed"""
+    unavailable = profiling_unavailable()
+    if unavailable:
+        return unavailable
+    
+    record = profiler.get(profile_id)
+    if record is None:
+        return jsonify({'error': '剖析记录不存在或已被淘汰'}), 404
+    
+    fmt = request.args.get('format', 'text')
+    try:
+        limit = int(request.args.get('limit', '50'))
+        body, content_type = profiler.render(record, fmt, request.args.get('sort', 'cumulative'), limit)
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    response = Response(body, content_type=content_type)
+    if fmt == 'pstats':
+        response.headers['Content-Disposition'] = f'attachment; filename={profile_id}.pstats'
+    return response
+
+
 @app.errorhandler(413)
 def too_large(e):
     """文件过大错误处理"""
@@ -328,10 +926,8 @@ def rate_limit_exceeded(e):
 
 
 if __name__ == '__main__':
-    # 检查识别器状态
-    if recognizer.p2t is None:
-        logger.warning("Pix2Text未初始化，公式识别功能可能无法正常工作")
-        print("警告: Pix2Text初始化失败，请确保已安装相关依赖库")
+    # 识别模型在后台加载，服务可立即启动
+    logger.info(f"识别模型状态: {recognizer.state}，可通过 /health 查看加载进度")
     
     print("正在启动公式识别器服务...")
     print("访问 http://localhost:8081 使用Web界面")
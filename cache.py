@@ -0,0 +1,351 @@
+"""
+缓存组件
+提供线程安全的LRU内存缓存，以及公式识别结果的内容寻址缓存
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """线程安全的LRU缓存，支持条目数和字节预算双重上限"""
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable] = None):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 最大条目数
+            max_bytes: 最大字节预算，为None时不限制
+            sizeof: 估算条目字节数的函数 (key, value) -> int，设置max_bytes时使用
+        """
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or _default_sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """读取缓存，未命中返回None"""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.max_entries == 0:
+            return
+        size = self._sizeof(key, value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # 单个条目超出总预算，不缓存
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._sizes[key]
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._sizes[key] = size
+            self._bytes += size
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                old_key, _ = self._data.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """返回缓存统计信息"""
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _key_sizeof(key) -> int:
+    """粗略估算缓存键的字节数；元组键（如转换缓存的 (规范化LaTeX, 输出格式)）累加各字符串部分"""
+    if isinstance(key, str):
+        return len(key)
+    if isinstance(key, tuple):
+        return 64 + sum(len(part) if isinstance(part, str) else 64 for part in key)
+    return 64
+
+
+def _default_sizeof(key, value) -> int:
+    """粗略估算条目占用的字节数（字符串按长度计，字典累加各字符串值）"""
+    size = _key_sizeof(key)
+    if isinstance(value, str):
+        return size + len(value)
+    if isinstance(value, dict):
+        for item in value.values():
+            size += len(item) if isinstance(item, str) else 16
+        return size
+    return size + 64
+
+
+class RecognitionCache:
+    """
+    公式识别结果缓存（按像素内容寻址）
+
+    - 内存层：有容量上限的LRU
+    - 磁盘层（可选）：按模型版本分目录存放，重启后仍可命中；不同版本并存
+      （如服务端的 mixed 模式与批量脚本的 formula-only 模式共用同一目录），
+      总大小超出上限时按最近使用时间淘汰
+    - 模型版本变化时，只读写新版本的目录，旧版本的结果不再命中
+    """
+
+    # 版本目录中的标记文件，只有带标记的目录才会被淘汰，缓存目录与其他数据共用时不会误删
+    DISK_MARKER = '.recognition-cache'
+    # 超出磁盘上限时淘汰到上限的这一比例，避免每次写入都重新扫描
+    DISK_LOW_WATER = 0.8
+
+    def __init__(self, max_entries: int = 256, cache_dir: Optional[str] = None,
+                 model_version: str = 'unknown', max_disk_bytes: Optional[int] = 256 * 1024 * 1024):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 内存层最大条目数
+            cache_dir: 磁盘层目录，为None时不启用磁盘层
+            model_version: 当前识别模型版本
+            max_disk_bytes: 磁盘层（所有版本合计）的字节上限，为None时不限制
+        """
+        self.memory = LRUCache(max_entries)
+        self.cache_dir = cache_dir
+        self.model_version = model_version
+        self.max_disk_bytes = max_disk_bytes or None
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        if self.cache_dir:
+            self._prepare_disk()
+
+    @classmethod
+    def from_env(cls, model_version: str = 'unknown') -> 'RecognitionCache':
+        """根据环境变量创建缓存（RECOGNITION_CACHE_SIZE / RECOGNITION_CACHE_DIR / RECOGNITION_CACHE_DISK_MAX_BYTES）"""
+        max_entries = int(os.environ.get('RECOGNITION_CACHE_SIZE', '256'))
+        cache_dir = os.environ.get('RECOGNITION_CACHE_DIR') or None
+        max_disk_bytes = int(os.environ.get('RECOGNITION_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+        return cls(max_entries=max_entries, cache_dir=cache_dir, model_version=model_version,
+                   max_disk_bytes=max_disk_bytes)
+
+    @staticmethod
+    def image_key(image: 'np.ndarray', preprocess: bool, route: str = 'mixed') -> str:
+        """根据解码后的像素、形状、预处理标志和推理路由计算缓存键"""
+        if not image.flags['C_CONTIGUOUS']:
+            image = image.copy()
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f'{image.shape}|{image.dtype}|{int(bool(preprocess))}|{route}'.encode('ascii'))
+        digest.update(memoryview(image).cast('B'))
+        return digest.hexdigest()
+
+    def set_model_version(self, model_version: str):
+        """更新模型版本，版本变化时使所有旧结果失效"""
+        with self._lock:
+            if model_version == self.model_version:
+                return
+            self.model_version = model_version
+        self.memory.clear()
+        if self.cache_dir:
+            self._prepare_disk()
+        logger.info(f"识别模型版本变化，缓存已失效: {model_version}")
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，依次检查内存层和磁盘层"""
+        value = self.memory.get(key)
+        if value is None and self.cache_dir:
+            value = self._disk_get(key)
+            if value is not None:
+                self.memory.put(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        """写入缓存（同时写入磁盘层）"""
+        if value is None:
+            return
+        self.memory.put(key, value)
+        if self.cache_dir:
+            self._disk_put(key, value)
+
+    def clear(self):
+        """清空内存层"""
+        self.memory.clear()
+
+    def stats(self) -> dict:
+        """返回缓存统计信息"""
+        with self._lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'model_version': self.model_version,
+                'disk_enabled': bool(self.cache_dir),
+                'disk_bytes': self._disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+            }
+        stats['memory'] = self.memory.stats()
+        return stats
+
+    def _version_dir(self) -> str:
+        """当前模型版本对应的磁盘目录"""
+        version_hash = hashlib.blake2b(self.model_version.encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, version_hash)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._version_dir(), key[:2], f'{key}.json')
+
+    def _disk_get(self, key: str) -> Optional[str]:
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            if record.get('model_version') != self.model_version:
+                return None
+            os.utime(path)  # 修改时间即最近使用时间，供淘汰排序
+            return record.get('latex')
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key: str, value: str):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'model_version': self.model_version, 'latex': value}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)  # 原子替换，避免读到半写入的文件
+        except OSError as e:
+            logger.warning(f"写入磁盘缓存失败: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += size
+            over = self.max_disk_bytes is not None and self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _prepare_disk(self):
+        """创建当前版本的目录并写入标记，统计磁盘层占用，超出上限时淘汰"""
+        version_dir = self._version_dir()
+        try:
+            os.makedirs(version_dir, exist_ok=True)
+            marker = os.path.join(version_dir, self.DISK_MARKER)
+            if not os.path.exists(marker):
+                with open(marker, 'w', encoding='utf-8') as f:
+                    json.dump({'model_version': self.model_version}, f, ensure_ascii=False)
+        except OSError as e:
+            logger.warning(f"初始化磁盘缓存失败: {e}")
+            return
+        self._evict_disk()
+
+    def _marked_version_dirs(self) -> list:
+        """缓存目录下带标记文件的版本目录（其余目录与本缓存无关，不做任何处理）"""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.cache_dir, name) for name in names
+                if os.path.isfile(os.path.join(self.cache_dir, name, self.DISK_MARKER))]
+
+    def _evict_disk(self):
+        """
+        重新统计磁盘层占用；超出上限时按修改时间从旧到新删除条目（不区分版本），
+        直到降到上限的 DISK_LOW_WATER；删空的其他版本目录一并移除
+
+        多个进程共用目录时各自统计，淘汰时以实际扫描结果为准
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return  # 其他线程正在淘汰
+        try:
+            current = self._version_dir()
+            entries = []
+            total = 0
+            for version_dir in self._marked_version_dirs():
+                for root, _, files in os.walk(version_dir):
+                    for name in files:
+                        if not name.endswith('.json'):
+                            continue
+                        path = os.path.join(root, name)
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                        total += stat.st_size
+
+            if self.max_disk_bytes is not None and total > self.max_disk_bytes:
+                target = self.max_disk_bytes * self.DISK_LOW_WATER
+                entries.sort()
+                removed = 0
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    total -= size
+                    removed += 1
+                logger.info(f"识别磁盘缓存超出上限，已淘汰 {removed} 条")
+                for version_dir in self._marked_version_dirs():
+                    if version_dir != current and not any(
+                            name.endswith('.json') for _, _, files in os.walk(version_dir) for name in files):
+                        shutil.rmtree(version_dir, ignore_errors=True)
+                        logger.info(f"清理已淘汰完的模型版本识别缓存: {os.path.basename(version_dir)}")
+
+            with self._lock:
+                self._disk_bytes = total
+        finally:
+            self._evict_lock.release()
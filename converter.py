@@ -1,18 +1,54 @@
+import os
+import re
+import threading
 from typing import Optional
 import logging
-from final_converter import WordMathMLConverter
+from final_converter import FormulaTooComplexError, WordMathMLConverter
+from math_ast import tree_depth
+from cache import LRUCache
+from metrics import time_stage, record_backend, record_failure
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# aligned 各行在第一个顶层关系符前插入对齐点
+ALIGN_RELATIONS = frozenset({'=', '<', '>', r'\approx', r'\equiv', r'\leq', r'\geq', r'\neq', r'\le', r'\ge', r'\sim'})
+# LaTeX记号：\left/\right 连同其后的定界符、命令名、转义字符或单个字符
+_LATEX_TOKEN = re.compile(r'\\(?:left|right)\b\\?.|\\[A-Za-z]+|\\.|.', re.S)
+# 规范化缓存键时需要区分的记号：转义字符（含控制空格 "\ "）、注释（含结束它的换行）、空白
+_KEY_TOKEN = re.compile(r'\\.|%[^\n]*\n?|\s+', re.S)
+# <math> 根元素的内容
+_MATH_CONTENT = re.compile(r'^\s*<math\b[^>]*>(.*)</math>\s*$', re.S)
+
 
 class FormulaConverter:
     """公式格式转换器"""
     
-    def __init__(self):
-        """初始化转换器"""
-        self.advanced_word_converter = WordMathMLConverter()
+    # 可按需请求的输出格式
+    OUTPUT_FORMATS = frozenset({'latex', 'mathml', 'mathml_word_compatible'})
+    
+    # SymPy 的LaTeX解析器是递归实现且耗时随嵌套层数超线性增长（约300层连续上标即耗时数秒后
+    # RecursionError），只对语法树深度和长度都在此范围内的公式运行，其余直接用Word转换结果兜底
+    SYMPY_MAX_DEPTH = 50
+    SYMPY_MAX_LENGTH = 1000
+    
+    def __init__(self, cache_size: Optional[int] = None, cache_max_bytes: Optional[int] = None):
+        """
+        初始化转换器
+        
+        Args:
+            cache_size: 转换结果缓存的最大条目数，默认读取 CONVERSION_CACHE_SIZE（1024），0 表示关闭
+            cache_max_bytes: 转换结果缓存的字节预算，默认读取 CONVERSION_CACHE_MAX_BYTES（16MB）
+        """
+        if cache_size is None:
+            cache_size = int(os.environ.get('CONVERSION_CACHE_SIZE', '1024'))
+        if cache_max_bytes is None:
+            cache_max_bytes = int(os.environ.get('CONVERSION_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+        # 转换是纯函数，可按规范化后的LaTeX缓存完整结果
+        self._cache = LRUCache(cache_size, max_bytes=cache_max_bytes)
+        
+        self.advanced_word_converter = WordMathMLConverter.from_env()
         self._latex2mathml_available = False
         self._sympy_latex_available = False
         
@@ -25,17 +61,33 @@ class FormulaConverter:
             logger.warning("latex2mathml 不可用，将仅使用自定义转换器")
             self._latex_to_mathml = None
         
-        # 尝试导入 sympy.parsing.latex
-        try:
-            from sympy.parsing.latex import parse_latex
-            from sympy import mathml
-            self._parse_latex = parse_latex
-            self._sympy_mathml = mathml
-            self._sympy_latex_available = True
-        except ImportError:
-            logger.warning("sympy.parsing.latex 不可用")
-            self._parse_latex = None
-            self._sympy_mathml = None
+        # sympy.parsing.latex 导入耗时较长（约0.4s），且只在 latex2mathml 失败时才用到，
+        # 因此延迟到第一次使用时再导入
+        self._sympy_loaded = False
+        self._sympy_lock = threading.Lock()
+        self._parse_latex = None
+        self._sympy_mathml = None
+    
+    def _load_sympy(self) -> bool:
+        """按需导入 sympy.parsing.latex，返回是否可用"""
+        if self._sympy_loaded:
+            return self._sympy_latex_available
+        with self._sympy_lock:
+            if not self._sympy_loaded:
+                try:
+                    from sympy.parsing.latex import parse_latex
+                    from sympy import mathml
+                    self._parse_latex = parse_latex
+                    self._sympy_mathml = mathml
+                    self._sympy_latex_available = True
+                except ImportError:
+                    logger.warning("sympy.parsing.latex 不可用")
+                self._sympy_loaded = True
+        return self._sympy_latex_available
+    
+    def warm_up(self):
+        """预先导入延迟加载的后端，避免首个回退请求承担导入耗时"""
+        self._load_sympy()
     
     def latex_to_mathml(self, latex_formula: str) -> Optional[str]:
         """
@@ -51,36 +103,118 @@ class FormulaConverter:
             logger.error("无效的LaTeX公式")
             return None
         
+        try:
+            tree = self._check_complexity(latex_formula)
+            mathml_result = self._standard_mathml(latex_formula, tree)
+            if mathml_result:
+                return mathml_result
+            
+            # 最终备用：使用自定义转换器
+            result = self._word_mathml(latex_formula, tree)
+        except FormulaTooComplexError as e:
+            logger.error(f"公式过于复杂: {e}")
+            return None
+        if result:
+            logger.info("使用自定义转换器成功")
+            return result
+        logger.error("所有转换方法都失败")
+        return None
+    
+    def _standard_mathml(self, latex_formula: str, tree=None) -> Optional[str]:
+        """
+        依次尝试 latex2mathml 和 SymPy 生成标准MathML，均失败返回None
+        
+        Args:
+            latex_formula: LaTeX公式
+            tree: _check_complexity 已得到的语法树，为None时按需重新解析
+        
+        Raises:
+            FormulaTooComplexError: 公式嵌套过深或解析工作量超出预算
+        """
         # 首先尝试使用 latex2mathml 库
         if self._latex2mathml_available:
             try:
                 mathml_result = self._latex_to_mathml(latex_formula)
                 logger.info("LaTeX转MathML成功 (latex2mathml)")
+                record_backend('latex2mathml', True)
                 return mathml_result
             except Exception as e:
                 logger.warning(f"latex2mathml 转换失败: {e}")
+                record_backend('latex2mathml', False)
         
-        # 备用方案：使用 SymPy 的 LaTeX 解析器
-        if self._sympy_latex_available:
+        # 备用方案：使用 SymPy 的 LaTeX 解析器（先用自定义解析器检查深度）
+        if self._sympy_allowed(latex_formula, tree) and self._load_sympy():
             try:
                 # 使用正确的 LaTeX 解析函数
                 sympy_expr = self._parse_latex(latex_formula)
                 if sympy_expr:
                     mathml_result = self._sympy_mathml(sympy_expr)
                     logger.info("使用 SymPy parse_latex 转换成功")
+                    record_backend('sympy', True)
                     return mathml_result
             except Exception as sympy_error:
                 logger.warning(f"SymPy 转换也失败: {sympy_error}")
+            record_backend('sympy', False)
         
-        # 最终备用：使用自定义转换器
+        return None
+    
+    def _word_mathml(self, latex_formula: str, tree=None) -> str:
+        """
+        使用自定义转换器生成Word兼容MathML，失败返回空字符串
+        
+        Args:
+            latex_formula: LaTeX公式
+            tree: _check_complexity 已得到的语法树，给出时直接序列化，不再重新解析
+        
+        Raises:
+            FormulaTooComplexError: 公式嵌套过深、解析工作量或输出长度超出限制
+        """
         try:
-            result = self.advanced_word_converter.convert(latex_formula)
-            logger.info("使用自定义转换器成功")
-            return result
+            if tree is not None:
+                result = self.advanced_word_converter.serialize(tree)
+            else:
+                result = self.advanced_word_converter.convert(latex_formula)
+        except FormulaTooComplexError:
+            record_backend('custom', False)
+            raise
         except Exception as e:
-            logger.error(f"所有转换方法都失败: {e}")
+            logger.warning(f"高级转换失败: {e}")
+            result = ""
+        record_backend('custom', bool(result))
+        return result
+    
+    def _check_complexity(self, latex_formula: str):
+        """
+        用自定义转换器的解析器（显式栈，线性时间）检查公式复杂度，
+        避免把深层嵌套的公式交给可能递归溢出的 latex2mathml / SymPy
+        
+        Returns:
+            解析得到的语法树；解析器因其他原因失败时返回None
+        
+        Raises:
+            FormulaTooComplexError: 公式嵌套过深或解析工作量超出预算
+        """
+        try:
+            return self.advanced_word_converter.parse(latex_formula)
+        except FormulaTooComplexError:
+            raise
+        except Exception:
+            # 解析器的其他失败不影响标准后端
             return None
     
+    def _sympy_allowed(self, latex_formula: str, tree=None) -> bool:
+        """
+        公式是否可以交给 SymPy 解析（长度和语法树深度在限制之内）
+        
+        Raises:
+            FormulaTooComplexError: 公式嵌套过深或解析工作量超出预算
+        """
+        if len(latex_formula) > self.SYMPY_MAX_LENGTH:
+            return False
+        if tree is None:
+            tree = self._check_complexity(latex_formula)
+        return tree is not None and tree_depth(tree) <= self.SYMPY_MAX_DEPTH
+    
     def _clean_latex(self, latex_formula: str) -> str:
         """
         清理LaTeX公式，移除不必要的格式
@@ -159,53 +293,257 @@ class FormulaConverter:
         required_tags = ['<math', '</math>']
         return all(tag in mathml_string for tag in required_tags)
     
-    def format_output(self, latex_formula: str, mathml_formula: str) -> dict:
+    def format_output(self, latex_formula: str, mathml_formula: str,
+                      word_mathml: Optional[str] = None) -> dict:
         """
         格式化输出结果（简化版，只保留LaTeX和Word MathML）
         
         Args:
             latex_formula: LaTeX公式
             mathml_formula: MathML公式
+            word_mathml: 已生成的Word兼容MathML，为None时在此生成
             
         Returns:
             格式化后的结果字典
         """
         # 生成高级Word兼容MathML（更准确的格式）
-        advanced_word_mathml = ""
-        if latex_formula:
-            try:
-                advanced_word_mathml = self.advanced_word_converter.convert(latex_formula)
-            except Exception as e:
-                logger.warning(f"高级转换失败: {e}")
+        if word_mathml is None:
+            word_mathml = self._word_mathml(latex_formula) if latex_formula else ""
         
         return {
             'latex': latex_formula,
-            'mathml': mathml_formula or advanced_word_mathml,
-            'mathml_word_compatible': advanced_word_mathml or mathml_formula,
-            'mathml_valid': self.validate_mathml(advanced_word_mathml or mathml_formula),
-            'latex_display': f"$${latex_formula}$$" if latex_formula and not (latex_formula.startswith('$$') and latex_formula.endswith('$$')) else latex_formula if latex_formula else "",
+            'mathml': mathml_formula or word_mathml,
+            'mathml_word_compatible': word_mathml or mathml_formula,
+            'mathml_valid': self.validate_mathml(word_mathml or mathml_formula),
+            'latex_display': self._latex_display(latex_formula),
         }
     
-    def convert_formula(self, latex_formula: str) -> dict:
+    @staticmethod
+    def _latex_display(latex_formula: str) -> str:
+        """生成用于前端展示的 $$...$$ 形式"""
+        if not latex_formula:
+            return ""
+        if latex_formula.startswith('$$') and latex_formula.endswith('$$'):
+            return latex_formula
+        return f"$${latex_formula}$$"
+    
+    def convert_formula(self, latex_formula: str, outputs=None) -> dict:
         """
-        转换公式并返回完整结果
+        转换公式并返回完整结果（相同公式命中缓存时直接返回）
+        
+        每个转换后端对同一公式最多运行一次：Word转换器的结果同时用作
+        标准MathML的兜底，latex2mathml/SymPy 的结果同时用作Word MathML的兜底。
         
         Args:
             latex_formula: LaTeX公式
+            outputs: 需要的输出格式集合（'latex'、'mathml'、'mathml_word_compatible'），
+                     为None时生成全部；未请求的格式在结果中为空字符串
             
         Returns:
             转换结果字典
+            
+        Raises:
+            FormulaTooComplexError: 公式嵌套过深或解析工作量超出预算
         """
+        outputs = self.normalize_outputs(outputs)
+        
         if not latex_formula:
-            return self.format_output("", "")
+            return self.format_output("", "", "")
+        
+        cache_key = (self._normalize_key(latex_formula), outputs)
+        cached = self._cache.get(cache_key)
+        if cached is None:
+            with time_stage('conversion'):
+                cached = self._convert_uncached(latex_formula, outputs)
+            self._cache.put(cache_key, cached)
+        
+        # 返回副本，并保留调用方原始的LaTeX写法
+        result = dict(cached)
+        if result['latex'] != latex_formula:
+            result['latex'] = latex_formula
+            result['latex_display'] = self._latex_display(latex_formula)
+        return result
+    
+    @classmethod
+    def normalize_outputs(cls, outputs=None) -> frozenset:
+        """
+        校验并规范化输出格式列表
+        
+        Raises:
+            ValueError: 包含未知的输出格式
+        """
+        if outputs is None:
+            return cls.OUTPUT_FORMATS
+        if isinstance(outputs, str):
+            outputs = [item.strip() for item in outputs.split(',') if item.strip()]
+        outputs = frozenset(outputs)
+        unknown = outputs - cls.OUTPUT_FORMATS
+        if unknown:
+            raise ValueError(f"未知的输出格式: {', '.join(sorted(map(str, unknown)))}")
+        return outputs | {'latex'}
+    
+    def _convert_uncached(self, latex_formula: str, outputs: frozenset) -> dict:
+        """按需运行各转换后端，每个后端最多运行一次"""
+        word_mathml = ""
+        mathml_formula = ""
+        tree = None
+        
+        if outputs != {'latex'}:
+            # 先用自定义解析器检查复杂度；语法树供Word MathML序列化和 SymPy 的深度检查复用，只解析一次
+            tree = self._check_complexity(latex_formula)
+        
+        if 'mathml_word_compatible' in outputs:
+            word_mathml = self._word_mathml(latex_formula, tree)
+        
+        # Word转换成功且不需要标准MathML时，完全跳过 latex2mathml / SymPy
+        if 'mathml' in outputs or ('mathml_word_compatible' in outputs and not word_mathml):
+            mathml_formula = self._standard_mathml(latex_formula, tree) or ""
+        
+        # 标准MathML失败时用Word转换结果兜底（未运行过才运行）
+        if 'mathml' in outputs and not mathml_formula and 'mathml_word_compatible' not in outputs:
+            word_mathml = self._word_mathml(latex_formula, tree)
+        
+        if outputs != {'latex'} and not mathml_formula and not word_mathml:
+            record_failure('conversion')
+        
+        result = self.format_output(latex_formula, mathml_formula, word_mathml)
+        for name in ('mathml', 'mathml_word_compatible'):
+            if name not in outputs:
+                result[name] = ""
+        return result
+    
+    def iter_convert_batch(self, latex_formulas: list, outputs=None):
+        """
+        批量转换公式，每条完成后立即产出
+        
+        同一批次内规范化后相同的公式只转换一次。
+        
+        Args:
+            latex_formulas: LaTeX公式列表
+            outputs: 需要的输出格式集合，同 convert_formula
+            
+        Yields:
+            (输入下标, 转换结果字典)
+        """
+        outputs = self.normalize_outputs(outputs)
+        seen = {}
+        for index, latex_formula in enumerate(latex_formulas):
+            key = self._normalize_key(latex_formula) if latex_formula else ''
+            if key in seen:
+                result = dict(seen[key])
+                result['latex'] = latex_formula
+                result['latex_display'] = self._latex_display(latex_formula)
+            else:
+                result = self.convert_formula(latex_formula, outputs)
+                seen[key] = result
+            yield index, result
+    
+    @staticmethod
+    def split_alignment(latex_formula: str) -> tuple:
+        """
+        在第一个顶层（不在花括号内）关系符处把一行公式拆为左右两半
         
-        # 转换为MathML
-        mathml_formula = self.latex_to_mathml(latex_formula)
+        Returns:
+            (关系符左侧, 关系符及右侧)；没有关系符时左侧为整行、右侧为空字符串
+        """
+        depth = 0
+        for match in _LATEX_TOKEN.finditer(latex_formula):
+            token = match.group(0)
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+            elif depth == 0 and token in ALIGN_RELATIONS:
+                return latex_formula[:match.start()].strip(), latex_formula[match.start():].strip()
+        return latex_formula.strip(), ''
+    
+    @classmethod
+    def join_aligned(cls, latex_formulas: list) -> str:
+        """
+        把多行公式拼接为 aligned 环境，各行在第一个关系符处对齐
+        
+        Args:
+            latex_formulas: 从上到下的LaTeX公式列表（空项跳过）
+        """
+        lines = []
+        for latex_formula in latex_formulas:
+            if not latex_formula or not latex_formula.strip():
+                continue
+            left, right = cls.split_alignment(latex_formula)
+            lines.append(f'{left} &{right}'.strip() if right else left)
+        return '\\begin{aligned}' + ' \\\\ '.join(lines) + '\\end{aligned}'
+    
+    def convert_aligned(self, latex_formulas: list, outputs=None) -> dict:
+        """
+        把多行公式拼接为 aligned 环境并转换
         
-        # 格式化输出
-        result = self.format_output(latex_formula, mathml_formula or "")
+        latex2mathml 和自定义转换器都不支持 aligned 环境，因此MathML由各行在对齐点拆成的
+        左右两半分别转换（命中缓存时不重复转换）后组装为两列的 mtable。
         
+        Args:
+            latex_formulas: 从上到下的LaTeX公式列表
+            outputs: 需要的输出格式集合，同 convert_formula
+            
+        Returns:
+            与 convert_formula 相同结构的结果字典；任意一半转换失败时对应的MathML为空字符串
+            
+        Raises:
+            FormulaTooComplexError: 公式嵌套过深或解析工作量超出预算
+        """
+        outputs = self.normalize_outputs(outputs)
+        latex_formula = self.join_aligned(latex_formulas)
+        rows = {'mathml': [], 'mathml_word_compatible': []}
+        for line in latex_formulas:
+            if not line or not line.strip():
+                continue
+            cells = {name: [] for name in rows}
+            for half in self.split_alignment(line):
+                if not half:
+                    for name in rows:
+                        cells[name].append('')
+                    continue
+                converted = self.convert_formula(half, outputs)
+                for name in rows:
+                    content = _MATH_CONTENT.match(converted[name])
+                    cells[name].append(content.group(1).strip() if content else None)
+            for name in rows:
+                rows[name].append(cells[name])
+        
+        result = self.format_output(latex_formula, "", "")
+        for name, attributes in (('mathml', ' display="block"'), ('mathml_word_compatible', '')):
+            if name not in outputs or any(cell is None for row in rows[name] for cell in row):
+                result[name] = ""
+                continue
+            table = ''.join('<mtr>' + ''.join(f'<mtd>{cell}</mtd>' for cell in row) + '</mtr>'
+                            for row in rows[name])
+            result[name] = (f'<math xmlns="http://www.w3.org/1998/Math/MathML"{attributes}>'
+                            f'<mtable columnalign="right left" columnspacing="0em" displaystyle="true">'
+                            f'{table}</mtable></math>')
+        result['mathml_valid'] = self.validate_mathml(result['mathml_word_compatible'] or result['mathml'])
         return result
+    
+    def cache_stats(self) -> dict:
+        """返回转换结果缓存的统计信息"""
+        return self._cache.stats()
+    
+    def clear_cache(self):
+        """清空转换结果缓存"""
+        self._cache.clear()
+    
+    @staticmethod
+    def _normalize_key(latex_formula: str) -> str:
+        """
+        规范化LaTeX作为缓存键（去除首尾空白并合并连续空白）
+        
+        注释连同结束它的换行原样保留（换行结束注释，换成空格后含义不同），
+        反斜杠后的空白是控制空格，也不参与合并
+        """
+        def replace(match):
+            token = match.group(0)
+            if token[0] in '\\%':
+                return token
+            return '' if match.start() == 0 or match.end() == len(latex_formula) else ' '
+        return _KEY_TOKEN.sub(replace, latex_formula)
 
 
 # 测试函数
@@ -0,0 +1,331 @@
+"""
+文档识别
+把PDF逐页栅格化（同一时刻只保留有限几页的像素），在每页中定位公式区域，
+区域裁剪后成批送入识别器，按页码顺序流式产出每个公式的识别结果和位置
+"""
+
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import cv2
+import numpy as np
+from preprocess import default_preprocessor
+from segmentation import FormulaSegmenter
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PDF_MAGIC = b'%PDF-'
+
+
+def load_pymupdf():
+    """
+    导入 PyMuPDF（1.24.3 起模块名为 pymupdf，更早的版本为 fitz）
+
+    Raises:
+        RuntimeError: 未安装 PyMuPDF
+    """
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf
+        except ImportError:
+            raise RuntimeError("PDF识别需要安装 PyMuPDF（pip install pymupdf）") from None
+    return pymupdf
+
+
+def parse_page_ranges(spec: Optional[str], page_count: int) -> list:
+    """
+    解析页码范围
+
+    Args:
+        spec: 如 "1-3,7"，页码从1开始、含两端；为空时表示全部页
+        page_count: 文档总页数
+
+    Returns:
+        从0开始的页下标列表（按输入顺序，去重）
+
+    Raises:
+        ValueError: 格式错误或页码超出范围
+    """
+    if not spec or not spec.strip():
+        return list(range(page_count))
+
+    indices = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                first, last = (int(value) for value in part.split('-', 1))
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError(f"无效的页码范围: {part}") from None
+        if first < 1 or last > page_count or first > last:
+            raise ValueError(f"页码范围 {part} 超出文档页数（共 {page_count} 页）")
+        indices.extend(range(first - 1, last))
+    return list(dict.fromkeys(indices))
+
+
+class DocumentRecognizer:
+    """PDF文档的公式识别流水线"""
+
+    # 独立公式通常居中排版：左右两侧相对正文边界的缩进都不小于正文宽度的此比例
+    DISPLAY_INDENT_RATIO = 0.08
+    # 双栏排版的栏间空白：页面中部三分之一内，墨迹行数不超过页高此比例的列视为空白
+    GUTTER_INK_RATIO = 0.02
+    # 栏间空白的最小宽度（占页宽的比例）
+    MIN_GUTTER_RATIO = 0.01
+
+    def __init__(self, recognizer, converter=None, dpi: int = 200, page_concurrency: int = 2,
+                 max_pages: int = 500, segmenter: Optional[FormulaSegmenter] = None):
+        """
+        Args:
+            recognizer: FormulaRecognizer 实例
+            converter: FormulaConverter 实例，为None时只返回LaTeX
+            dpi: 栅格化分辨率
+            page_concurrency: 同时处理的页数（也是同时驻留内存的页图像数上限）
+            max_pages: 单个文档最多处理的页数
+            segmenter: 没有公式检测模型时用于切分页面的切分器
+        """
+        self.recognizer = recognizer
+        self.converter = converter
+        self.dpi = max(36, dpi)
+        self.page_concurrency = max(1, page_concurrency)
+        self.max_pages = max(1, max_pages)
+        # 整页正文的行数远多于单张公式截图
+        self.segmenter = segmenter or FormulaSegmenter(max_regions=1024)
+        self._detector_failed = False
+
+    @classmethod
+    def from_env(cls, recognizer, converter=None) -> 'DocumentRecognizer':
+        """根据环境变量创建（PDF_RENDER_DPI、PDF_PAGE_CONCURRENCY、PDF_MAX_PAGES）"""
+        return cls(
+            recognizer,
+            converter,
+            dpi=int(os.environ.get('PDF_RENDER_DPI', '200')),
+            page_concurrency=int(os.environ.get('PDF_PAGE_CONCURRENCY', '2')),
+            max_pages=int(os.environ.get('PDF_MAX_PAGES', '500')),
+        )
+
+    def open(self, source):
+        """
+        打开PDF文档
+
+        Args:
+            source: 文件路径或PDF字节
+
+        Raises:
+            RuntimeError: 未安装 PyMuPDF
+            ValueError: 不是有效的PDF
+        """
+        pymupdf = load_pymupdf()
+        try:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                return pymupdf.open(stream=bytes(source), filetype='pdf')
+            return pymupdf.open(source, filetype='pdf')
+        except Exception as e:
+            raise ValueError(f"无法打开PDF文档: {e}") from None
+
+    def rasterize(self, document, page_index: int) -> np.ndarray:
+        """把一页栅格化为灰度数组（调用方需保证同一文档不被多个线程同时访问）"""
+        pymupdf = load_pymupdf()
+        pixmap = document.load_page(page_index).get_pixmap(dpi=self.dpi, colorspace=pymupdf.csGRAY, alpha=False)
+        image = np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.stride)
+        # 复制出独立的数组，pixmap 随即释放
+        return image[:, :pixmap.width].copy()
+
+    def iter_pdf(self, source, pages: Optional[str] = None, outputs=None, route: Optional[str] = 'formula'):
+        """
+        流式识别PDF中的公式
+
+        栅格化在当前线程中逐页进行（PyMuPDF 的文档对象不是线程安全的），公式定位和识别
+        在线程池中按页并行；同时在处理的页数不超过 page_concurrency，内存占用与总页数无关。
+        结果按页码顺序产出，消费方停止迭代时不再栅格化后续页面。
+
+        Args:
+            source: PDF文件路径、PDF字节或已打开的文档对象
+            pages: 页码范围（见 parse_page_ranges），为空时处理全部页
+            outputs: 需要的输出格式集合（见 FormulaConverter.normalize_outputs）
+            route: 推理路由，公式区域默认直接调用公式识别模型
+
+        Yields:
+            每个公式区域一条 {'type': 'formula', 'page', 'index', 'bbox', 'kind', 'success', ...}，
+            bbox 为PDF坐标（点，左上角为原点）下的 [x, y, 宽, 高]；
+            每页结束后一条 {'type': 'page', 'page', 'width', 'height', 'formulas'}
+
+        Raises:
+            RuntimeError: 未安装 PyMuPDF
+            ValueError: 不是有效的PDF，页码范围无效，或页数超过 max_pages
+        """
+        owns_document = not hasattr(source, 'load_page')
+        document = self.open(source) if owns_document else source
+        try:
+            indices = parse_page_ranges(pages, document.page_count)
+            if len(indices) > self.max_pages:
+                raise ValueError(f"文档共需处理 {len(indices)} 页，超过上限 {self.max_pages}")
+
+            with ThreadPoolExecutor(max_workers=self.page_concurrency) as executor:
+                in_flight = deque()
+                for page_index in indices:
+                    image = self.rasterize(document, page_index)
+                    in_flight.append(executor.submit(self.process_page, page_index + 1, image, outputs, route))
+                    del image
+                    if len(in_flight) >= self.page_concurrency:
+                        yield from in_flight.popleft().result()
+                while in_flight:
+                    yield from in_flight.popleft().result()
+        finally:
+            if owns_document:
+                document.close()
+
+    def process_page(self, page_number: int, image: np.ndarray, outputs=None,
+                     route: Optional[str] = 'formula') -> list:
+        """
+        定位并识别一页中的公式
+
+        Returns:
+            该页的结果列表（公式条目在前，页结束条目在最后）
+        """
+        height, width = image.shape[:2]
+        scale = 72.0 / self.dpi
+        regions = self.detect(image)
+
+        records = []
+        if regions:
+            crops = [np.ascontiguousarray(image[y:y + h, x:x + w]) for (x, y, w, h), _ in regions]
+            results = self.recognizer.batch_recognize(crops, route=route)
+            for index, (((x, y, w, h), kind), result) in enumerate(zip(regions, results)):
+                record = {
+                    'type': 'formula',
+                    'page': page_number,
+                    'index': index,
+                    'bbox': [round(value * scale, 2) for value in (x, y, w, h)],
+                    'kind': kind,
+                    'success': result['success'],
+                }
+                if result['success']:
+                    record.update(self._convert(result['formula'], outputs))
+                else:
+                    record['error'] = result.get('error') or '无法识别公式'
+                records.append(record)
+
+        records.append({
+            'type': 'page',
+            'page': page_number,
+            'width': round(width * scale, 2),
+            'height': round(height * scale, 2),
+            'formulas': sum(record['success'] for record in records),
+        })
+        return records
+
+    def _convert(self, latex_formula: str, outputs) -> dict:
+        """转换为请求的输出格式；没有转换器时只返回LaTeX"""
+        if self.converter is None:
+            return {'latex': latex_formula}
+        try:
+            outputs = self.converter.normalize_outputs(outputs)
+            conversion_result = self.converter.convert_formula(latex_formula, outputs)
+        except Exception as e:
+            return {'latex': latex_formula, 'conversion_error': str(e)}
+        converted = {'latex': conversion_result['latex']}
+        for name in ('mathml', 'mathml_word_compatible'):
+            if name in outputs:
+                converted[name] = conversion_result.get(name, '')
+        return converted
+
+    def detect(self, image: np.ndarray) -> list:
+        """
+        定位页面中的公式区域
+
+        已加载 Pix2Text 完整模型时使用其公式检测模型（可检测行内公式）；
+        formula-only 模式、工作池模式或检测失败时，按版面规则查找居中排版的独立公式行。
+
+        Returns:
+            [([x, y, 宽, 高], 类型)]，类型为 'isolated'（独立公式）或 'embedding'（行内公式）
+        """
+        detector = self._formula_detector()
+        if detector is not None:
+            try:
+                return self._detect_with_model(detector, image)
+            except Exception as e:
+                # 检测模型接口随 Pix2Text 版本变化，失败一次后不再尝试
+                self._detector_failed = True
+                logger.warning(f"公式检测模型不可用，改用版面规则: {e}")
+        return [(box, 'isolated') for box in self.display_regions(image)]
+
+    def _formula_detector(self):
+        """Pix2Text 的公式检测模型（MFD），不可用时返回None"""
+        p2t = getattr(self.recognizer, 'p2t', None)
+        if p2t is None or self._detector_failed:
+            return None
+        text_formula_ocr = getattr(p2t, 'text_formula_ocr', None)
+        return getattr(p2t, 'mfd', None) or getattr(text_formula_ocr, 'mfd', None)
+
+    @staticmethod
+    def _detect_with_model(detector, image: np.ndarray) -> list:
+        """用公式检测模型定位公式，返回按阅读顺序（从上到下、从左到右）排列的区域"""
+        from PIL import Image
+
+        height, width = image.shape[:2]
+        regions = []
+        for item in detector.detect(Image.fromarray(image)):
+            points = np.asarray(item['box'], dtype=np.float32).reshape(-1, 2)
+            x0, y0 = np.floor(points.min(axis=0)).astype(int)
+            x1, y1 = np.ceil(points.max(axis=0)).astype(int)
+            x0, y0 = max(0, x0), max(0, y0)
+            x1, y1 = min(width, x1), min(height, y1)
+            if x1 > x0 and y1 > y0:
+                kind = 'embedding' if item.get('type') == 'embedding' else 'isolated'
+                regions.append(([int(x0), int(y0), int(x1 - x0), int(y1 - y0)], kind))
+        regions.sort(key=lambda region: (region[0][1], region[0][0]))
+        return regions
+
+    def display_regions(self, image: np.ndarray) -> list:
+        """
+        按版面规则查找独立公式行：先按栏间空白拆分双栏，再在每栏内按行切分，
+        保留左右两侧都明显缩进（居中排版）的行
+
+        Returns:
+            原图坐标下的 [x, y, 宽, 高] 列表，按栏、再按从上到下排列
+        """
+        regions = []
+        for left, right in self._columns(image):
+            lines = self.segmenter.regions(image[:, left:right])
+            if not lines:
+                continue
+            # 正文行占大多数：以较宽的行的左右边界作为正文边界（右边界取较高分位数，兼容不两端对齐的正文）
+            widest = max(w for _, _, w, _ in lines)
+            body = np.array([(x, x + w) for x, _, w, _ in lines if w >= 0.6 * widest])
+            body_left = float(np.percentile(body[:, 0], 10))
+            body_right = float(np.percentile(body[:, 1], 90))
+            indent = self.DISPLAY_INDENT_RATIO * (body_right - body_left)
+            for x, y, w, h in lines:
+                if x >= body_left + indent and x + w <= body_right - indent:
+                    regions.append([x + left, y, w, h])
+        return regions
+
+    def _columns(self, image: np.ndarray) -> list:
+        """按页面中部最宽的栏间空白拆分为左右两栏，没有栏间空白时返回整页 [(左, 右)]"""
+        width = image.shape[1]
+        mask, step = default_preprocessor.ink_mask(image)
+        ink_rows = cv2.reduce((mask > 0).astype(np.uint8), 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+        blank = ink_rows <= self.GUTTER_INK_RATIO * mask.shape[0]
+
+        # 中部三分之一内最长的空白列段
+        start, end = len(blank) // 3, 2 * len(blank) // 3
+        best, best_length, run = None, 0, 0
+        for column in range(start, end):
+            run = run + 1 if blank[column] else 0
+            if run > best_length:
+                best, best_length = column - run + 1, run
+        if best is None or best_length * step < self.MIN_GUTTER_RATIO * width:
+            return [(0, width)]
+        split = (best + best_length // 2) * step
+        return [(0, split), (split, width)]
@@ -3,1127 +3,833 @@
 Word兼容的MathML转换器
 完全重新设计，使用递归下降解析
 支持完整的LaTeX数学命令集
+
+公式先由 tokenize_latex 一次扫描切分为词法单元数组，解析器只在单元下标上移动，
+分组、括号的匹配位置在词法分析时一并求出，不再复制子串、不再重复扫描；
+解析结果是 math_ast 中的语法树，由 MathMLSerializer 输出。
+递归下降的各解析函数由显式栈驱动，嵌套深度和工作量有上限，深层嵌套不会触发 RecursionError
 """
 
-import re
+import os
+from types import GeneratorType
 
+from math_ast import (
+    Fraction, Identifier, Math, MathMLSerializer, Number, Operator, OutputTooLargeError, Over,
+    Root, Row, Scripts, Space, Sqrt, Text, Under, register_symbols,
+)
 
-class WordMathMLConverter:
-    def __init__(self):
-        # 完整希腊字母表（小写 + 大写）
-        self.greek_letters = {
-            # 小写
-            'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ',
-            'epsilon': 'ε', 'zeta': 'ζ', 'eta': 'η', 'theta': 'θ',
-            'iota': 'ι', 'kappa': 'κ', 'lambda': 'λ', 'mu': 'μ',
-            'nu': 'ν', 'xi': 'ξ', 'pi': 'π', 'rho': 'ρ',
-            'sigma': 'σ', 'tau': 'τ', 'upsilon': 'υ', 'phi': 'φ',
-            'chi': 'χ', 'psi': 'ψ', 'omega': 'ω',
-            'varepsilon': 'ε', 'vartheta': 'ϑ', 'varpi': 'ϖ',
-            'varrho': 'ϱ', 'varsigma': 'ς', 'varphi': 'ϕ',
-            # 大写
-            'Alpha': 'Α', 'Beta': 'Β', 'Gamma': 'Γ', 'Delta': 'Δ',
-            'Epsilon': 'Ε', 'Zeta': 'Ζ', 'Eta': 'Η', 'Theta': 'Θ',
-            'Iota': 'Ι', 'Kappa': 'Κ', 'Lambda': 'Λ', 'Mu': 'Μ',
-            'Nu': 'Ν', 'Xi': 'Ξ', 'Pi': 'Π', 'Rho': 'Ρ',
-            'Sigma': 'Σ', 'Tau': 'Τ', 'Upsilon': 'Υ', 'Phi': 'Φ',
-            'Chi': 'Χ', 'Psi': 'Ψ', 'Omega': 'Ω',
-        }
-        
-        # 完整运算符映射
-        self.operator_map = {
-            'cdot': '⋅', 'times': '×', 'div': '÷',
-            'pm': '±', 'mp': '∓',
-            'leq': '≤', 'le': '≤', 'geq': '≥', 'ge': '≥',
-            'neq': '≠', 'ne': '≠', 'approx': '≈',
-            'equiv': '≡', 'sim': '∼', 'simeq': '≃',
-            'll': '≪', 'gg': '≫',
-            'subset': '⊂', 'supset': '⊃', 'subseteq': '⊆', 'supseteq': '⊇',
-            'in': '∈', 'notin': '∉', 'ni': '∋',
-            'cap': '∩', 'cup': '∪', 'setminus': '∖',
-            'land': '∧', 'lor': '∨', 'lnot': '¬', 'neg': '¬',
-            'forall': '∀', 'exists': '∃', 'nexists': '∄',
-            'partial': '∂', 'nabla': '∇',
-            'infty': '∞', 'emptyset': '∅', 'varnothing': '∅',
-            'to': '→', 'rightarrow': '→', 'leftarrow': '←',
-            'Rightarrow': '⇒', 'Leftarrow': '⇐', 'Leftrightarrow': '⇔',
-            'mapsto': '↦',
-            'ldots': '…', 'cdots': '⋯', 'vdots': '⋮', 'ddots': '⋱',
-            'angle': '∠', 'triangle': '△',
-            'perp': '⊥', 'parallel': '∥',
-            'prime': '′',
-        }
-        
-        # 函数名映射
-        self.function_names = {
-            'sin', 'cos', 'tan', 'cot', 'sec', 'csc',
-            'sinh', 'cosh', 'tanh', 'coth',
-            'arcsin', 'arccos', 'arctan',
-            'log', 'ln', 'lg', 'exp',
-            'lim', 'limsup', 'liminf',
-            'max', 'min', 'sup', 'inf',
-            'arg', 'det', 'dim', 'gcd', 'hom', 'ker',
-            'deg', 'mod', 'Pr',
-        }
-        
-        # 括号映射
-        self.bracket_map = {
-            'lbrace': '{', 'rbrace': '}',
-            'lbrack': '[', 'rbrack': ']',
-            'lparen': '(', 'rparen': ')',
-            'langle': '⟨', 'rangle': '⟩',
-            'lfloor': '⌊', 'rfloor': '⌋',
-            'lceil': '⌈', 'rceil': '⌉',
-            'vert': '|', 'Vert': '‖',
-        }
-        
-        # 重音/修饰符映射
-        self.accent_map = {
-            'hat': '^', 'bar': '¯', 'vec': '→',
-            'dot': '˙', 'ddot': '¨', 'tilde': '˜',
-            'overline': '¯', 'underline': '_',
-            'widehat': '^', 'widetilde': '˜',
-        }
-    
-    def convert(self, formula):
-        """转换LaTeX公式为MathML（Word兼容版）"""
-        result = ['<math xmlns="http://www.w3.org/1998/Math/MathML">']
-        
-        # 处理整个公式
-        content, _ = self._parse_expression(formula.strip())
-        result.extend(content)
-        
-        result.append('</math>')
-        output = '\n'.join(result)
-        
-        # 将非ASCII Unicode字符转换为XML实体，提高Word兼容性
-        output = self._unicode_to_xml_entities(output)
-        return output
-    
-    def _unicode_to_xml_entities(self, text):
-        """将非ASCII Unicode字符转换为XML数字实体"""
-        result = []
-        for char in text:
-            if ord(char) > 127:
-                # 转换为十六进制XML实体
-                result.append(f'&#x{ord(char):04X};')
+# 词法单元类型
+TOKEN_COMMAND = 0   # \name，值为命令名（末尾孤立的反斜杠为空命令名）
+TOKEN_CONTROL = 1   # 反斜杠加单个非字母数字字符，如 \{ \, \\ ，值为该字符
+TOKEN_LBRACE = 2    # {
+TOKEN_RBRACE = 3    # }
+TOKEN_SUP = 4       # ^
+TOKEN_SUB = 5       # _
+TOKEN_NUMBER = 6    # 数字串（最多一个小数点）
+TOKEN_LETTER = 7    # 单个字母
+TOKEN_CHAR = 8      # 其他单个字符（运算符、括号等）
+
+# 单字符运算符对应的<mo>文本
+CHAR_OPERATORS = {
+    '+': '+', '-': '-', '=': '=',
+    '*': '×', '/': '/', '<': '<', '>': '>',
+    '|': '|', ',': ',', ';': ';', ':': ':', '!': '!', "'": '′',
+}
+
+
+class FormulaTooComplexError(ValueError):
+    """公式嵌套过深或解析工作量超出预算"""
+
+
+class LatexTokens:
+    """
+    词法单元数组（按列存储）
+
+    kinds/values/starts/ends 分别为类型、值和源码起止偏移；
+    match 记录花括号、圆括号、方括号配对单元的下标，未配对为 -1
+    """
+
+    __slots__ = ('source', 'kinds', 'values', 'starts', 'ends', 'match')
+
+    def __init__(self, source):
+        self.source = source
+        self.kinds = []
+        self.values = []
+        self.starts = []
+        self.ends = []
+        self.match = []
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def source_text(self, open_index, end):
+        """开分组单元之后到单元end之前的原始文本（去除首尾空白）"""
+        stop = self.starts[end] if end < len(self.kinds) else len(self.source)
+        return self.source[self.ends[open_index]:stop].strip()
+
+
+def tokenize_latex(formula, single_argument_commands=frozenset()):
+    """
+    将LaTeX公式一次扫描切分为词法单元
+
+    与TeX一致，上下标及 single_argument_commands 中命令（\\sqrt、重音等）的
+    不带花括号参数只取一个字符，因此紧随其后的数字串只切出第一位
+
+    Args:
+        formula: LaTeX公式
+        single_argument_commands: 参数可省略花括号的命令名集合
+
+    Returns:
+        LatexTokens
+    """
+    tokens = LatexTokens(formula)
+    kinds = tokens.kinds
+    values = tokens.values
+    starts = tokens.starts
+    ends = tokens.ends
+    match = tokens.match
+
+    # 每层花括号独立配对圆括号和方括号：(左花括号下标, 圆括号栈, 方括号栈)
+    frames = [(-1, [], [])]
+    root_indices = set()        # \sqrt[...] 根指数的左方括号
+    single_argument = False     # 下一个参数只取一个字符
+    after_sqrt = False
+    after_delimiter = False     # \left / \right 之后的分隔符
+
+    n = len(formula)
+    i = 0
+    while i < n:
+        ch = formula[i]
+        if ch.isspace():
+            i += 1
+            continue
+
+        start = i
+        i += 1
+        if ch == '\\':
+            while i < n and (formula[i].isalpha() or formula[i].isdigit()):
+                i += 1
+            if i > start + 1:
+                kind, value = TOKEN_COMMAND, formula[start + 1:i]
+            elif i < n:
+                kind, value = TOKEN_CONTROL, formula[i]
+                i += 1
+            else:
+                kind, value = TOKEN_COMMAND, ''
+        elif ch == '{':
+            kind, value = TOKEN_LBRACE, ch
+        elif ch == '}':
+            kind, value = TOKEN_RBRACE, ch
+        elif ch == '^':
+            kind, value = TOKEN_SUP, ch
+        elif ch == '_':
+            kind, value = TOKEN_SUB, ch
+        elif ch.isdigit() or (ch == '.' and i < n and formula[i].isdigit()):
+            if ch == '.' and (single_argument or after_delimiter):
+                kind, value = TOKEN_CHAR, ch
+            elif single_argument:
+                kind, value = TOKEN_NUMBER, ch
             else:
-                result.append(char)
-        return ''.join(result)
+                has_dot = ch == '.'
+                while i < n:
+                    if formula[i].isdigit():
+                        i += 1
+                    elif formula[i] == '.' and not has_dot:
+                        has_dot = True
+                        i += 1
+                    else:
+                        break
+                kind, value = TOKEN_NUMBER, formula[start:i]
+        elif ch.isalpha():
+            kind, value = TOKEN_LETTER, ch
+        else:
+            kind, value = TOKEN_CHAR, ch
+
+        index = len(kinds)
+        kinds.append(kind)
+        values.append(value)
+        starts.append(start)
+        ends.append(i)
+        match.append(-1)
+
+        # 记录配对关系，并确定下一个单元是否为单字符参数
+        # （本身已作为单字符参数的单元不再开启新的参数）
+        consumed_as_argument = single_argument and kind != TOKEN_LBRACE
+        single_argument = kind == TOKEN_SUP or kind == TOKEN_SUB
+        if kind == TOKEN_COMMAND:
+            single_argument = value in single_argument_commands
+        elif kind == TOKEN_LBRACE:
+            frames.append((index, [], []))
+        elif kind == TOKEN_RBRACE:
+            if len(frames) > 1:
+                opener = frames.pop()[0]
+                match[opener] = index
+                match[index] = opener
+        elif kind == TOKEN_CHAR and value in '()[]':
+            _, parens, brackets = frames[-1]
+            if value == '(':
+                parens.append(index)
+            elif value == '[':
+                brackets.append(index)
+                if after_sqrt:
+                    root_indices.add(index)
+            else:
+                stack = parens if value == ')' else brackets
+                if stack:
+                    opener = stack.pop()
+                    match[opener] = index
+                    match[index] = opener
+                    single_argument = opener in root_indices
+        if consumed_as_argument:
+            single_argument = False
+        after_sqrt = kind == TOKEN_COMMAND and value == 'sqrt' and not consumed_as_argument
+        after_delimiter = kind == TOKEN_COMMAND and value in ('left', 'right')
+
+    return tokens
+
+
+class WordMathMLConverter:
+    """
+    LaTeX → Word兼容MathML转换器
+
+    符号映射和命令分派表都在类级别构建一次，所有实例共享；
+    新命令通过 register_command / register_alias 注册，不需要修改解析代码
+    """
+
+    # 完整希腊字母表（小写 + 大写）
+    greek_letters = {
+        # 小写
+        'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ',
+        'epsilon': 'ε', 'zeta': 'ζ', 'eta': 'η', 'theta': 'θ',
+        'iota': 'ι', 'kappa': 'κ', 'lambda': 'λ', 'mu': 'μ',
+        'nu': 'ν', 'xi': 'ξ', 'pi': 'π', 'rho': 'ρ',
+        'sigma': 'σ', 'tau': 'τ', 'upsilon': 'υ', 'phi': 'φ',
+        'chi': 'χ', 'psi': 'ψ', 'omega': 'ω',
+        'varepsilon': 'ε', 'vartheta': 'ϑ', 'varpi': 'ϖ',
+        'varrho': 'ϱ', 'varsigma': 'ς', 'varphi': 'ϕ',
+        # 大写
+        'Alpha': 'Α', 'Beta': 'Β', 'Gamma': 'Γ', 'Delta': 'Δ',
+        'Epsilon': 'Ε', 'Zeta': 'Ζ', 'Eta': 'Η', 'Theta': 'Θ',
+        'Iota': 'Ι', 'Kappa': 'Κ', 'Lambda': 'Λ', 'Mu': 'Μ',
+        'Nu': 'Ν', 'Xi': 'Ξ', 'Pi': 'Π', 'Rho': 'Ρ',
+        'Sigma': 'Σ', 'Tau': 'Τ', 'Upsilon': 'Υ', 'Phi': 'Φ',
+        'Chi': 'Χ', 'Psi': 'Ψ', 'Omega': 'Ω',
+    }
+
+    # 完整运算符映射
+    operator_map = {
+        'cdot': '⋅', 'times': '×', 'div': '÷',
+        'pm': '±', 'mp': '∓',
+        'leq': '≤', 'le': '≤', 'geq': '≥', 'ge': '≥',
+        'neq': '≠', 'ne': '≠', 'approx': '≈',
+        'equiv': '≡', 'sim': '∼', 'simeq': '≃',
+        'll': '≪', 'gg': '≫',
+        'subset': '⊂', 'supset': '⊃', 'subseteq': '⊆', 'supseteq': '⊇',
+        'in': '∈', 'notin': '∉', 'ni': '∋',
+        'cap': '∩', 'cup': '∪', 'setminus': '∖',
+        'land': '∧', 'lor': '∨', 'lnot': '¬', 'neg': '¬',
+        'forall': '∀', 'exists': '∃', 'nexists': '∄',
+        'partial': '∂', 'nabla': '∇',
+        'infty': '∞', 'emptyset': '∅', 'varnothing': '∅',
+        'to': '→', 'rightarrow': '→', 'leftarrow': '←',
+        'Rightarrow': '⇒', 'Leftarrow': '⇐', 'Leftrightarrow': '⇔',
+        'mapsto': '↦',
+        'ldots': '…', 'cdots': '⋯', 'vdots': '⋮', 'ddots': '⋱',
+        'angle': '∠', 'triangle': '△',
+        'perp': '⊥', 'parallel': '∥',
+        'prime': '′',
+    }
+
+    # 函数名映射
+    function_names = {
+        'sin', 'cos', 'tan', 'cot', 'sec', 'csc',
+        'sinh', 'cosh', 'tanh', 'coth',
+        'arcsin', 'arccos', 'arctan',
+        'log', 'ln', 'lg', 'exp',
+        'lim', 'limsup', 'liminf',
+        'max', 'min', 'sup', 'inf',
+        'arg', 'det', 'dim', 'gcd', 'hom', 'ker',
+        'deg', 'mod', 'Pr',
+    }
+
+    # 括号映射
+    bracket_map = {
+        'lbrace': '{', 'rbrace': '}',
+        'lbrack': '[', 'rbrack': ']',
+        'lparen': '(', 'rparen': ')',
+        'langle': '⟨', 'rangle': '⟩',
+        'lfloor': '⌊', 'rfloor': '⌋',
+        'lceil': '⌈', 'rceil': '⌉',
+        'vert': '|', 'Vert': '‖',
+    }
+
+    # 重音/修饰符映射
+    accent_map = {
+        'hat': '^', 'bar': '¯', 'vec': '→',
+        'dot': '˙', 'ddot': '¨', 'tilde': '˜',
+        'overline': '¯', 'underline': '_',
+        'widehat': '^', 'widetilde': '˜',
+    }
+
+    # 大运算符
+    big_operators = {
+        'sum': '∑', 'prod': '∏', 'coprod': '∐',
+    }
+
+    # 积分符号
+    integrals = {
+        'int': '∫', 'iint': '∬', 'iiint': '∭', 'oint': '∮',
+    }
+
+    # 数学字体命令对应的 mathvariant
+    font_variants = {
+        'mathrm': 'normal',
+        'mathbf': 'bold',
+        'mathit': 'italic',
+        'mathsf': 'sans-serif',
+        'mathtt': 'monospace',
+        'mathbb': 'double-struck',
+        'mathcal': 'script',
+        'mathfrak': 'fraktur',
+    }
+
+    # 反斜杠加特殊字符表示的空白宽度
+    control_spaces = {' ': '0.3em', ',': '0.2em', ';': '0.3em', '!': '-0.1em'}
+
+    # 命令分派表：命令名 → (处理函数, 附加数据)
+    _commands = {}
+
+    # 参数可以省略花括号的命令，词法分析时只给它们切出单字符参数
+    single_argument_commands = frozenset()
+
+    # 序列化器无状态，可在线程间共享
+    _serializers = {True: MathMLSerializer(pretty=True), False: MathMLSerializer(pretty=False)}
+
+    DEFAULT_MAX_DEPTH = 1000      # 解析栈最大深度（每层分数、上下标分组约占3帧，花括号分组1帧）
+    DEFAULT_MAX_WORK = 100000     # 单个公式最多创建的解析帧数
+    DEFAULT_MAX_OUTPUT = 2000000  # 单个公式MathML输出的最大字符数
+    SCRIPT_DEPTH_FRAMES = 3       # 连续的独立脚标每嵌套一层按此帧数计入 max_depth
+
+    def __init__(self, max_depth=None, max_work=None, max_output=None):
+        """
+        Args:
+            max_depth: 解析栈最大深度，默认 DEFAULT_MAX_DEPTH
+            max_work: 工作量预算（解析帧数），默认 DEFAULT_MAX_WORK
+            max_output: MathML输出的最大字符数，默认 DEFAULT_MAX_OUTPUT
+        """
+        self.max_depth = self.DEFAULT_MAX_DEPTH if max_depth is None else max_depth
+        self.max_work = self.DEFAULT_MAX_WORK if max_work is None else max_work
+        self.max_output = self.DEFAULT_MAX_OUTPUT if max_output is None else max_output
+
+    @classmethod
+    def from_env(cls):
+        """根据环境变量创建转换器（WORD_CONVERTER_MAX_DEPTH / WORD_CONVERTER_MAX_WORK / WORD_CONVERTER_MAX_OUTPUT）"""
+        return cls(
+            max_depth=int(os.environ.get('WORD_CONVERTER_MAX_DEPTH', str(cls.DEFAULT_MAX_DEPTH))),
+            max_work=int(os.environ.get('WORD_CONVERTER_MAX_WORK', str(cls.DEFAULT_MAX_WORK))),
+            max_output=int(os.environ.get('WORD_CONVERTER_MAX_OUTPUT', str(cls.DEFAULT_MAX_OUTPUT))),
+        )
+
+    @classmethod
+    def register_command(cls, name, handler, payload=None, single_argument=False):
+        """
+        注册（或覆盖）LaTeX命令
+
+        Args:
+            name: 命令名（不含反斜杠）
+            handler: 处理函数 handler(converter, tokens, start, end, payload)，
+                start 为命令之后的词法单元下标，返回 (节点或None, 新位置)；
+                需要解析参数时写成生成器，用 yield converter._parse_argument(...) 取得参数节点
+            payload: 传给处理函数的附加数据，如命令对应的符号
+            single_argument: 参数是否可以省略花括号（如 \\hat x，只取一个字符）
+        """
+        if '_commands' not in cls.__dict__:
+            # 子类注册时复制一份分派表，不影响父类
+            cls._commands = dict(cls._commands)
+        cls._commands[name] = (handler, payload)
+        if single_argument:
+            cls.single_argument_commands = cls.single_argument_commands | {name}
+        if isinstance(payload, str):
+            register_symbols((payload,))
+
+    @classmethod
+    def register_alias(cls, name, target):
+        """将命令注册为已有命令的别名，如 \\dfrac → \\frac"""
+        handler, payload = cls._commands[target]
+        cls.register_command(name, handler, payload,
+                             single_argument=target in cls.single_argument_commands)
+
+    @classmethod
+    def _register_builtin_commands(cls):
+        """注册内置命令，按优先级从低到高注册，同名时后注册的覆盖先注册的"""
+        for name, variant in cls.font_variants.items():
+            cls.register_command(name, cls._parse_math_font, variant)
+        cls.register_command('text', cls._parse_text)
+        cls.register_command('operatorname', cls._parse_operatorname)
+        for name, accent_char in cls.accent_map.items():
+            cls.register_command(name, cls._parse_accent, accent_char, single_argument=True)
+        for name, symbol in cls.bracket_map.items():
+            cls.register_command(name, cls._parse_operator, symbol)
+        for name in cls.function_names:
+            cls.register_command(name, cls._parse_function, name)
+        for name, symbol in cls.operator_map.items():
+            cls.register_command(name, cls._parse_operator, symbol)
+        for name, symbol in cls.greek_letters.items():
+            cls.register_command(name, cls._parse_greek_with_scripts, symbol)
+        cls.register_command('left', cls._parse_delimiter)
+        cls.register_command('right', cls._parse_delimiter)
+        cls.register_command('lim', cls._parse_limit)
+        for name, symbol in cls.integrals.items():
+            cls.register_command(name, cls._parse_big_operator, symbol)
+        for name, symbol in cls.big_operators.items():
+            cls.register_command(name, cls._parse_big_operator, symbol)
+        cls.register_command('sqrt', cls._parse_sqrt, single_argument=True)
+        cls.register_command('frac', cls._parse_fraction)
+        cls.register_command('binom', cls._parse_binom)
+        cls.register_alias('dfrac', 'frac')
+        cls.register_alias('tfrac', 'frac')
+
+    def convert(self, formula, pretty=True):
+        """
+        转换LaTeX公式为MathML（Word兼容版，非ASCII字符输出为XML数字实体）
+
+        Args:
+            formula: LaTeX公式
+            pretty: True 时缩进换行输出，False 时输出紧凑的单行MathML
+        
+        Raises:
+            FormulaTooComplexError: 嵌套深度、工作量或输出长度超出限制
+        """
+        return self.serialize(self.parse(formula), pretty=pretty)
+
+    def write(self, formula, out, pretty=True):
+        """
+        转换LaTeX公式并把MathML直接写入out，不生成中间字符串
+
+        Args:
+            formula: LaTeX公式
+            out: 带write方法的输出对象（如 io.StringIO、文件、响应流）
+            pretty: True 时缩进换行输出，False 时输出紧凑的单行MathML
+        
+        Raises:
+            FormulaTooComplexError: 嵌套深度、工作量或输出长度超出限制（超出前的部分已写入out）
+        """
+        self.serialize(self.parse(formula), out, pretty)
     
-    def _parse_expression(self, expr):
-        """解析表达式，返回(MathML行列表, 新位置)"""
-        result = []
-        i = 0
-        
-        while i < len(expr):
-            # 跳过空格
-            if expr[i].isspace():
-                i += 1
+    def serialize(self, tree, out=None, pretty=True):
+        """
+        序列化 parse 得到的语法树，输出长度不超过 max_output
+        
+        Raises:
+            FormulaTooComplexError: 输出长度超出限制
+        """
+        try:
+            return self._serializers[bool(pretty)].serialize(tree, out, self.max_output)
+        except OutputTooLargeError as e:
+            raise FormulaTooComplexError(str(e)) from e
+
+    def parse(self, formula):
+        """
+        将LaTeX公式解析为语法树，返回 math_ast.Math 根节点
+
+        Raises:
+            FormulaTooComplexError: 嵌套深度或工作量超出限制
+        """
+        tokens = self.tokenize(formula.strip())
+        return Math(self._run(self._parse_expression(tokens, 0, len(tokens))))
+
+    def tokenize(self, formula):
+        """将公式切分为词法单元"""
+        return tokenize_latex(formula, self.single_argument_commands)
+
+    # 需要解析子区间的解析函数写成生成器（解析帧）：yield 子帧，由 _run 运行后把结果送回；
+    # yield 非生成器的值（如不递归的命令处理函数的返回值）时原样送回
+
+    def _run(self, frame):
+        """
+        用显式栈运行解析帧并返回其结果，不占用Python调用栈
+
+        每个词法单元只在包含它的最内层解析帧中处理一次，帧数与单元数成正比；
+        max_work 限制帧数上限，max_depth 限制栈深度
+        """
+        max_depth = self.max_depth
+        budget = self.max_work
+        stack = [frame]
+        value = None
+        while True:
+            try:
+                child = frame.send(value)
+            except StopIteration as stop:
+                stack.pop()
+                if not stack:
+                    return stop.value
+                frame = stack[-1]
+                value = stop.value
                 continue
-            
+
+            if type(child) is not GeneratorType:
+                value = child
+                continue
+            budget -= 1
+            if budget < 0:
+                raise FormulaTooComplexError(f'公式解析工作量超出预算（{self.max_work}）')
+            if len(stack) >= max_depth:
+                raise FormulaTooComplexError(f'公式嵌套过深（解析栈超过{max_depth}层）')
+            stack.append(child)
+            frame = child
+            value = None
+
+    def _parse_expression(self, tokens, start, end):
+        """解析词法单元区间[start, end)，返回节点列表"""
+        result = []
+        kinds = tokens.kinds
+        values = tokens.values
+        i = start
+        # 独立脚标附加到前一个节点时语法树加深一层但不创建解析帧（如 x^x^x^...），
+        # 这里单独计数，避免深度上限失效、带缩进的输出随层数平方增长
+        chained = None
+        chain_depth = 0
+
+        while i < end:
+            kind = kinds[i]
+            node = None
+
             # LaTeX命令
-            if expr[i] == '\\':
-                cmd_result, new_i = self._parse_command(expr, i)
-                if cmd_result:
-                    result.extend(cmd_result)
-                    i = new_i
-                    continue
+            if kind == TOKEN_COMMAND or kind == TOKEN_CONTROL:
+                node, i = yield self._parse_command(tokens, i, end)
+
+            # 花括号分组，内容直接并入当前序列
+            elif kind == TOKEN_LBRACE:
+                content_start, content_end, i = self._braced_range(tokens, i, end)
+                result.extend((yield self._parse_expression(tokens, content_start, content_end)))
+
+            # 字母变量（单字母变量更常见，不贪婪匹配多字母）
+            elif kind == TOKEN_LETTER:
+                if i + 1 < end and (kinds[i + 1] == TOKEN_SUB or kinds[i + 1] == TOKEN_SUP):
+                    node, i = yield self._parse_scripts(tokens, i + 1, end, Identifier(values[i]))
                 else:
-                    i = new_i
-                    continue
-            
-            # 花括号分组
-            elif expr[i] == '{':
-                content, new_i = self._parse_braced_content(expr, i)
-                if content:
-                    group_result, _ = self._parse_expression(content)
-                    result.extend(group_result)
-                i = new_i
-                continue
-            
+                    node = Identifier(values[i])
+                    i += 1
+
+            # 数字（包括小数）
+            elif kind == TOKEN_NUMBER:
+                node = Number(values[i])
+                i += 1
+
+            # 独立的上下标（应该附加到前一个元素，这里作为错误恢复处理）
+            elif kind == TOKEN_SUP or kind == TOKEN_SUB:
+                script_start, script_end, i = self._parse_script_content(tokens, i + 1, end)
+                if script_end > script_start and result:
+                    script = yield self._parse_argument(tokens, script_start, script_end)
+                    base = result.pop()
+                    node = self._attach_script(base, script, superscript=kind == TOKEN_SUP)
+                    if node is not base:
+                        chain_depth = chain_depth + 1 if base is chained else 1
+                        if chain_depth * self.SCRIPT_DEPTH_FRAMES >= self.max_depth:
+                            raise FormulaTooComplexError(
+                                f'上下标嵌套过深（超过{self.max_depth // self.SCRIPT_DEPTH_FRAMES}层）')
+                    chained = node
+
             # 圆括号
-            elif expr[i] == '(':
-                paren_result, new_i = self._parse_parentheses(expr, i)
-                if paren_result:
-                    result.extend(paren_result)
-                    i = new_i
-                    continue
-            
+            elif kind == TOKEN_CHAR and values[i] == '(':
+                node, i = yield self._parse_parentheses(tokens, i, end)
+
             # 方括号
-            elif expr[i] == '[':
-                bracket_result, new_i = self._parse_brackets(expr, i, '[', ']')
-                if bracket_result:
-                    result.extend(bracket_result)
-                    i = new_i
-                    continue
-            
-            # 字母变量
-            elif expr[i].isalpha():
-                var_result, new_i = self._parse_variable(expr, i)
-                result.extend(var_result)
-                i = new_i
-                continue
-            
-            # 数字（包括小数和负数）
-            elif expr[i].isdigit() or (expr[i] == '.' and i + 1 < len(expr) and expr[i + 1].isdigit()):
-                num, new_i = self._parse_number(expr, i)
-                result.append(f'  <mn>{num}</mn>')
-                i = new_i
-                continue
-            
-            # 上标
-            elif expr[i] == '^':
-                # 独立上标（应该附加到前一个元素，但这里作为错误恢复处理）
-                sup_content, new_i = self._parse_script_content(expr, i + 1)
-                if sup_content and result:
-                    # 将上标附加到前一个元素
-                    last_elem = result.pop()
-                    sup_lines, _ = self._parse_expression(sup_content)
-                    result.append('  <msup>')
-                    result.append(f'  {last_elem}')
-                    if len(sup_lines) == 1:
-                        result.append(f'  {sup_lines[0]}')
-                    else:
-                        result.append('    <mrow>')
-                        result.extend([f'    {line}' for line in sup_lines])
-                        result.append('    </mrow>')
-                    result.append('  </msup>')
-                i = new_i
-                continue
-            
-            # 下标
-            elif expr[i] == '_':
-                sub_content, new_i = self._parse_script_content(expr, i + 1)
-                if sub_content and result:
-                    last_elem = result.pop()
-                    sub_lines, _ = self._parse_expression(sub_content)
-                    result.append('  <msub>')
-                    result.append(f'  {last_elem}')
-                    if len(sub_lines) == 1:
-                        result.append(f'  {sub_lines[0]}')
-                    else:
-                        result.append('    <mrow>')
-                        result.extend([f'    {line}' for line in sub_lines])
-                        result.append('    </mrow>')
-                    result.append('  </msub>')
-                i = new_i
-                continue
-            
+            elif kind == TOKEN_CHAR and values[i] == '[':
+                node, i = yield self._parse_brackets(tokens, i, end, '[', ']')
+
             # 运算符
-            elif expr[i] in '+-=':
-                result.append(f'  <mo>{expr[i]}</mo>')
-                i += 1
-                continue
-            
-            # 其他常见运算符
-            elif expr[i] == '*':
-                result.append('  <mo>×</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == '/':
-                result.append('  <mo>/</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == '<':
-                result.append('  <mo>&lt;</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == '>':
-                result.append('  <mo>&gt;</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == '|':
-                result.append('  <mo>|</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == ',':
-                result.append('  <mo>,</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == ';':
-                result.append('  <mo>;</mo>')
+            elif kind == TOKEN_CHAR and values[i] in CHAR_OPERATORS:
+                node = Operator(CHAR_OPERATORS[values[i]])
                 i += 1
-                continue
-            
-            elif expr[i] == ':':
-                result.append('  <mo>:</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == '!':
-                result.append('  <mo>!</mo>')
-                i += 1
-                continue
-            
-            elif expr[i] == "'":
-                result.append('  <mo>′</mo>')
-                i += 1
-                continue
-            
+
             # 跳过其他字符（如右括号等已处理的）
             else:
                 i += 1
-        
-        return result, i
-    
-    def _parse_variable(self, expr, start):
-        """解析变量，处理上下标"""
+
+            if node is not None:
+                result.append(node)
+
+        return result
+
+    def _parse_argument(self, tokens, start, end):
+        """解析参数区间；多个（或零个）节点时用<mrow>包装"""
+        # 单个字母或数字（如 x^2）直接生成节点，不创建解析帧
+        if end == start + 1:
+            kind = tokens.kinds[start]
+            if kind == TOKEN_LETTER:
+                return Identifier(tokens.values[start])
+            if kind == TOKEN_NUMBER:
+                return Number(tokens.values[start])
+        return self._parse_row(tokens, start, end)
+
+    def _parse_row(self, tokens, start, end):
+        """解析参数区间的解析帧"""
+        nodes = yield self._parse_expression(tokens, start, end)
+        return nodes[0] if len(nodes) == 1 else Row(nodes)
+
+    def _braced_range(self, tokens, start, end):
+        """花括号分组的内容区间，返回(内容起点, 内容终点, 新位置)；未闭合时延伸到end"""
+        close = tokens.match[start]
+        if close < 0 or close >= end:
+            return start + 1, end, end
+        return start + 1, close, close + 1
+
+    def _parse_script_content(self, tokens, start, end):
+        """上标或下标内容的区间，返回(内容起点, 内容终点, 新位置)"""
+        if start >= end:
+            return start, start, start
+
+        if tokens.kinds[start] == TOKEN_LBRACE:
+            return self._braced_range(tokens, start, end)
+        else:
+            # 单个词法单元
+            return start, start + 1, start + 1
+
+    def _parse_scripts(self, tokens, start, end, base):
+        """解析base后面可选的下标和上标（先下后上），返回(节点, 新位置)"""
+        kinds = tokens.kinds
         i = start
-        var = expr[i]
-        i += 1
-        
-        # 不再贪婪匹配多字母（单字母变量更常见）
-        # 检查是否有上下标
-        has_sub = False
-        has_sup = False
-        subscript = ''
-        superscript = ''
-        
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
+        sub = sup = None
+
         # 检查下标
-        if i < len(expr) and expr[i] == '_':
-            has_sub = True
-            subscript, i = self._parse_script_content(expr, i + 1)
-            # 跳过空格
-            while i < len(expr) and expr[i].isspace():
-                i += 1
-        
+        if i < end and kinds[i] == TOKEN_SUB:
+            sub_start, sub_end, i = self._parse_script_content(tokens, i + 1, end)
+            sub = yield self._parse_argument(tokens, sub_start, sub_end)
+
         # 检查上标
-        if i < len(expr) and expr[i] == '^':
-            has_sup = True
-            superscript, i = self._parse_script_content(expr, i + 1)
-        
-        # 生成MathML
-        if has_sub and has_sup:
-            # 同时有上下标
-            sub_lines, _ = self._parse_expression(subscript)
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msubsup>', f'    <mi>{var}</mi>']
-            if len(sub_lines) == 1:
-                result.append(f'  {sub_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sub_lines])
-                result.append('    </mrow>')
-            if len(sup_lines) == 1:
-                result.append(f'  {sup_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msubsup>')
-            return result, i
-        elif has_sub:
-            sub_lines, _ = self._parse_expression(subscript)
-            result = ['  <msub>', f'    <mi>{var}</mi>']
-            if len(sub_lines) == 1:
-                result.append(f'  {sub_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sub_lines])
-                result.append('    </mrow>')
-            result.append('  </msub>')
-            return result, i
-        elif has_sup:
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msup>', f'    <mi>{var}</mi>']
-            if len(sup_lines) == 1:
-                result.append(f'  {sup_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msup>')
-            return result, i
-        else:
-            return [f'  <mi>{var}</mi>'], i
-    
-    def _parse_number(self, expr, start):
-        """解析数字（包括小数）"""
-        i = start
-        num = ''
-        has_dot = False
-        
-        while i < len(expr):
-            if expr[i].isdigit():
-                num += expr[i]
-                i += 1
-            elif expr[i] == '.' and not has_dot:
-                has_dot = True
-                num += expr[i]
-                i += 1
-            else:
-                break
-        
-        return num, i
-    
-    def _parse_script_content(self, expr, start):
-        """解析上标或下标内容"""
-        i = start
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        if i >= len(expr):
-            return '', i
-        
-        if expr[i] == '{':
-            content, new_i = self._parse_braced_content(expr, i)
-            return content, new_i
-        else:
-            # 单字符
-            return expr[i], i + 1
-    
-    def _parse_command(self, expr, start):
-        """解析LaTeX命令，返回(MathML行列表, 新位置)"""
+        if i < end and kinds[i] == TOKEN_SUP:
+            sup_start, sup_end, i = self._parse_script_content(tokens, i + 1, end)
+            sup = yield self._parse_argument(tokens, sup_start, sup_end)
+
+        if sub is None and sup is None:
+            return base, i
+        return Scripts(base, sub, sup), i
+
+    def _attach_script(self, base, script, superscript):
+        """把独立的上标或下标附加到前一个节点，已有另一侧脚标时合并为<msubsup>"""
+        if isinstance(base, Scripts):
+            if superscript and base.sup is None:
+                base.sup = script
+                return base
+            if not superscript and base.sub is None:
+                base.sub = script
+                return base
+        if superscript:
+            return Scripts(base, sup=script)
+        return Scripts(base, sub=script)
+
+    def _parse_command(self, tokens, start, end):
+        """解析LaTeX命令，返回(节点或None, 新位置)"""
+        cmd = tokens.values[start]
         i = start + 1
-        cmd = ''
-        
-        # 读取命令名
-        while i < len(expr) and (expr[i].isalpha() or expr[i].isdigit()):
-            cmd += expr[i]
-            i += 1
-        
+
         # 特殊处理：反斜杠后直接跟特殊字符
-        if not cmd and i < len(expr):
-            special_char = expr[i]
-            i += 1
-            if special_char in '{}':
-                return [f'  <mo>{special_char}</mo>'], i
-            elif special_char == ' ':
-                return ['  <mspace width="0.3em"/>'], i
-            elif special_char == ',':
-                return ['  <mspace width="0.2em"/>'], i
-            elif special_char == ';':
-                return ['  <mspace width="0.3em"/>'], i
-            elif special_char == '!':
-                return ['  <mspace width="-0.1em"/>'], i
-            elif special_char == '\\':
-                return ['  <mspace linebreak="newline"/>'], i
-            else:
-                return [f'  <mo>{special_char}</mo>'], i
-        
-        # 分数
-        if cmd == 'frac':
-            return self._parse_fraction(expr, i)
-        
-        # 根号
-        elif cmd == 'sqrt':
-            return self._parse_sqrt(expr, i)
-        
-        # 求和、积分等大运算符
-        elif cmd in ('sum', 'prod', 'coprod'):
-            return self._parse_big_operator(expr, i, cmd)
-        
-        elif cmd in ('int', 'iint', 'iiint', 'oint'):
-            return self._parse_integral(expr, i, cmd)
-        
-        elif cmd == 'lim':
-            return self._parse_limit(expr, i)
-        
-        # left/right命令 - 跳过命令和后面的分隔符
-        elif cmd == 'left' or cmd == 'right':
-            # 跳过空格
-            while i < len(expr) and expr[i].isspace():
-                i += 1
-            # 跳过分隔符字符
-            if i < len(expr):
-                if expr[i] == '\\':
-                    # 处理 \left\{ 等情况
-                    j = i + 1
-                    bracket_cmd = ''
-                    while j < len(expr) and expr[j].isalpha():
-                        bracket_cmd += expr[j]
-                        j += 1
-                    if bracket_cmd in self.bracket_map:
-                        i = j
-                elif expr[i] in '()[]{}|.':
-                    i += 1
-            return [], i
-        
-        # 希腊字母
-        elif cmd in self.greek_letters:
-            return self._parse_greek_with_scripts(expr, i, self.greek_letters[cmd])
-        
-        # 运算符
-        elif cmd in self.operator_map:
-            return [f'  <mo>{self.operator_map[cmd]}</mo>'], i
-        
-        # 函数名
-        elif cmd in self.function_names:
-            return self._parse_function(expr, i, cmd)
-        
-        # 括号
-        elif cmd in self.bracket_map:
-            return [f'  <mo>{self.bracket_map[cmd]}</mo>'], i
-        
-        # 重音/修饰符
-        elif cmd in self.accent_map:
-            return self._parse_accent(expr, i, cmd)
-        
-        # text命令
-        elif cmd == 'text':
-            return self._parse_text(expr, i)
-        
-        elif cmd in ('mathrm', 'mathbf', 'mathit', 'mathsf', 'mathtt', 'mathbb', 'mathcal', 'mathfrak'):
-            return self._parse_math_font(expr, i, cmd)
-        
-        # 其他命令当作普通文本
-        else:
-            return [f'  <mi>{cmd}</mi>'], i
-    
-    def _parse_greek_with_scripts(self, expr, start, symbol):
-        """解析带上下标的希腊字母"""
-        i = start
-        has_sub = False
-        has_sup = False
-        subscript = ''
-        superscript = ''
-        
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        # 检查下标
-        if i < len(expr) and expr[i] == '_':
-            has_sub = True
-            subscript, i = self._parse_script_content(expr, i + 1)
-            while i < len(expr) and expr[i].isspace():
-                i += 1
-        
-        # 检查上标
-        if i < len(expr) and expr[i] == '^':
-            has_sup = True
-            superscript, i = self._parse_script_content(expr, i + 1)
-        
-        if has_sub and has_sup:
-            sub_lines, _ = self._parse_expression(subscript)
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msubsup>', f'    <mi>{symbol}</mi>']
-            if len(sub_lines) == 1:
-                result.append(f'  {sub_lines[0]}')
+        if tokens.kinds[start] == TOKEN_CONTROL:
+            if cmd in self.control_spaces:
+                return Space(width=self.control_spaces[cmd]), i
+            elif cmd == '\\':
+                return Space(linebreak='newline'), i
             else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sub_lines])
-                result.append('    </mrow>')
-            if len(sup_lines) == 1:
-                result.append(f'  {sup_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msubsup>')
-            return result, i
-        elif has_sub:
-            sub_lines, _ = self._parse_expression(subscript)
-            result = ['  <msub>', f'    <mi>{symbol}</mi>']
-            if len(sub_lines) == 1:
-                result.append(f'  {sub_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sub_lines])
-                result.append('    </mrow>')
-            result.append('  </msub>')
-            return result, i
-        elif has_sup:
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msup>', f'    <mi>{symbol}</mi>']
-            if len(sup_lines) == 1:
-                result.append(f'  {sup_lines[0]}')
-            else:
-                result.append('    <mrow>')
-                result.extend([f'    {line}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msup>')
-            return result, i
-        else:
-            return [f'  <mi>{symbol}</mi>'], i
-    
-    def _parse_fraction(self, expr, start):
-        """解析分数，返回(MathML行列表, 新位置)"""
-        # 跳过前导空格
+                return Operator(cmd), i
+
+        entry = self._commands.get(cmd)
+        if entry is None:
+            # 其他命令当作普通文本
+            return Identifier(cmd), i
+        handler, payload = entry
+        return handler(self, tokens, i, end, payload)
+
+    def _two_argument_ranges(self, tokens, start, end):
+        """两个花括号参数的内容区间，返回(参数1起点, 参数1终点, 参数2起点, 参数2终点, 新位置)；缺少参数时返回None"""
+        kinds = tokens.kinds
         i = start
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        # 解析分子
-        if i < len(expr) and expr[i] == '{':
-            numerator, i = self._parse_braced_content(expr, i)
-        else:
-            return [], start
-        
-        # 跳过中间的空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        # 解析分母
-        if i < len(expr) and expr[i] == '{':
-            denominator, i = self._parse_braced_content(expr, i)
-        else:
-            return [], start
-        
-        # 生成分子MathML
-        num_lines, _ = self._parse_expression(numerator)
-        
-        # 生成分母MathML
-        den_lines, _ = self._parse_expression(denominator)
-        
-        result = ['  <mfrac>']
-
-        # 分子 - 只在不是单个元素时用<mrow>包装
-        if not self._is_single_element(num_lines):
-            result.append('    <mrow>')
-            for line in num_lines:
-                result.append(f'      {line.strip()}')
-            result.append('    </mrow>')
+
+        if i < end and kinds[i] == TOKEN_LBRACE:
+            first_start, first_end, i = self._braced_range(tokens, i, end)
         else:
-            for line in num_lines:
-                result.append(f'    {line.strip()}')
-
-        # 分母 - 只在不是单个元素时用<mrow>包装
-        if not self._is_single_element(den_lines):
-            result.append('    <mrow>')
-            for line in den_lines:
-                result.append(f'      {line.strip()}')
-            result.append('    </mrow>')
+            return None
+
+        if i < end and kinds[i] == TOKEN_LBRACE:
+            second_start, second_end, i = self._braced_range(tokens, i, end)
         else:
-            for line in den_lines:
-                result.append(f'    {line.strip()}')
+            return None
 
-        result.append('  </mfrac>')
-        
-        return result, i
-    
-    def _parse_sqrt(self, expr, start):
-        """解析根号 \sqrt 或 \sqrt[n]"""
+        return first_start, first_end, second_start, second_end, i
+
+    def _parse_fraction(self, tokens, start, end, payload=None):
+        """解析分数，返回(节点, 新位置)"""
+        ranges = self._two_argument_ranges(tokens, start, end)
+        if ranges is None:
+            return None, start
+        first_start, first_end, second_start, second_end, i = ranges
+
+        # 只在不是单个元素时用<mrow>包装
+        numerator = yield self._parse_argument(tokens, first_start, first_end)
+        denominator = yield self._parse_argument(tokens, second_start, second_end)
+        return Fraction(numerator, denominator), i
+
+    def _parse_binom(self, tokens, start, end, payload=None):
+        """解析二项式系数 \\binom{n}{k}：括号内无分数线的分数"""
+        ranges = self._two_argument_ranges(tokens, start, end)
+        if ranges is None:
+            return None, start
+        first_start, first_end, second_start, second_end, i = ranges
+
+        upper = yield self._parse_argument(tokens, first_start, first_end)
+        lower = yield self._parse_argument(tokens, second_start, second_end)
+        return Row([Operator('('), Fraction(upper, lower, linethickness='0'), Operator(')')]), i
+
+    def _parse_sqrt(self, tokens, start, end, payload=None):
+        """解析根号 \\sqrt 或 \\sqrt[n]"""
+        kinds = tokens.kinds
         i = start
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
+
         # 检查是否有指数 [n]
-        index = None
-        if i < len(expr) and expr[i] == '[':
-            # 找到匹配的 ]
-            j = i + 1
-            depth = 1
-            while j < len(expr) and depth > 0:
-                if expr[j] == '[':
-                    depth += 1
-                elif expr[j] == ']':
-                    depth -= 1
-                j += 1
-            index = expr[i + 1:j - 1]
-            i = j
-            # 跳过空格
-            while i < len(expr) and expr[i].isspace():
-                i += 1
-        
+        has_index = False
+        if i < end and kinds[i] == TOKEN_CHAR and tokens.values[i] == '[':
+            close = tokens.match[i]
+            if close < 0 or close >= end:
+                return None, start
+            index_start, index_end = i + 1, close
+            # 与原始文本一致：方括号之间有任何字符即视为带指数
+            has_index = tokens.starts[close] > tokens.ends[i]
+            i = close + 1
+
         # 解析根号内容
-        if i < len(expr) and expr[i] == '{':
-            content, i = self._parse_braced_content(expr, i)
-        elif i < len(expr):
-            # 单字符
-            content = expr[i]
+        if i < end and kinds[i] == TOKEN_LBRACE:
+            content_start, content_end, i = self._braced_range(tokens, i, end)
+        elif i < end:
+            # 单个词法单元
+            content_start, content_end = i, i + 1
             i += 1
         else:
-            return [], start
-        
-        content_lines, _ = self._parse_expression(content)
-        
-        if index:
+            return None, start
+
+        body = yield self._parse_argument(tokens, content_start, content_end)
+        if has_index:
             # n次根号
-            index_lines, _ = self._parse_expression(index)
-            result = ['  <mroot>']
-            if self._is_single_element(content_lines):
-                result.extend([f'    {line.strip()}' for line in content_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in content_lines])
-                result.append('    </mrow>')
-            if self._is_single_element(index_lines):
-                result.extend([f'    {line.strip()}' for line in index_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in index_lines])
-                result.append('    </mrow>')
-            result.append('  </mroot>')
-        else:
-            # 平方根
-            result = ['  <msqrt>']
-            if self._is_single_element(content_lines):
-                result.extend([f'    {line.strip()}' for line in content_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in content_lines])
-                result.append('    </mrow>')
-            result.append('  </msqrt>')
-        
-        return result, i
-    
-    def _parse_big_operator(self, expr, start, cmd):
-        """解析大运算符（sum, prod等）- 使用 msubsup 格式以提高 Word 兼容性"""
-        op_map = {
-            'sum': '∑', 'prod': '∏', 'coprod': '∐',
-        }
-        symbol = op_map.get(cmd, cmd)
-        
+            return Root(body, (yield self._parse_argument(tokens, index_start, index_end))), i
+        # 平方根
+        return Sqrt(body), i
+
+    def _parse_greek_with_scripts(self, tokens, start, end, symbol):
+        """解析带上下标的希腊字母"""
+        return self._parse_scripts(tokens, start, end, Identifier(symbol))
+
+    def _parse_big_operator(self, tokens, start, end, symbol):
+        """解析求和、积分等大运算符 - 使用 msubsup 替代 munderover 以提高 Word 兼容性"""
+        return self._parse_scripts(tokens, start, end, Operator(symbol))
+
+    def _parse_limit(self, tokens, start, end, payload=None):
+        """解析极限"""
         i = start
-        has_sub = False
-        has_sup = False
-        subscript = ''
-        superscript = ''
-        
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
+
         # 检查下标
-        if i < len(expr) and expr[i] == '_':
-            has_sub = True
-            subscript, i = self._parse_script_content(expr, i + 1)
-            while i < len(expr) and expr[i].isspace():
-                i += 1
-        
-        # 检查上标
-        if i < len(expr) and expr[i] == '^':
-            has_sup = True
-            superscript, i = self._parse_script_content(expr, i + 1)
-        
-        # 使用 msubsup 替代 munderover 以提高 Word 兼容性
-        if has_sub and has_sup:
-            sub_lines, _ = self._parse_expression(subscript)
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msubsup>', f'    <mo>&#x{ord(symbol):04X};</mo>']
-            if self._is_single_element(sub_lines):
-                result.extend([f'    {line.strip()}' for line in sub_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sub_lines])
-                result.append('    </mrow>')
-            if self._is_single_element(sup_lines):
-                result.extend([f'    {line.strip()}' for line in sup_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msubsup>')
-            return result, i
-        elif has_sub:
-            sub_lines, _ = self._parse_expression(subscript)
-            result = ['  <msub>', f'    <mo>&#x{ord(symbol):04X};</mo>']
-            if self._is_single_element(sub_lines):
-                result.extend([f'    {line.strip()}' for line in sub_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sub_lines])
-                result.append('    </mrow>')
-            result.append('  </msub>')
-            return result, i
-        elif has_sup:
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msup>', f'    <mo>&#x{ord(symbol):04X};</mo>']
-            if self._is_single_element(sup_lines):
-                result.extend([f'    {line.strip()}' for line in sup_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msup>')
-            return result, i
+        if i < end and tokens.kinds[i] == TOKEN_SUB:
+            sub_start, sub_end, i = self._parse_script_content(tokens, i + 1, end)
+            return Under(Operator('lim'), (yield self._parse_argument(tokens, sub_start, sub_end))), i
         else:
-            return [f'  <mo>&#x{ord(symbol):04X};</mo>'], i
-    
-    def _parse_integral(self, expr, start, cmd):
-        """解析积分符号 - 使用 XML 实体编码以提高 Word 兼容性"""
-        int_map = {
-            'int': 0x222B, 'iint': 0x222C, 'iiint': 0x222D, 'oint': 0x222E,
-        }
-        symbol_code = int_map.get(cmd, 0x222B)
-        
+            return Operator('lim'), i
+
+    def _parse_delimiter(self, tokens, start, end, payload=None):
+        """\\left / \\right - 跳过命令和后面的分隔符"""
         i = start
-        has_sub = False
-        has_sup = False
-        subscript = ''
-        superscript = ''
-        
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        # 检查下标
-        if i < len(expr) and expr[i] == '_':
-            has_sub = True
-            subscript, i = self._parse_script_content(expr, i + 1)
-            while i < len(expr) and expr[i].isspace():
+        if i < end:
+            kind = tokens.kinds[i]
+            value = tokens.values[i]
+            if kind == TOKEN_COMMAND:
+                # 处理 \left\langle 等情况
+                if value in self.bracket_map:
+                    i += 1
+            elif kind == TOKEN_LBRACE or kind == TOKEN_RBRACE:
                 i += 1
-        
-        # 检查上标
-        if i < len(expr) and expr[i] == '^':
-            has_sup = True
-            superscript, i = self._parse_script_content(expr, i + 1)
-        
-        if has_sub and has_sup:
-            sub_lines, _ = self._parse_expression(subscript)
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msubsup>', f'    <mo>&#x{symbol_code:04X};</mo>']
-            if self._is_single_element(sub_lines):
-                result.extend([f'    {line.strip()}' for line in sub_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sub_lines])
-                result.append('    </mrow>')
-            if self._is_single_element(sup_lines):
-                result.extend([f'    {line.strip()}' for line in sup_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msubsup>')
-            return result, i
-        elif has_sub:
-            sub_lines, _ = self._parse_expression(subscript)
-            result = ['  <msub>', f'    <mo>&#x{symbol_code:04X};</mo>']
-            if self._is_single_element(sub_lines):
-                result.extend([f'    {line.strip()}' for line in sub_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sub_lines])
-                result.append('    </mrow>')
-            result.append('  </msub>')
-            return result, i
-        elif has_sup:
-            sup_lines, _ = self._parse_expression(superscript)
-            result = ['  <msup>', f'    <mo>&#x{symbol_code:04X};</mo>']
-            if self._is_single_element(sup_lines):
-                result.extend([f'    {line.strip()}' for line in sup_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sup_lines])
-                result.append('    </mrow>')
-            result.append('  </msup>')
-            return result, i
-        else:
-            return [f'  <mo>&#x{symbol_code:04X};</mo>'], i
-    
-    def _parse_limit(self, expr, start):
-        """解析极限"""
-        i = start
-        has_sub = False
-        subscript = ''
-        
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        # 检查下标
-        if i < len(expr) and expr[i] == '_':
-            has_sub = True
-            subscript, i = self._parse_script_content(expr, i + 1)
-        
-        if has_sub:
-            sub_lines, _ = self._parse_expression(subscript)
-            result = ['  <munder>', '    <mo>lim</mo>']
-            if self._is_single_element(sub_lines):
-                result.extend([f'    {line.strip()}' for line in sub_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in sub_lines])
-                result.append('    </mrow>')
-            result.append('  </munder>')
-            return result, i
-        else:
-            return ['  <mo>lim</mo>'], i
-    
-    def _parse_function(self, expr, start, func_name):
+            elif kind == TOKEN_CHAR and value in '()[]|.':
+                i += 1
+        return None, i
+
+    def _parse_operator(self, tokens, start, end, symbol):
+        """运算符和括号命令"""
+        return Operator(symbol), start
+
+    def _parse_function(self, tokens, start, end, func_name):
         """解析函数名"""
+        # 函数名使用 <mi> 标签，mathvariant="normal"
+        return Identifier(func_name, variant='normal'), start
+
+    def _parse_operatorname(self, tokens, start, end, payload=None):
+        """解析 \\operatorname{...}（带*的形式同样处理），按函数名输出"""
         i = start
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
+        if i < end and tokens.kinds[i] == TOKEN_CHAR and tokens.values[i] == '*':
             i += 1
-        
-        # 函数名使用 <mi> 标签，mathvariant="normal"
-        return [f'  <mi mathvariant="normal">{func_name}</mi>'], i
-    
-    def _parse_accent(self, expr, start, accent_name):
+        if i < end and tokens.kinds[i] == TOKEN_LBRACE:
+            _, content_end, next_i = self._braced_range(tokens, i, end)
+            return Identifier(tokens.source_text(i, content_end), variant='normal'), next_i
+        else:
+            return None, start
+
+    def _parse_accent(self, tokens, start, end, accent_char):
         """解析重音符号"""
         i = start
-        # 跳过空格
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
+
         # 解析被修饰的内容
-        if i < len(expr) and expr[i] == '{':
-            content, i = self._parse_braced_content(expr, i)
-        elif i < len(expr):
-            content = expr[i]
+        if i < end and tokens.kinds[i] == TOKEN_LBRACE:
+            content_start, content_end, i = self._braced_range(tokens, i, end)
+        elif i < end:
+            content_start, content_end = i, i + 1
             i += 1
         else:
-            return [], start
-        
-        content_lines, _ = self._parse_expression(content)
-        accent_char = self.accent_map.get(accent_name, '^')
-        
-        result = ['  <mover>']
-        if self._is_single_element(content_lines):
-            result.extend([f'    {line.strip()}' for line in content_lines])
-        else:
-            result.append('    <mrow>')
-            result.extend([f'      {line.strip()}' for line in content_lines])
-            result.append('    </mrow>')
-        result.append(f'    <mo>{accent_char}</mo>')
-        result.append('  </mover>')
-        
-        return result, i
-    
-    def _parse_text(self, expr, start):
-        """解析 \text{...}"""
-        i = start
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        if i < len(expr) and expr[i] == '{':
-            content, i = self._parse_braced_content(expr, i)
-            return [f'  <mtext>{content}</mtext>'], i
+            return None, start
+
+        body = yield self._parse_argument(tokens, content_start, content_end)
+        return Over(body, Operator(accent_char)), i
+
+    def _parse_text(self, tokens, start, end, payload=None):
+        """解析 \\text{...}"""
+        if start < end and tokens.kinds[start] == TOKEN_LBRACE:
+            _, content_end, i = self._braced_range(tokens, start, end)
+            return Text(tokens.source_text(start, content_end)), i
         else:
-            return [], start
-    
-    def _parse_math_font(self, expr, start, font_cmd):
+            return None, start
+
+    def _parse_math_font(self, tokens, start, end, variant):
         """解析数学字体命令"""
-        font_map = {
-            'mathrm': 'normal',
-            'mathbf': 'bold',
-            'mathit': 'italic',
-            'mathsf': 'sans-serif',
-            'mathtt': 'monospace',
-            'mathbb': 'double-struck',
-            'mathcal': 'script',
-            'mathfrak': 'fraktur',
-        }
-        variant = font_map.get(font_cmd, 'normal')
-        
-        i = start
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        if i < len(expr) and expr[i] == '{':
-            content, i = self._parse_braced_content(expr, i)
-            return [f'  <mi mathvariant="{variant}">{content}</mi>'], i
+        if start < end and tokens.kinds[start] == TOKEN_LBRACE:
+            _, content_end, i = self._braced_range(tokens, start, end)
+            return Identifier(tokens.source_text(start, content_end), variant=variant), i
         else:
-            return [], start
-    
-    def _parse_parentheses(self, expr, start):
-        """解析圆括号及其内容"""
-        if start >= len(expr) or expr[start] != '(':
-            return [], start
-        
-        # 找到匹配的右括号
-        content, end_pos = self._find_matching_paren(expr, start, '(', ')')
-        if content is None:
-            return ['  <mo>(</mo>'], start + 1
-        
+            return None, start
+
+    def _parse_parentheses(self, tokens, start, end):
+        """解析圆括号及其内容 - 使用 mrow + mo 替代 mfenced"""
+        # 匹配的右括号在词法分析时已求出
+        close = tokens.match[start]
+        if close < 0 or close >= end:
+            return Operator('('), start + 1
+
+        content = yield self._parse_expression(tokens, start + 1, close)
+        fenced = Row([Operator('('), *content, Operator(')')])
+
         # 检查是否有上标
-        i = end_pos
-        has_superscript = False
-        superscript = ''
-        
-        while i < len(expr) and expr[i].isspace():
-            i += 1
-        
-        if i < len(expr) and expr[i] == '^':
-            has_superscript = True
-            superscript, i = self._parse_script_content(expr, i + 1)
-        
-        # 解析括号内容
-        content_lines, _ = self._parse_expression(content)
-        
-        if has_superscript and superscript:
-            # 有上标的括号 - 使用 mrow + mo 替代 mfenced
-            superscript_lines, _ = self._parse_expression(superscript)
-
-            result = [
-                '  <msup>',
-                '    <mrow>',
-                '      <mo>(</mo>'
-            ]
-            result.extend([f'      {line.strip()}' for line in content_lines])
-            result.append('      <mo>)</mo>')
-            result.append('    </mrow>')
-
-            # 添加实际的上标内容
-            if self._is_single_element(superscript_lines):
-                result.extend([f'    {line.strip()}' for line in superscript_lines])
-            else:
-                result.append('    <mrow>')
-                result.extend([f'      {line.strip()}' for line in superscript_lines])
-                result.append('    </mrow>')
-            result.append('  </msup>')
-        else:
-            # 普通括号 - 使用 mrow + mo 替代 mfenced
-            result = [
-                '  <mrow>',
-                '    <mo>(</mo>'
-            ]
-            result.extend([f'    {line.strip()}' for line in content_lines])
-            result.extend([
-                '    <mo>)</mo>',
-                '  </mrow>'
-            ])
-        
-        return result, i
-    
-    def _parse_brackets(self, expr, start, open_char, close_char):
+        i = close + 1
+        if i < end and tokens.kinds[i] == TOKEN_SUP:
+            sup_start, sup_end, i = self._parse_script_content(tokens, i + 1, end)
+            if sup_end > sup_start:
+                return Scripts(fenced, sup=(yield self._parse_argument(tokens, sup_start, sup_end))), i
+
+        return fenced, i
+
+    def _parse_brackets(self, tokens, start, end, open_char, close_char):
         """解析方括号等 - 使用 mrow + mo 替代 mfenced"""
-        if start >= len(expr) or expr[start] != open_char:
-            return [], start
-        
-        content, end_pos = self._find_matching_paren(expr, start, open_char, close_char)
-        if content is None:
-            return [f'  <mo>{open_char}</mo>'], start + 1
-        
-        content_lines, _ = self._parse_expression(content)
-        
-        result = [
-            '  <mrow>',
-            f'    <mo>{open_char}</mo>'
-        ]
-        result.extend([f'    {line.strip()}' for line in content_lines])
-        result.extend([
-            f'    <mo>{close_char}</mo>',
-            '  </mrow>'
-        ])
-        
-        return result, end_pos
-    
-    def _find_matching_paren(self, expr, start, open_char, close_char):
-        """找到匹配的括号，返回(内容, 新位置)"""
-        if start >= len(expr) or expr[start] != open_char:
-            return None, start
-        
-        depth = 0
-        content = ''
-        i = start + 1
-        
-        while i < len(expr):
-            if expr[i] == open_char:
-                depth += 1
-                content += expr[i]
-            elif expr[i] == close_char:
-                if depth == 0:
-                    return content, i + 1
-                depth -= 1
-                content += expr[i]
-            elif expr[i] == '{':
-                # 跳过花括号内容，避免干扰圆括号匹配
-                brace_content, new_i = self._parse_braced_content(expr, i)
-                content += '{' + brace_content + '}'
-                i = new_i - 1  # -1 因为循环会+1
-            else:
-                content += expr[i]
-            i += 1
-        
-        return None, start
-    
-    def _parse_braced_content(self, expr, start):
-        """解析花括号内容，返回(内容, 新位置)"""
-        # 跳过前导空格
-        while start < len(expr) and expr[start].isspace():
-            start += 1
-        
-        if start >= len(expr) or expr[start] != '{':
-            return '', start
-        
-        brace_count = 1
-        content = ''
-        i = start + 1
-        
-        while i < len(expr) and brace_count > 0:
-            if expr[i] == '{':
-                brace_count += 1
-                content += expr[i]
-            elif expr[i] == '}':
-                brace_count -= 1
-                if brace_count > 0:
-                    content += expr[i]
-            else:
-                content += expr[i]
-            i += 1
-        
-        if brace_count == 0:
-            return content.strip(), i
-        else:
-            return content.strip(), i
-
-    def _is_single_element(self, lines):
-        """检查MathML行列表是否表示单个元素"""
-        if not lines:
-            return False
-        if len(lines) == 1:
-            # 单行，必定是单个元素
-            return True
-
-        # 多行时，通过标签深度追踪来确定是否只有一个顶层元素
-        depth = 0
-        first_tag_closed = False
-
-        for line in lines:
-            stripped = line.strip()
-            if not stripped:
-                continue
+        close = tokens.match[start]
+        if close < 0 or close >= end:
+            return Operator(open_char), start + 1
+
+        content = yield self._parse_expression(tokens, start + 1, close)
+        return Row([Operator(open_char), *content, Operator(close_char)]), close + 1
 
-            # 处理自闭合标签或注释
-            if stripped.startswith('<!--') or '/>' in stripped:
-                if depth == 0 and first_tag_closed:
-                    return False  # 第一个元素后还有元素
-                continue
 
-            # 处理同一行包含完整标签的情况 (如 <mi>x</mi>)
-            if '<' in stripped and '>' in stripped and '</' in stripped:
-                # 提取开始标签名
-                start_idx = stripped.find('<')
-                end_idx = stripped.find('>', start_idx)
-                if end_idx > start_idx:
-                    tag_part = stripped[start_idx+1:end_idx]
-                    tag_name = tag_part.split()[0] if tag_part else ''
-
-                    # 检查是否有对应的结束标签在同一行
-                    close_tag = f'</{tag_name}>'
-                    if close_tag in stripped:
-                        # 这是一个自包含的标签，depth不变
-                        if depth == 0:
-                            if first_tag_closed:
-                                return False  # 多个顶层元素
-                            first_tag_closed = True
-                        continue
-
-            # 结束标签
-            if stripped.startswith('</'):
-                depth -= 1
-                if depth == 0:
-                    first_tag_closed = True
-                elif depth < 0:
-                    # 深度为负，说明结构有问题
-                    return False
-            # 开始标签
-            elif stripped.startswith('<'):
-                if first_tag_closed:
-                    # 第一个顶层元素已经关闭，但又遇到新的开始标签
-                    # 说明有多个顶层元素
-                    return False
-                depth += 1
-
-        # 只有一个顶层元素当且仅当第一个标签被正确关闭，且没有其他顶层元素
-        return first_tag_closed and depth == 0
+WordMathMLConverter._register_builtin_commands()
 
 
 # 测试
@@ -0,0 +1,201 @@
+"""
+异步任务队列
+将耗时的识别任务放入有界队列，由固定大小的工作线程池消费，
+客户端通过任务ID轮询或订阅状态变化获取结果
+"""
+
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """任务队列已满"""
+
+
+class Job:
+    """单个异步任务"""
+
+    def __init__(self, func: Callable, args: tuple):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0  # 每次状态变化递增，供订阅方判断是否有更新
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def to_dict(self) -> dict:
+        """任务状态的可序列化表示"""
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'created_at': self.created_at,
+        }
+        if self.started_at is not None:
+            data['wait_time'] = round(self.started_at - self.created_at, 4)
+        if self.finished_at is not None:
+            data['run_time'] = round(self.finished_at - self.started_at, 4)
+        if self.status == 'done':
+            data['result'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+class JobQueue:
+    """有界任务队列 + 固定大小的工作线程池"""
+
+    def __init__(self, workers: int = 2, max_queue: int = 64, result_ttl: float = 600):
+        """
+        初始化任务队列
+
+        Args:
+            workers: 工作线程数
+            max_queue: 队列中等待的最大任务数，超出时拒绝提交
+            result_ttl: 已完成任务结果的保留秒数
+        """
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._wait_times = deque(maxlen=200)
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._threads = []
+
+    @classmethod
+    def from_env(cls) -> 'JobQueue':
+        """根据环境变量创建任务队列（JOB_WORKERS / JOB_QUEUE_SIZE / JOB_RESULT_TTL）"""
+        return cls(
+            workers=int(os.environ.get('JOB_WORKERS', '2')),
+            max_queue=int(os.environ.get('JOB_QUEUE_SIZE', '64')),
+            result_ttl=float(os.environ.get('JOB_RESULT_TTL', '600')),
+        )
+
+    def submit(self, func: Callable, *args) -> Job:
+        """
+        提交任务
+
+        Raises:
+            QueueFullError: 队列已满
+        """
+        self._ensure_workers()
+        self._purge_expired()
+
+        job = Job(func, args)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+                self.rejected += 1
+            raise QueueFullError('任务队列已满，请稍后再试')
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """按ID查询任务"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait_for_change(self, job: Job, version: int, timeout: float) -> bool:
+        """等待任务状态版本超过version，超时返回False"""
+        with self._changed:
+            return self._changed.wait_for(lambda: job.version > version, timeout)
+
+    def stats(self) -> dict:
+        """队列深度与等待时间统计"""
+        now = time.time()
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job.status == 'queued']
+            wait_times = list(self._wait_times)
+            return {
+                'workers': self.workers,
+                'queue_depth': len(queued),
+                'max_queue': self.max_queue,
+                'running': self._running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'oldest_queued_age': round(max((now - job.created_at for job in queued), default=0.0), 4),
+                'avg_wait_time': round(sum(wait_times) / len(wait_times), 4) if wait_times else 0.0,
+                'max_wait_time': round(max(wait_times), 4) if wait_times else 0.0,
+            }
+
+    def _ensure_workers(self):
+        """首次提交时启动工作线程"""
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _set_status(self, job: Job, status: str, **fields):
+        with self._changed:
+            job.status = status
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.version += 1
+            self._changed.notify_all()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            started_at = time.time()
+            with self._lock:
+                self._running += 1
+                self._wait_times.append(started_at - job.created_at)
+            self._set_status(job, 'running', started_at=started_at)
+
+            try:
+                result = job.func(*job.args)
+                with self._lock:
+                    self.completed += 1
+                self._set_status(job, 'done', result=result, finished_at=time.time())
+            except Exception as e:
+                logger.error(f"异步任务执行失败 {job.id}: {e}")
+                with self._lock:
+                    self.failed += 1
+                self._set_status(job, 'failed', error=str(e), finished_at=time.time())
+            finally:
+                job.func = None
+                job.args = ()  # 释放图片等大对象
+                with self._lock:
+                    self._running -= 1
+                self._queue.task_done()
+
+    def _purge_expired(self):
+        """清理超过保留时间的已完成任务"""
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -0,0 +1,335 @@
+"""
+公式语法树与MathML序列化
+WordMathMLConverter 先把LaTeX解析为这里的节点树，再由 MathMLSerializer 一次遍历输出，
+其他输出格式可以复用同一棵树
+"""
+
+import io
+
+MATHML_NAMESPACE = 'http://www.w3.org/1998/Math/MathML'
+
+# 字符 → 输出文本的预计算表：XML特殊字符转义，非ASCII字符转换为十六进制XML数字实体
+# （Word对数字实体的兼容性更好）。希腊字母、运算符等已知符号由 register_symbols 预先填入；
+# 用户输入中的其他非ASCII字符每次现场转换，不写入此表（否则表会随输入无限增长）
+ENTITY_TABLE = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+
+class OutputTooLargeError(ValueError):
+    """序列化输出超过长度上限"""
+
+
+class MathNode:
+    """语法树节点基类"""
+
+    __slots__ = ()
+    tag = ''
+    text = None       # 叶子节点的文本；None 表示布局节点或自闭合元素
+    children = ()
+
+    def attributes(self):
+        """MathML属性 (名称, 值) 列表"""
+        return ()
+
+
+class Identifier(MathNode):
+    """标识符 <mi>，variant 对应 mathvariant"""
+
+    __slots__ = ('text', 'variant')
+    tag = 'mi'
+
+    def __init__(self, text, variant=None):
+        self.text = text
+        self.variant = variant
+
+    def attributes(self):
+        return (('mathvariant', self.variant),) if self.variant else ()
+
+
+class Number(MathNode):
+    """数字 <mn>"""
+
+    __slots__ = ('text',)
+    tag = 'mn'
+
+    def __init__(self, text):
+        self.text = text
+
+
+class Operator(MathNode):
+    """运算符、括号等 <mo>"""
+
+    __slots__ = ('text',)
+    tag = 'mo'
+
+    def __init__(self, text):
+        self.text = text
+
+
+class Text(MathNode):
+    """普通文本 <mtext>"""
+
+    __slots__ = ('text',)
+    tag = 'mtext'
+
+    def __init__(self, text):
+        self.text = text
+
+
+class Space(MathNode):
+    """空白或换行 <mspace/>"""
+
+    __slots__ = ('width', 'linebreak')
+    tag = 'mspace'
+
+    def __init__(self, width=None, linebreak=None):
+        self.width = width
+        self.linebreak = linebreak
+
+    def attributes(self):
+        if self.linebreak:
+            return (('linebreak', self.linebreak),)
+        return (('width', self.width),)
+
+
+class Row(MathNode):
+    """水平排列 <mrow>"""
+
+    __slots__ = ('children',)
+    tag = 'mrow'
+
+    def __init__(self, children):
+        self.children = children
+
+
+class Math(Row):
+    """根节点 <math>"""
+
+    __slots__ = ()
+    tag = 'math'
+
+    def attributes(self):
+        return (('xmlns', MATHML_NAMESPACE),)
+
+
+class Fraction(MathNode):
+    """分数 <mfrac>，linethickness 为 '0' 时不画分数线（如二项式系数）"""
+
+    __slots__ = ('numerator', 'denominator', 'linethickness')
+    tag = 'mfrac'
+
+    def __init__(self, numerator, denominator, linethickness=None):
+        self.numerator = numerator
+        self.denominator = denominator
+        self.linethickness = linethickness
+
+    def attributes(self):
+        return (('linethickness', self.linethickness),) if self.linethickness else ()
+
+    @property
+    def children(self):
+        return (self.numerator, self.denominator)
+
+
+class Sqrt(MathNode):
+    """平方根 <msqrt>"""
+
+    __slots__ = ('body',)
+    tag = 'msqrt'
+
+    def __init__(self, body):
+        self.body = body
+
+    @property
+    def children(self):
+        return (self.body,)
+
+
+class Root(MathNode):
+    """n次根 <mroot>"""
+
+    __slots__ = ('body', 'index')
+    tag = 'mroot'
+
+    def __init__(self, body, index):
+        self.body = body
+        self.index = index
+
+    @property
+    def children(self):
+        return (self.body, self.index)
+
+
+class Scripts(MathNode):
+    """上下标 <msub> / <msup> / <msubsup>"""
+
+    __slots__ = ('base', 'sub', 'sup')
+
+    def __init__(self, base, sub=None, sup=None):
+        self.base = base
+        self.sub = sub
+        self.sup = sup
+
+    @property
+    def tag(self):
+        if self.sub is None:
+            return 'msup'
+        return 'msub' if self.sup is None else 'msubsup'
+
+    @property
+    def children(self):
+        return tuple(node for node in (self.base, self.sub, self.sup) if node is not None)
+
+
+class Under(MathNode):
+    """下方标注 <munder>（如极限）"""
+
+    __slots__ = ('base', 'under')
+    tag = 'munder'
+
+    def __init__(self, base, under):
+        self.base = base
+        self.under = under
+
+    @property
+    def children(self):
+        return (self.base, self.under)
+
+
+class Over(MathNode):
+    """上方标注 <mover>（如重音）"""
+
+    __slots__ = ('base', 'over')
+    tag = 'mover'
+
+    def __init__(self, base, over):
+        self.base = base
+        self.over = over
+
+    @property
+    def children(self):
+        return (self.base, self.over)
+
+
+def tree_depth(node):
+    """语法树的最大深度（根节点为1），显式栈遍历"""
+    deepest = 0
+    stack = [(node, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if depth > deepest:
+            deepest = depth
+        for child in node.children:
+            stack.append((child, depth + 1))
+    return deepest
+
+
+def register_symbols(symbols):
+    """为符号中的非ASCII字符预先计算XML数字实体"""
+    for text in symbols:
+        for char in text:
+            if ord(char) > 127 and char not in ENTITY_TABLE:
+                ENTITY_TABLE[char] = f'&#x{ord(char):04X};'
+
+
+def escape_text(text, non_ascii=True):
+    """
+    转义节点文本
+
+    Args:
+        text: 节点文本
+        non_ascii: 是否把非ASCII字符转换为XML数字实体
+    """
+    table = ENTITY_TABLE
+    if non_ascii:
+        # 单字符符号直接查表
+        escaped = table.get(text)
+        if escaped is not None:
+            return escaped
+    if not non_ascii or text.isascii():
+        if '&' in text or '<' in text or '>' in text:
+            text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        return text
+
+    parts = []
+    for char in text:
+        escaped = table.get(char)
+        if escaped is None:
+            if ord(char) > 127:
+                escaped = f'&#x{ord(char):04X};'
+            else:
+                escaped = char
+        parts.append(escaped)
+    return ''.join(parts)
+
+
+class MathMLSerializer:
+    """将语法树序列化为MathML，显式栈遍历，边遍历边写入输出流"""
+
+    def __init__(self, pretty=True, indent='  ', non_ascii_entities=True):
+        """
+        Args:
+            pretty: True 时每个元素一行并按层级缩进，False 时输出紧凑的单行MathML
+            indent: 每层缩进字符串
+            non_ascii_entities: 是否把非ASCII字符输出为XML数字实体
+        """
+        self.pretty = pretty
+        self.indent = indent
+        self.non_ascii_entities = non_ascii_entities
+
+    def serialize(self, node, out=None, max_length=None):
+        """
+        序列化节点树
+
+        Args:
+            node: 根节点
+            out: 带write方法的输出对象（如 io.StringIO、文件）；为None时返回字符串
+            max_length: 输出的最大字符数，None 表示不限制（带缩进输出的长度随嵌套深度平方增长）
+
+        Returns:
+            out 为 None 时返回MathML字符串，否则返回 None
+
+        Raises:
+            OutputTooLargeError: 输出超过 max_length（已写入 out 的部分不会撤回）
+        """
+        stream = io.StringIO() if out is None else out
+        write = stream.write
+        pretty = self.pretty
+        indent = self.indent
+        non_ascii = self.non_ascii_entities
+        pads = ['']    # pads[d]：第d层的换行和缩进
+        prefix = ''
+        remaining = float('inf') if max_length is None else max_length
+
+        # 栈元素：(节点, 深度, 是否为结束标签)；每个元素只写一次
+        stack = [(node, 0, False)]
+        while stack:
+            node, depth, closing = stack.pop()
+            if pretty:
+                while len(pads) <= depth:
+                    pads.append('\n' + indent * len(pads))
+                prefix = pads[depth] if depth else ('\n' if closing else '')
+
+            tag = node.tag
+            if closing:
+                chunk = f'{prefix}</{tag}>'
+            else:
+                attributes = ''.join(f' {name}="{value}"' for name, value in node.attributes())
+                text = node.text
+                if text is not None:
+                    chunk = f'{prefix}<{tag}{attributes}>{escape_text(text, non_ascii)}</{tag}>'
+                elif isinstance(node, Space):
+                    chunk = f'{prefix}<{tag}{attributes}/>'
+                else:
+                    chunk = f'{prefix}<{tag}{attributes}>'
+                    stack.append((node, depth, True))
+                    for child in reversed(node.children):
+                        stack.append((child, depth + 1, False))
+
+            remaining -= len(chunk)
+            if remaining < 0:
+                raise OutputTooLargeError(f'MathML输出超过{max_length}个字符')
+            write(chunk)
+
+        if out is None:
+            return stream.getvalue()
+        return None
@@ -0,0 +1,244 @@
+"""
+运行时指标
+提供线程安全的计数器和直方图，按 Prometheus 文本格式输出，
+并为每个请求收集各处理阶段的耗时（用于 Server-Timing 响应头）
+"""
+
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# 阶段耗时直方图的默认分桶（秒）：覆盖从亚毫秒的清理/转换到数秒的模型推理
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels: dict) -> str:
+    """格式化标签集合，如 {stage="decode"}"""
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增计数器，可带标签"""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1):
+        """计数加 amount，labelvalues 按 labelnames 顺序给出"""
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues) -> float:
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        """(指标名, 标签字典, 值) 列表"""
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Histogram:
+    """固定分桶直方图，可带标签；observe 只做一次二分查找和几次加法"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # 标签值 → [各分桶计数（非累计）, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        """记录一次观测值"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labelvalues) -> int:
+        with self._lock:
+            series = self._series.get(labelvalues)
+            return series[2] if series else 0
+
+    def samples(self):
+        """(指标名, 标签字典, 值) 列表，分桶计数按 Prometheus 约定累计"""
+        with self._lock:
+            items = sorted((key, (list(series[0]), series[1], series[2])) for key, series in self._series.items())
+        result = []
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                result.append((f'{self.name}_bucket', dict(labels, le=_format_value(float(bound))), cumulative))
+            result.append((f'{self.name}_sum', labels, total))
+            result.append((f'{self.name}_count', labels, count))
+        return result
+
+
+class CallbackMetric:
+    """输出时才取值的指标（如从缓存统计中读取命中数）"""
+
+    def __init__(self, name: str, help_text: str, type_name: str, func: Callable):
+        """
+        Args:
+            func: 返回 [(标签字典, 值)] 的函数
+        """
+        self.name = name
+        self.help_text = help_text
+        self.type_name = type_name
+        self.func = func
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.func()]
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        """注册（或取回同名的）计数器"""
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """注册（或取回同名的）直方图"""
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def register_callback(self, name: str, help_text: str, type_name: str, func: Callable):
+        """注册输出时才取值的指标（同名时替换）"""
+        with self._lock:
+            self._metrics[name] = CallbackMetric(name, help_text, type_name, func)
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式（0.0.4）输出全部指标"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue  # 回调出错时跳过该指标，不影响其他指标
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# 全局注册表与内置指标
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'formula_stage_duration_seconds', '各处理阶段耗时（秒）', ('stage',))
+CONVERSION_BACKEND = REGISTRY.counter(
+    'formula_conversion_backend_total',
+    '各转换后端的调用结果（回退链在首个成功的后端处停止，success 即该后端胜出）',
+    ('backend', 'outcome'))
+FAILURES = REGISTRY.counter('formula_failures_total', '各阶段失败次数', ('stage',))
+ROUTES = REGISTRY.counter(
+    'formula_recognition_route_total', '识别推理路由（decision 为 auto 表示自动分类，forced 表示由请求或配置指定）',
+    ('route', 'decision'))
+
+# 当前请求的阶段耗时（阶段名 → 累计秒数），未在请求中时为None
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def time_stage(stage: str):
+    """记录代码块耗时到阶段直方图，并累加到当前请求的 Server-Timing"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def record_stage(stage: str, elapsed: float):
+    """记录一次阶段耗时（秒）"""
+    STAGE_SECONDS.observe(elapsed, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def record_failure(stage: str):
+    """记录一次阶段失败"""
+    FAILURES.inc(stage)
+
+
+def record_backend(backend: str, success: bool):
+    """记录一次转换后端的结果"""
+    CONVERSION_BACKEND.inc(backend, 'success' if success else 'failure')
+
+
+def record_route(route: str, forced: bool):
+    """记录一次推理路由决策"""
+    ROUTES.inc(route, 'forced' if forced else 'auto')
+
+
+def start_request_timing():
+    """开始收集当前请求（当前上下文）的阶段耗时"""
+    _request_timings.set({})
+
+
+def request_timings() -> Optional[dict]:
+    """当前请求已收集的阶段耗时"""
+    return _request_timings.get()
+
+
+def server_timing_header(timings: dict, total: Optional[float] = None) -> str:
+    """
+    生成 Server-Timing 响应头的值
+
+    Args:
+        timings: 阶段名 → 秒数
+        total: 请求总耗时（秒），为None时不输出 total 项
+    """
+    entries = [f'{stage};dur={elapsed * 1000:.2f}' for stage, elapsed in timings.items()]
+    if total is not None:
+        entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
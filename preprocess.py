@@ -0,0 +1,296 @@
+"""
+图片预处理引擎
+识别前先按墨迹范围自动裁剪（送入公式识别模型的再缩放到模型偏好的高度），再做
+灰度化 → 高斯模糊 → 自适应阈值 → 闭运算，中间结果写入按线程复用的预分配缓冲区，
+输入已是灰度或二值图时跳过不需要的步骤，结果数组可直接送入模型
+"""
+
+import os
+import threading
+import cv2
+import numpy as np
+from typing import Optional
+
+# 形态学闭运算的结构元素，所有调用共享
+CLOSE_KERNEL = np.ones((2, 2), np.uint8)
+
+# 检测墨迹范围时先把图片缩小到此最长边以内（只用于定位，不影响输出清晰度）
+DETECTION_MAX_SIDE = 1024
+
+# 每个线程保留的缓冲区容量上限（像素数）；更大的图片临时分配，避免一张超大图长期占用内存
+SCRATCH_MAX_PIXELS = 4096 * 2048
+SCRATCH_NAMES = ('gray', 'blurred', 'thresh', 'mask')
+
+
+class Preprocessor:
+    """公式图片预处理，线程安全（每个线程使用各自的缓冲区）"""
+
+    def __init__(self, blur_size: int = 5, block_size: int = 11, offset: int = 2,
+                 skip_binary: bool = True, auto_crop: bool = True, crop_margin: int = 16,
+                 target_height: int = 384):
+        """
+        Args:
+            blur_size: 高斯模糊核大小
+            block_size: 自适应阈值的邻域大小
+            offset: 自适应阈值从邻域均值中减去的常数
+            skip_binary: 输入已是二值图（只含0和255）时跳过模糊和阈值处理
+            auto_crop: 是否在预处理前裁剪到墨迹范围并缩放
+            crop_margin: 裁剪时在墨迹范围四周保留的边距（像素）
+            target_height: 公式识别模型偏好的输入高度，裁剪后高于此值的图片等比缩小到此高度，0 表示不缩放
+        """
+        self.blur_size = (blur_size, blur_size)
+        self.block_size = block_size
+        self.offset = offset
+        self.skip_binary = skip_binary
+        self.auto_crop_enabled = auto_crop
+        self.crop_margin = max(0, crop_margin)
+        self.target_height = max(0, target_height)
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls) -> 'Preprocessor':
+        """根据环境变量创建预处理引擎（AUTO_CROP、AUTO_CROP_MARGIN、RECOGNITION_TARGET_HEIGHT）"""
+        return cls(
+            auto_crop=os.environ.get('AUTO_CROP', 'on').lower() in ('1', 'on', 'true', 'yes'),
+            crop_margin=int(os.environ.get('AUTO_CROP_MARGIN', '16')),
+            target_height=int(os.environ.get('RECOGNITION_TARGET_HEIGHT', '384')),
+        )
+
+    def _scratch(self, shape: tuple) -> dict:
+        """
+        当前线程的缓冲区，按所需尺寸切出视图
+
+        缓冲区是只增不减的一维数组：自动裁剪后每张图片尺寸都不同，按容量而不是形状复用，
+        只有遇到更大的图片时才重新分配
+        """
+        size = shape[0] * shape[1]
+        if size > SCRATCH_MAX_PIXELS:
+            return {name: np.empty(shape, np.uint8) for name in SCRATCH_NAMES}
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None or buffers['gray'].size < size:
+            buffers = {name: np.empty(size, np.uint8) for name in SCRATCH_NAMES}
+            self._local.buffers = buffers
+        return {name: buffer[:size].reshape(shape) for name, buffer in buffers.items()}
+
+    @staticmethod
+    def to_uint8(image: np.ndarray) -> np.ndarray:
+        """
+        转为8位数组：整数类型按取值范围等比缩放（16位的 0~65535 映射到 0~255，而不是截断到255），
+        浮点类型按实际的最小/最大值拉伸到 0~255
+        """
+        if image.dtype == np.uint8:
+            return image
+        if np.issubdtype(image.dtype, np.integer):
+            return cv2.convertScaleAbs(image, alpha=255.0 / np.iinfo(image.dtype).max)
+        return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+    def to_gray(self, image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        转为8位灰度图，已是灰度图时直接返回原数组
+
+        Args:
+            image: BGR、BGRA或灰度格式的NumPy数组
+            out: 可选的输出缓冲区
+        """
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[:, :, 0]
+        image = self.to_uint8(image)
+        if image.ndim == 2:
+            return image
+        code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(image, code, dst=out)
+
+    def ink_mask(self, image: np.ndarray, max_side: int = DETECTION_MAX_SIDE):
+        """
+        在缩小后的灰度图上用Otsu阈值区分墨迹和背景（背景偏暗时视为浅色字）
+
+        Args:
+            image: BGR或灰度格式的NumPy数组
+            max_side: 缩小后的最长边上限；按整数倍缩小，OpenCV对整数比例的区域插值有快速路径
+
+        Returns:
+            (墨迹掩码（墨迹为255）, 缩小倍数)
+        """
+        height, width = image.shape[:2]
+        gray = self.to_gray(image)
+        step = -(-max(height, width) // max_side)
+        if step > 1 and height >= step and width >= step:
+            # 不足一倍的边缘行列忽略
+            rows, cols = height // step, width // step
+            gray = cv2.resize(gray[:rows * step, :cols * step], (cols, rows), interpolation=cv2.INTER_AREA)
+        else:
+            step = 1
+
+        dark_background = cv2.mean(gray)[0] < 128
+        mode = cv2.THRESH_BINARY if dark_background else cv2.THRESH_BINARY_INV
+        _, mask = cv2.threshold(gray, 0, 255, mode | cv2.THRESH_OTSU)
+        return mask, step
+
+    def ink_bounds(self, image: np.ndarray) -> Optional[tuple]:
+        """
+        定位墨迹的外接矩形，墨迹为空或占据大半画面（无法区分前景）时返回None
+
+        Returns:
+            原图坐标下的 (x, y, 宽, 高)，或None
+        """
+        height, width = image.shape[:2]
+        mask, step = self.ink_mask(image)
+        ink = cv2.countNonZero(mask)
+        if ink == 0 or ink > mask.size // 2:
+            return None
+
+        x, y, w, h = cv2.boundingRect(mask)
+        # 映射回原图坐标
+        x0, y0 = x * step, y * step
+        x1, y1 = min(width, (x + w) * step), min(height, (y + h) * step)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def auto_crop(self, image: np.ndarray, scale: bool = True):
+        """
+        裁剪到墨迹范围（保留边距）并缩放到模型偏好的高度
+
+        在模糊、阈值等重处理和模型推理之前调用：整页截图中只有一小块公式时，
+        后续各步骤处理的像素数可减少一到两个数量级。
+
+        Args:
+            image: BGR或灰度格式的NumPy数组
+            scale: 是否缩放；为False时只裁剪，之后可按推理路由调用 fit_height
+
+        Returns:
+            (处理后的图片, 决策字典)；决策字典包含 applied、original_size、crop_box、scale、output_size，
+            尺寸均为 [宽, 高]
+        """
+        height, width = image.shape[:2]
+        decisions = {'applied': False, 'original_size': [width, height], 'crop_box': None,
+                     'scale': 1.0, 'output_size': [width, height]}
+        if not self.auto_crop_enabled or height == 0 or width == 0:
+            return image, decisions
+
+        bounds = self.ink_bounds(image)
+        if bounds is not None:
+            x, y, w, h = bounds
+            margin = self.crop_margin
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+            # 裁掉的面积不足10%时不裁剪，省去一次拷贝
+            if (x1 - x0) * (y1 - y0) < 0.9 * width * height:
+                image = np.ascontiguousarray(image[y0:y1, x0:x1])
+                decisions['crop_box'] = [x0, y0, x1 - x0, y1 - y0]
+                decisions['applied'] = True
+                decisions['output_size'] = [x1 - x0, y1 - y0]
+
+        if scale:
+            image = self.fit_height(image, decisions)
+        return image, decisions
+
+    def fit_height(self, image: np.ndarray, decisions: Optional[dict] = None) -> np.ndarray:
+        """
+        高于 target_height 的图片等比缩小到该高度
+
+        只适用于送入公式识别模型的图片；版面分析和文字OCR需要原始分辨率，
+        整页文字缩到几百像素高后字符只剩几个像素
+
+        Args:
+            image: 图片数组
+            decisions: 可选的 auto_crop 决策字典，缩放时更新其中的 scale、output_size 和 applied
+        """
+        height, width = image.shape[:2]
+        if not self.target_height or height <= self.target_height:
+            return image
+        scale = self.target_height / height
+        size = (max(1, round(width * scale)), self.target_height)
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if decisions is not None:
+            decisions['scale'] = round(scale, 4)
+            decisions['applied'] = True
+            decisions['output_size'] = list(size)
+        return image
+
+    def is_binary(self, gray: np.ndarray, mask: Optional[np.ndarray] = None) -> bool:
+        """灰度图是否只含0和255两种值"""
+        return cv2.countNonZero(cv2.inRange(gray, 1, 254, dst=mask)) == 0
+
+    def process(self, image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        预处理单张图片
+
+        Args:
+            image: BGR、BGRA或灰度格式的NumPy数组
+            out: 可选的输出缓冲区（与输入同高宽的uint8二维数组）；为None时分配新数组
+
+        Returns:
+            预处理后的二值化灰度数组
+        """
+        shape = image.shape[:2]
+        scratch = self._scratch(shape)
+        gray = self.to_gray(image, scratch['gray'])
+        if out is None:
+            out = np.empty(shape, np.uint8)
+
+        if self.skip_binary and self.is_binary(gray, scratch['mask']):
+            # 已是二值图：模糊和阈值不会带来改善，只做闭运算去除噪点
+            return cv2.morphologyEx(gray, cv2.MORPH_CLOSE, CLOSE_KERNEL, dst=out)
+
+        # 应用高斯模糊降噪
+        blurred = cv2.GaussianBlur(gray, self.blur_size, 0, dst=scratch['blurred'])
+        # 自适应阈值处理
+        thresh = cv2.adaptiveThreshold(
+            blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY, self.block_size, self.offset, dst=scratch['thresh']
+        )
+        # 形态学操作去除噪点
+        return cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, CLOSE_KERNEL, dst=out)
+
+    def process_batch(self, images, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        一次调用预处理一组同尺寸的图片
+
+        彩色输入的灰度化对整组一次完成；模糊、阈值和闭运算逐张写入输出数组的切片，
+        与逐张调用 process 的结果完全一致（浮点输入也逐张拉伸到 0~255），且不为单张图片分配内存。
+
+        Args:
+            images: 形状为 (N, H, W) 或 (N, H, W, C) 的数组，或同尺寸图片的列表
+            out: 可选的 (N, H, W) uint8 输出数组
+
+        Returns:
+            形状为 (N, H, W) 的预处理结果
+
+        Raises:
+            ValueError: 图片尺寸不一致
+        """
+        if not isinstance(images, np.ndarray):
+            if not images:
+                return np.empty((0, 0, 0), np.uint8)
+            if len({image.shape for image in images}) != 1:
+                raise ValueError("批量预处理要求所有图片尺寸相同")
+            images = np.stack(images)
+
+        count, height, width = images.shape[:3]
+        if out is None:
+            out = np.empty((count, height, width), np.uint8)
+        if count == 0:
+            return out
+
+        if np.issubdtype(images.dtype, np.floating):
+            # 浮点按各自的最小/最大值拉伸，整组一起拉伸会让每张的结果取决于同组的其他图片
+            converted = np.empty(images.shape, np.uint8)
+            for index in range(count):
+                converted[index] = self.to_uint8(images[index]).reshape(images.shape[1:])
+            images = converted
+
+        if images.ndim == 4 and images.shape[3] > 1:
+            # 灰度化是逐像素运算，整组视为一张高图一次完成
+            stacked = np.ascontiguousarray(images).reshape(count * height, width, images.shape[3])
+            grays = self.to_gray(stacked).reshape(count, height, width)
+        else:
+            grays = images.reshape(count, height, width)
+            if grays.dtype != np.uint8:
+                grays = self.to_uint8(grays.reshape(count * height, width)).reshape(count, height, width)
+
+        for index in range(count):
+            self.process(grays[index], out[index])
+        return out
+
+
+# 默认实例，供识别器和工作进程共享
+default_preprocessor = Preprocessor.from_env()
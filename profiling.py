@@ -0,0 +1,236 @@
+"""
+按请求剖析
+开启后，带剖析请求头的请求会被 cProfile 或栈采样器记录，
+结果保存在最近剖析记录的环形缓冲区中，可导出为 pstats 或折叠栈文本（用于生成火焰图）
+"""
+
+import io
+import os
+import sys
+import hmac
+import time
+import uuid
+import pstats
+import marshal
+import cProfile
+import logging
+import threading
+from collections import Counter, deque
+from typing import Optional
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class StackSampler(threading.Thread):
+    """定时采样目标线程的调用栈，按栈统计命中次数"""
+
+    def __init__(self, thread_id: int, interval: float, max_samples: int):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval) and self.samples < self.max_samples:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            del frame
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class ProfileSession:
+    """正在进行的一次剖析"""
+
+    def __init__(self, mode: str, label: str, sample_interval: float, max_samples: int):
+        self.id = uuid.uuid4().hex[:16]
+        self.mode = mode
+        self.label = label
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._profile = None
+        self._sampler = None
+        if mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = StackSampler(threading.get_ident(), sample_interval, max_samples)
+            self._sampler.start()
+
+    def stop(self) -> dict:
+        """停止剖析并返回剖析记录"""
+        duration = time.perf_counter() - self._started
+        record = {
+            'id': self.id,
+            'mode': self.mode,
+            'label': self.label,
+            'started_at': self.started_at,
+            'duration': round(duration, 6),
+        }
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.create_stats()
+            record['stats'] = self._profile.stats
+        else:
+            self._sampler.stop()
+            record['stacks'] = self._sampler.stacks
+            record['samples'] = self._sampler.samples
+        return record
+
+
+class RequestProfiler:
+    """按请求剖析的开关、并发控制与最近剖析记录的环形缓冲区"""
+
+    def __init__(self, enabled: bool = False, buffer_size: int = 20, sample_interval: float = 0.001,
+                 max_samples: int = 100000, token: Optional[str] = None):
+        """
+        Args:
+            enabled: 是否允许剖析；关闭时请求头被忽略，管理接口不可用
+            buffer_size: 保留最近多少条剖析记录
+            sample_interval: 栈采样间隔（秒）
+            max_samples: 单次采样的最大样本数
+            token: 管理令牌，剖析请求头和管理接口都需要携带该令牌；未设置时不开启剖析
+        """
+        if enabled and not token:
+            # 剖析会串行化请求并带来额外开销，导出的记录含源码路径和公式内容，不能对任意客户端开放
+            logger.warning("已设置 REQUEST_PROFILING 但未设置 PROFILE_ADMIN_TOKEN，按请求剖析保持关闭")
+            enabled = False
+        self.enabled = enabled
+        self.sample_interval = sample_interval
+        self.max_samples = max_samples
+        self.token = token
+        self._records = deque(maxlen=max(1, buffer_size))
+        self._lock = threading.Lock()
+        # cProfile 在 Python 3.12+ 同一时刻只能有一个实例启用，因此同一时刻只剖析一个请求
+        self._active = threading.Lock()
+        self.skipped = 0
+
+    @classmethod
+    def from_env(cls) -> 'RequestProfiler':
+        """根据环境变量创建剖析器（REQUEST_PROFILING=on 时启用）"""
+        enabled = os.environ.get('REQUEST_PROFILING', '').lower() in ('1', 'on', 'true', 'yes')
+        return cls(
+            enabled=enabled,
+            buffer_size=int(os.environ.get('PROFILE_BUFFER_SIZE', '20')),
+            sample_interval=float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '1')) / 1000,
+            token=os.environ.get('PROFILE_ADMIN_TOKEN') or None,
+        )
+
+    def authorized(self, token: Optional[str]) -> bool:
+        """剖析已开启且令牌匹配"""
+        return self.enabled and token is not None and hmac.compare_digest(
+            token.encode('utf-8'), self.token.encode('utf-8'))
+
+    def start(self, mode: str, label: str = '') -> Optional[ProfileSession]:
+        """
+        开始剖析当前线程
+
+        Args:
+            mode: 'cprofile'（确定性剖析，可导出 pstats）或 'sample'（栈采样，可导出折叠栈）
+            label: 记录的说明，如请求方法和路径
+
+        Returns:
+            剖析会话；已有请求正在剖析时返回None
+
+        Raises:
+            ValueError: 未知的剖析模式
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"未知的剖析模式: {mode}，可选 {', '.join(PROFILE_MODES)}")
+        if not self._active.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        try:
+            return ProfileSession(mode, label, self.sample_interval, self.max_samples)
+        except Exception as e:
+            self._active.release()
+            logger.warning(f"启动剖析失败: {e}")
+            return None
+
+    def finish(self, session: ProfileSession) -> dict:
+        """结束剖析并将记录放入环形缓冲区"""
+        try:
+            record = session.stop()
+        finally:
+            self._active.release()
+        with self._lock:
+            self._records.append(record)
+        logger.info(f"剖析完成: {record['label']} ({record['mode']}, {record['duration'] * 1000:.1f}ms)")
+        return record
+
+    def list(self) -> list:
+        """最近的剖析记录摘要（新记录在前）"""
+        with self._lock:
+            records = list(self._records)
+        return [{key: value for key, value in record.items() if key not in ('stats', 'stacks')}
+                for record in reversed(records)]
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        with self._lock:
+            for record in self._records:
+                if record['id'] == profile_id:
+                    return record
+        return None
+
+    @staticmethod
+    def render(record: dict, fmt: str, sort: str = 'cumulative', limit: int = 50):
+        """
+        导出剖析记录
+
+        Args:
+            record: 剖析记录
+            fmt: 'text'（pstats 文本报表）、'pstats'（可被 pstats/snakeviz 读取的二进制）
+                 或 'collapsed'（折叠栈，每行 "栈;帧 次数"，可直接交给 flamegraph.pl / speedscope）
+            sort: text 格式的排序键
+            limit: text 格式输出的函数数
+
+        Returns:
+            (内容, MIME类型)
+
+        Raises:
+            ValueError: 格式未知或与剖析模式不匹配
+        """
+        if fmt == 'collapsed':
+            if 'stacks' not in record:
+                raise ValueError("折叠栈只适用于 sample 模式的剖析记录")
+            lines = [f"{';'.join(stack)} {count}" for stack, count in record['stacks'].most_common()]
+            return '\n'.join(lines) + '\n', 'text/plain; charset=utf-8'
+
+        if fmt not in ('text', 'pstats'):
+            raise ValueError(f"未知的导出格式: {fmt}，可选 text、pstats、collapsed")
+        if 'stats' not in record:
+            raise ValueError("pstats 只适用于 cprofile 模式的剖析记录")
+        if fmt == 'pstats':
+            return marshal.dumps(record['stats']), 'application/octet-stream'
+
+        stream = io.StringIO()
+        stats = pstats.Stats(_StatsSource(record['stats']), stream=stream)
+        stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue(), 'text/plain; charset=utf-8'
+
+
+class _StatsSource:
+    """让 pstats.Stats 直接读取内存中的统计数据"""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
@@ -1,26 +1,287 @@
+import io
+import os
+import time
+import threading
 import cv2
 import numpy as np
-from PIL import Image
-import pix2text
+from PIL import Image, ImageOps
 from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
+from cache import RecognitionCache
+from metrics import time_stage, record_failure, record_route
+from preprocess import Preprocessor, default_preprocessor
+from routing import ROUTES, InferenceRouter
+from segmentation import FormulaSegmenter
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class FormulaOnlyModel:
+    """
+    只包含公式识别模型（LatexOCR）的轻量封装
+    
+    提供与 Pix2Text 相同的 recognize / recognize_formula 接口，
+    不加载版面分析、公式检测和文字OCR模型。
+    """
+    
+    def __init__(self):
+        from pix2text import LatexOCR
+        self.latex_ocr = LatexOCR()
+    
+    def recognize(self, image, **kwargs):
+        """识别单张公式图片，返回含 'text' 的字典"""
+        return self.latex_ocr.recognize(image, **kwargs)
+    
+    def recognize_formula(self, images, batch_size: int = 1, **kwargs):
+        """批量识别公式图片"""
+        return self.latex_ocr.recognize(images, batch_size=batch_size, **kwargs)
+
+
 class FormulaRecognizer:
     """数学公式识别器"""
     
-    def __init__(self):
-        """初始化识别器"""
+    # 模型加载模式：mixed 加载完整的 Pix2Text（版面分析 + 文字OCR + 公式识别），
+    # formula-only 只加载公式识别模型，内存占用和启动时间都小得多
+    LOAD_MODES = ('mixed', 'formula-only')
+    
+    def __init__(self, cache: Optional[RecognitionCache] = None, batch_size: Optional[int] = None,
+                 worker_pool=None, load_model: bool = True, preprocessor: Optional[Preprocessor] = None,
+                 load_mode: Optional[str] = None, router: Optional[InferenceRouter] = None,
+                 segmenter: Optional[FormulaSegmenter] = None):
+        """
+        初始化识别器
+        
+        Args:
+            cache: 识别结果缓存，为None时根据环境变量创建
+            batch_size: 批量识别时单次送入模型的图片数，默认读取 RECOGNITION_BATCH_SIZE（8）
+            worker_pool: 多进程识别工作池（RecognitionWorkerPool），设置后推理在工作进程中执行，
+                         当前进程不再加载模型
+            load_model: 是否在构造时同步加载模型；为False时可调用 start_background_load() 后台加载
+            preprocessor: 图片预处理引擎，默认使用共享的 default_preprocessor
+            load_mode: 模型加载模式（mixed / formula-only），默认读取 RECOGNITION_LOAD_MODE（mixed）
+            router: 推理路由器，默认根据 RECOGNITION_ROUTE 创建
+            segmenter: 多公式切分器，默认根据 SEGMENT_MAX_REGIONS 创建
+            
+        Raises:
+            ValueError: 未知的加载模式或路由
+        """
+        if load_mode is None:
+            load_mode = os.environ.get('RECOGNITION_LOAD_MODE', 'mixed')
+        load_mode = load_mode.strip().lower()
+        if load_mode not in self.LOAD_MODES:
+            raise ValueError(f"未知的模型加载模式: {load_mode}，可选 {', '.join(self.LOAD_MODES)}")
+        self.load_mode = load_mode
+        
+        if batch_size is None:
+            batch_size = int(os.environ.get('RECOGNITION_BATCH_SIZE', '8'))
+        self.batch_size = max(1, batch_size)
+        self.worker_pool = worker_pool
+        self.preprocessor = preprocessor or default_preprocessor
+        self.router = router or InferenceRouter.from_env()
+        self.segmenter = segmenter or FormulaSegmenter.from_env()
+        
+        self.p2t = None
+        self.load_error = None
+        self._state = 'not_loaded'
+        self._load_lock = threading.Lock()
+        self._load_finished = threading.Event()
+        
+        # 两种模式的输出格式不同（mixed 会带 $$ 等定界符），缓存按模式区分
+        self.model_version = f"pix2text-{_pix2text_version()}"
+        if load_mode == 'formula-only':
+            self.model_version += '-formula'
+        self.cache = cache if cache is not None else RecognitionCache.from_env(self.model_version)
+        self.cache.set_model_version(self.model_version)
+        
+        if worker_pool is None and load_model:
+            self.load_model()
+    
+    @property
+    def ready(self) -> bool:
+        """是否可以执行识别（本进程已加载模型或已接入工作池）"""
+        return self.p2t is not None or self.worker_pool is not None
+    
+    @property
+    def state(self) -> str:
+        """模型加载状态：not_loaded / loading / ready / failed"""
+        if self.worker_pool is not None:
+            if self.worker_pool.ready:
+                return 'ready'
+            return 'failed' if self.worker_pool.failed else 'loading'
+        return self._state
+    
+    def load_model(self) -> bool:
+        """
+        加载Pix2Text模型（重复调用只加载一次）
+        
+        Returns:
+            是否加载成功
+        """
+        with self._load_lock:
+            if self.p2t is not None:
+                return True
+            self._state = 'loading'
+            started = time.perf_counter()
+            try:
+                # 延迟导入：pix2text 会连带导入 torch/onnxruntime，耗时较长
+                if self.load_mode == 'formula-only':
+                    self.p2t = FormulaOnlyModel()
+                else:
+                    import pix2text
+                    self.p2t = pix2text.Pix2Text()
+                self._state = 'ready'
+                logger.info(f"Pix2Text 初始化成功（{self.load_mode}），耗时 {time.perf_counter() - started:.2f}s")
+            except Exception as e:
+                logger.error(f"Pix2Text 初始化失败: {e}")
+                self.p2t = None
+                self.load_error = str(e)
+                self._state = 'failed'
+            finally:
+                self._load_finished.set()
+        return self.p2t is not None
+    
+    def start_background_load(self, warmup: bool = True) -> Optional[threading.Thread]:
+        """
+        在后台线程中加载模型，并用内置样例完成一次预热推理
+        
+        Args:
+            warmup: 加载完成后是否执行预热推理
+            
+        Returns:
+            后台线程；使用工作池或模型已加载时返回None
+        """
+        if self.worker_pool is not None or self.p2t is not None:
+            return None
+        self._state = 'loading'
+        thread = threading.Thread(target=self._background_load, args=(warmup,),
+                                  name='model-loader', daemon=True)
+        thread.start()
+        return thread
+    
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """等待后台加载结束，返回模型是否可用"""
+        if self.worker_pool is None and self._state == 'loading':
+            self._load_finished.wait(timeout)
+        return self.ready
+    
+    def warm_up(self):
+        """用内置样例图片执行一次推理，提前完成模型的惰性初始化"""
+        if not self.p2t:
+            return
+        started = time.perf_counter()
         try:
-            self.p2t = pix2text.Pix2Text()
-            logger.info("Pix2Text 初始化成功")
+            for route in self.available_routes:
+                self.run_recognition(_warmup_image(), route=route)
+            logger.info(f"模型预热完成，耗时 {time.perf_counter() - started:.2f}s")
         except Exception as e:
-            logger.error(f"Pix2Text 初始化失败: {e}")
-            self.p2t = None
+            logger.warning(f"模型预热失败: {e}")
+    
+    def _background_load(self, warmup: bool):
+        if self.load_model() and warmup:
+            self.warm_up()
+    
+    def decode_image(self, data: bytes) -> Optional[np.ndarray]:
+        """
+        从内存缓冲区解码图片，不经过磁盘
+        
+        Args:
+            data: 图片文件的原始字节
+            
+        Returns:
+            8位BGR或灰度格式的NumPy数组（已按EXIF方向旋转），解码失败返回None
+        """
+        if not data:
+            return None
+        
+        with time_stage('decode'):
+            buffer = np.frombuffer(data, dtype=np.uint8)
+            # ANYCOLOR 与 imread 默认的 IMREAD_COLOR 一样应用EXIF方向、把16位图缩放到8位、去掉alpha通道，
+            # 但灰度图保持单通道，后续的灰度化可以跳过
+            image = cv2.imdecode(buffer, cv2.IMREAD_ANYCOLOR)
+            if image is not None:
+                return image
+            
+            # OpenCV不支持的格式（如GIF）回退到PIL解码
+            try:
+                with Image.open(io.BytesIO(data)) as pil_image:
+                    rgb = np.asarray(ImageOps.exif_transpose(pil_image).convert('RGB'))
+                return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+            except Exception as e:
+                logger.error(f"图片解码失败: {e}")
+                record_failure('decode')
+                return None
+    
+    def load_image(self, image_path: str) -> Optional[np.ndarray]:
+        """
+        读取图片文件并解码为NumPy数组
+        
+        Args:
+            image_path: 图片路径
+            
+        Returns:
+            NumPy数组，读取失败返回None
+        """
+        try:
+            with open(image_path, 'rb') as f:
+                return self.decode_image(f.read())
+        except OSError as e:
+            logger.error(f"无法读取图片: {image_path}, {e}")
+            return None
+    
+    def crop_to_formula(self, image: np.ndarray):
+        """
+        裁剪到墨迹范围（不缩放，缩放要等选定路由后由 fit_to_route 决定）
+        
+        Returns:
+            (处理后的图片, 决策字典)
+        """
+        with time_stage('auto_crop'):
+            return self.preprocessor.auto_crop(image, scale=False)
+    
+    def fit_to_route(self, image: np.ndarray, decisions: dict, routing: dict) -> np.ndarray:
+        """
+        formula 路由的图片缩放到公式识别模型偏好的高度；mixed 路由保持裁剪后的原始分辨率，
+        版面分析和文字OCR需要足够的像素才能读出正文
+        
+        Args:
+            image: 已裁剪的图片数组
+            decisions: crop_to_formula 返回的决策字典，缩放时一并更新
+            routing: choose_route 返回的路由决策
+        """
+        if routing['route'] != 'formula':
+            return image
+        with time_stage('auto_crop'):
+            return self.preprocessor.fit_height(image, decisions)
+    
+    def preprocess_array(self, image: np.ndarray) -> np.ndarray:
+        """
+        在内存中预处理图片数组以提高识别准确率
+        
+        Args:
+            image: BGR或灰度格式的NumPy数组
+            
+        Returns:
+            预处理后的二值化灰度数组
+        """
+        # 灰度化、模糊、阈值和闭运算的中间结果写入线程复用的缓冲区，已是灰度/二值图时跳过对应步骤
+        with time_stage('preprocess'):
+            return self.preprocessor.process(image)
+    
+    def preprocess_batch(self, images) -> np.ndarray:
+        """
+        一次调用预处理一组同尺寸的图片（如同一张图中切出的多个公式区域）
+        
+        Args:
+            images: 形状为 (N, H, W) 或 (N, H, W, C) 的数组，或同尺寸图片的列表
+            
+        Returns:
+            形状为 (N, H, W) 的预处理结果
+        """
+        with time_stage('preprocess_batch'):
+            return self.preprocessor.process_batch(images)
     
     def preprocess_image(self, image_path: str) -> str:
         """
@@ -34,25 +295,11 @@ class FormulaRecognizer:
         """
         try:
             # 读取图片
-            image = cv2.imread(image_path)
+            image = self.load_image(image_path)
             if image is None:
                 raise ValueError(f"无法读取图片: {image_path}")
             
-            # 转换为灰度图
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            
-            # 应用高斯模糊降噪
-            blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-            
-            # 自适应阈值处理
-            thresh = cv2.adaptiveThreshold(
-                blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                cv2.THRESH_BINARY, 11, 2
-            )
-            
-            # 形态学操作去除噪点
-            kernel = np.ones((2, 2), np.uint8)
-            processed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+            processed = self.preprocess_array(image)
             
             # 保存处理后的图片
             processed_path = image_path.replace('.', '_processed.')
@@ -65,16 +312,119 @@ class FormulaRecognizer:
             logger.error(f"图片预处理失败: {e}")
             return image_path  # 如果预处理失败，返回原图
     
-    def recognize_formula(self, image_path: str, preprocess: bool = True) -> Optional[str]:
+    @property
+    def available_routes(self) -> tuple:
+        """当前加载的模型支持的推理路由（formula-only 模式没有版面分析）"""
+        return ('formula',) if self.load_mode == 'formula-only' else ROUTES
+    
+    def choose_route(self, image: np.ndarray, route: Optional[str] = None) -> dict:
+        """
+        为已裁剪的图片选择推理路由并计入指标
+        
+        Args:
+            image: 已裁剪的图片数组
+            route: 请求指定的路由（auto / formula / mixed），为None时使用配置的默认路由
+            
+        Returns:
+            路由决策字典（见 InferenceRouter.choose）
+        """
+        with time_stage('routing'):
+            decision = self.router.choose(image, route, self.available_routes)
+        record_route(decision['route'], decision['forced'])
+        return decision
+    
+    def recognize_formula(self, image_path: str, preprocess: bool = True,
+                          details: Optional[dict] = None, route: Optional[str] = None) -> Optional[str]:
         """
         识别数学公式
         
         Args:
             image_path: 图片路径
             preprocess: 是否进行预处理
+            details: 可选的字典，写入自动裁剪/缩放和路由决策（见 recognize_image）
+            route: 推理路由（见 recognize_image）
+            
+        Returns:
+            识别出的LaTeX公式，失败返回None
+        """
+        if not self.ready:
+            logger.error("Pix2Text 未初始化")
+            return None
+        
+        image = self.load_image(image_path)
+        if image is None:
+            return None
+        
+        return self.recognize_image(image, preprocess, details, route)
+    
+    def recognize_image(self, image: np.ndarray, preprocess: bool = True,
+                        details: Optional[dict] = None, route: Optional[str] = None) -> Optional[str]:
+        """
+        识别内存中图片数组里的数学公式（全程不读写磁盘）
+        
+        Args:
+            image: BGR或灰度格式的NumPy数组
+            preprocess: 是否进行预处理
+            details: 可选的字典，写入 'auto_crop'（自动裁剪/缩放的决策）和 'route'（推理路由决策）
+            route: 推理路由：auto 按图片特征自动选择，formula 直接调用公式识别模型，
+                   mixed 走完整的版面分析；为None时使用 RECOGNITION_ROUTE 配置的默认值
             
         Returns:
             识别出的LaTeX公式，失败返回None
+            
+        Raises:
+            ValueError: 未知的路由
+        """
+        if not self.ready:
+            logger.error("Pix2Text 未初始化")
+            return None
+        
+        # 先裁剪到公式所在区域，按裁剪后的内容选择路由后再决定是否缩放，
+        # 后续的缓存键计算、预处理和推理都只处理这块区域
+        image, decisions = self.crop_to_formula(image)
+        routing = self.choose_route(image, route)
+        image = self.fit_to_route(image, decisions, routing)
+        if details is not None:
+            details['auto_crop'] = decisions
+            details['route'] = routing
+        
+        # 相同像素内容的图片直接返回缓存结果（不同路由的结果分别缓存）
+        cache_key = self.cache.image_key(image, preprocess, routing['route'])
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"识别缓存命中: {cached[:50]}...")
+            return cached
+        
+        if self.worker_pool is not None:
+            # 工作进程内的各阶段耗时不回传，这里记录整个往返耗时
+            try:
+                with time_stage('worker_pool'):
+                    cleaned_formula = self.worker_pool.recognize(image, preprocess, routing['route'],
+                                                                 timeout=self.worker_pool.result_timeout)
+            except Exception as e:
+                logger.error(f"公式识别失败: {e}")
+                record_failure('inference')
+                return None
+        else:
+            cleaned_formula = self.run_recognition(image, preprocess, routing['route'])
+        
+        if cleaned_formula:
+            self.cache.put(cache_key, cleaned_formula)
+            logger.info(f"公式识别成功: {cleaned_formula[:50]}...")
+        return cleaned_formula
+    
+    def run_recognition(self, image: np.ndarray, preprocess: bool = True,
+                        route: str = 'mixed') -> Optional[str]:
+        """
+        在当前进程中执行预处理、模型推理和清理（不经过缓存）
+        
+        Args:
+            image: BGR或灰度格式的NumPy数组
+            preprocess: 是否进行预处理
+            route: formula 直接调用公式识别模型，mixed 调用 Pix2Text 完整流程
+            
+        Returns:
+            清理后的LaTeX公式，失败返回None
         """
         if not self.p2t:
             logger.error("Pix2Text 未初始化")
@@ -82,35 +432,56 @@ class FormulaRecognizer:
         
         try:
             # 图片预处理
+            processed = image
             if preprocess:
-                processed_path = self.preprocess_image(image_path)
-            else:
-                processed_path = image_path
+                try:
+                    processed = self.preprocess_array(image)
+                except Exception as e:
+                    logger.error(f"图片预处理失败: {e}")  # 预处理失败时使用原图
             
             # 使用Pix2Text识别公式
-            result = self.p2t.recognize(processed_path)
-            
-            if isinstance(result, dict):
-                # 提取LaTeX公式
-                latex_formula = result.get('text', '')
-                if not latex_formula:
-                    latex_formula = result.get('latex', '')
-            else:
-                latex_formula = str(result)
+            with time_stage('inference'):
+                latex_formula = self._infer(self._to_pil(processed), route)
             
             if latex_formula:
                 # 清理LaTeX公式，移除多余的$$符号
-                cleaned_formula = self._clean_latex_formula(latex_formula)
-                logger.info(f"公式识别成功: {cleaned_formula[:50]}...")
-                return cleaned_formula
+                with time_stage('cleanup'):
+                    return self._clean_latex_formula(latex_formula)
             else:
                 logger.warning("未识别到公式内容")
+                record_failure('empty_result')
                 return None
-                
+        
         except Exception as e:
             logger.error(f"公式识别失败: {e}")
+            record_failure('inference')
             return None
     
+    def _infer(self, pil_image: Image.Image, route: str) -> str:
+        """按路由调用模型，返回原始LaTeX文本"""
+        if route == 'formula':
+            recognize_formula = getattr(self.p2t, 'recognize_formula', None)
+            if recognize_formula is not None:
+                outputs = recognize_formula([pil_image], batch_size=1)
+                return self._extract_latex(outputs[0] if isinstance(outputs, list) else outputs)
+        return self._extract_latex(self.p2t.recognize(pil_image))
+    
+    def _to_pil(self, image: np.ndarray) -> Image.Image:
+        """将BGR/灰度NumPy数组转换为Pix2Text可直接接收的PIL图片"""
+        if image.ndim == 2:
+            return Image.fromarray(image)
+        return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    
+    def _extract_latex(self, result) -> str:
+        """从Pix2Text的返回值中提取LaTeX文本"""
+        if isinstance(result, dict):
+            # 提取LaTeX公式
+            latex_formula = result.get('text', '')
+            if not latex_formula:
+                latex_formula = result.get('latex', '')
+            return latex_formula
+        return str(result) if result else ''
+    
     def _clean_latex_formula(self, latex_formula: str) -> str:
         """
         清理LaTeX公式，移除多余的格式符号
@@ -172,24 +543,261 @@ class FormulaRecognizer:
         
         return formula.strip()
     
-    def batch_recognize(self, image_paths: list) -> list:
+    def batch_recognize(self, image_paths: list, preprocess: bool = True,
+                        batch_size: Optional[int] = None, max_workers: Optional[int] = None,
+                        route: Optional[str] = None) -> list:
         """
         批量识别多个图片
         
+        先用线程池并行解码和预处理，再按批次一次性送入Pix2Text公式识别模型，
+        结果按输入顺序返回，单张图片的失败只影响其自身的结果。
+        
         Args:
-            image_paths: 图片路径列表
+            image_paths: 图片路径列表（也可以是已解码的NumPy数组或原始字节）
+            preprocess: 是否进行预处理
+            batch_size: 单次模型前向的图片数，默认使用 self.batch_size
+            max_workers: 预处理线程数，默认为CPU核数
+            route: 推理路由（见 recognize_image），对每张图片分别生效
             
         Returns:
             识别结果列表
         """
+        results = [None] * len(image_paths)
+        for index, result in self.iter_batch_recognize(image_paths, preprocess, batch_size, max_workers, route):
+            results[index] = result
+        
+        logger.info(f"批量识别完成: {sum(r['success'] for r in results)}/{len(results)} 成功")
+        return results
+    
+    def recognize_regions(self, image: np.ndarray, preprocess: bool = True,
+                          route: Optional[str] = None, max_workers: Optional[int] = None) -> list:
+        """
+        识别一张图片中的多行公式
+        
+        先按水平投影把图片切分为逐行的公式区域，再把各区域作为一个批次识别：
+        区域的裁剪、预处理并行完成，formula 路由的区域一次送入模型（或分派到工作池）。
+        每个小区域单独裁剪、缩放，比整张大图一次识别更快，输出也不会被拼成一行。
+        
+        Args:
+            image: BGR或灰度格式的NumPy数组
+            preprocess: 是否进行预处理
+            route: 推理路由（见 recognize_image），对每个区域分别生效
+            max_workers: 预处理线程数，默认为CPU核数
+            
+        Returns:
+            从上到下的区域结果列表，每项在 batch_recognize 的结果基础上增加 bbox（原图坐标 [x, y, 宽, 高]）；
+            没有切分出区域时把整张图片作为一个区域
+            
+        Raises:
+            ValueError: 未知的路由，或区域数超过切分器的上限
+        """
+        with time_stage('segmentation'):
+            boxes = self.segmenter.regions(image)
+        if not boxes:
+            height, width = image.shape[:2]
+            boxes = [[0, 0, width, height]]
+        
+        crops = [np.ascontiguousarray(image[y:y + h, x:x + w]) for x, y, w, h in boxes]
+        results = self.batch_recognize(crops, preprocess, len(crops), max_workers, route)
+        for box, result in zip(boxes, results):
+            result.pop('image_path', None)
+            result['bbox'] = box
+        logger.info(f"多公式识别: 切分出 {len(boxes)} 个区域")
+        return results
+    
+    def iter_batch_recognize(self, image_paths: list, preprocess: bool = True,
+                             batch_size: Optional[int] = None, max_workers: Optional[int] = None,
+                             route: Optional[str] = None):
+        """
+        批量识别的流式版本，每张图片完成后立即产出
+        
+        缓存命中和读取失败的图片最先产出，其余图片按路由分组、按模型批次依次产出：
+        formula 路由的图片成批送入公式识别模型，mixed 路由的图片逐张走完整流程。
+        
+        Yields:
+            (输入下标, 识别结果字典)
+            
+        Raises:
+            ValueError: 未知的路由
+        """
+        if route is not None:
+            route = InferenceRouter.normalize(route)
+        
+        def new_result(item):
+            return {'image_path': item if isinstance(item, str) else None, 'formula': None, 'success': False}
+        
+        if not image_paths:
+            return
+        
+        if not self.ready:
+            logger.error("Pix2Text 未初始化")
+            for index, item in enumerate(image_paths):
+                yield index, dict(new_result(item), error='Pix2Text 未初始化')
+            return
+        
+        # 并行解码、查缓存、预处理（OpenCV在计算时会释放GIL）
+        # 使用工作池时预处理在工作进程中完成，这里只解码
+        to_model = self.worker_pool is None
+        workers = max_workers or min(len(image_paths), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            prepared = list(executor.map(
+                lambda item: self._prepare_batch_item(item, preprocess, to_model, route), image_paths))
+        
+        pending = {name: [] for name in ROUTES}
+        crops = {}
+        routes = {}
+        for index, (cache_key, pil_image, cached, error, decisions, routing) in enumerate(prepared):
+            crops[index] = decisions
+            routes[index] = routing
+            if error:
+                yield index, dict(new_result(image_paths[index]), error=error)
+            elif cached is not None:
+                yield index, dict(new_result(image_paths[index]), formula=cached, success=True, cached=True,
+                                  auto_crop=decisions, route=routing)
+            else:
+                pending[routing['route']].append((index, cache_key, pil_image))
+        
+        if self.worker_pool is not None:
+            for index, result in self._iter_pool_results(image_paths, pending, preprocess, new_result):
+                yield index, dict(result, auto_crop=crops[index], route=routes[index])
+            return
+        
+        # 按路由分组、按批次送入模型
+        batch_size = max(1, batch_size or self.batch_size)
+        for route_name, items in pending.items():
+            for start in range(0, len(items), batch_size):
+                chunk = items[start:start + batch_size]
+                with time_stage('batch_inference'):
+                    formulas = self._recognize_batch([pil_image for _, _, pil_image in chunk], route_name)
+                for index, result in self._batch_results(image_paths, chunk, formulas, new_result):
+                    yield index, dict(result, auto_crop=crops[index], route=routes[index])
+    
+    def _batch_results(self, image_paths: list, chunk: list, formulas: list, new_result):
+        """清理一个模型批次的输出并写入缓存，按输入顺序产出结果"""
+        for (index, cache_key, _), (latex_formula, error) in zip(chunk, formulas):
+            result = new_result(image_paths[index])
+            if latex_formula:
+                with time_stage('cleanup'):
+                    cleaned_formula = self._clean_latex_formula(latex_formula)
+                self.cache.put(cache_key, cleaned_formula)
+                result.update(formula=cleaned_formula, success=True)
+            else:
+                record_failure('inference' if error else 'empty_result')
+                result['error'] = error or '未识别到公式内容'
+            yield index, result
+    
+    def _iter_pool_results(self, image_paths: list, pending: dict, preprocess: bool, new_result):
+        """将未命中缓存的图片（按路由分组）分派到工作池，按完成顺序产出结果"""
+        futures = {}
+        for route, items in pending.items():
+            for index, cache_key, image in items:
+                try:
+                    futures[self.worker_pool.submit(image, preprocess, route)] = (index, cache_key)
+                except Exception as e:
+                    yield index, dict(new_result(image_paths[index]), error=str(e))
+        
+        # 工作池保证每个任务在提交后 result_timeout 秒内完成；等待时再留出监控线程的检查间隔，
+        # 超过仍没有任何任务完成时视为工作池异常，其余任务直接判为失败，不无限等待
+        timeout = self.worker_pool.result_timeout
+        remaining = set(futures)
+        while remaining:
+            done, remaining = wait(remaining, timeout=timeout + 5 if timeout else None,
+                                   return_when=FIRST_COMPLETED)
+            if not done:
+                for future in remaining:
+                    record_failure('inference')
+                    yield futures[future][0], dict(new_result(image_paths[futures[future][0]]),
+                                                   error='识别工作池超时未返回结果')
+                break
+            for future in done:
+                index, cache_key = futures[future]
+                result = new_result(image_paths[index])
+                try:
+                    cleaned_formula = future.result(timeout=0)
+                except Exception as e:
+                    record_failure('inference')
+                    result['error'] = str(e)
+                else:
+                    if cleaned_formula:
+                        self.cache.put(cache_key, cleaned_formula)
+                        result.update(formula=cleaned_formula, success=True)
+                    else:
+                        record_failure('empty_result')
+                        result['error'] = '未识别到公式内容'
+                yield index, result
+    
+    def _prepare_batch_item(self, item, preprocess: bool, to_model: bool = True,
+                            route: Optional[str] = None):
+        """
+        准备批量识别中的单个输入
+        
+        Args:
+            item: 图片路径、原始字节或NumPy数组
+            preprocess: 是否进行预处理（参与缓存键计算）
+            to_model: 为True时在本进程预处理并转为PIL图片，否则返回解码后的原始数组
+            route: 请求指定的推理路由
+        
+        Returns:
+            (缓存键, PIL图片或原始数组, 缓存命中的公式, 错误信息, 自动裁剪决策, 路由决策)
+        """
+        try:
+            if isinstance(item, np.ndarray):
+                image = item
+            elif isinstance(item, (bytes, bytearray, memoryview)):
+                image = self.decode_image(bytes(item))
+            else:
+                image = self.load_image(item)
+            if image is None:
+                return None, None, None, '无法读取图片', None, None
+            
+            image, decisions = self.crop_to_formula(image)
+            routing = self.choose_route(image, route)
+            image = self.fit_to_route(image, decisions, routing)
+            cache_key = self.cache.image_key(image, preprocess, routing['route'])
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cache_key, None, cached, None, decisions, routing
+            if not to_model:
+                return cache_key, image, None, None, decisions, routing
+            
+            processed = image
+            if preprocess:
+                try:
+                    processed = self.preprocess_array(image)
+                except Exception as e:
+                    logger.error(f"图片预处理失败: {e}")  # 预处理失败时使用原图
+            return cache_key, self._to_pil(processed), None, None, decisions, routing
+        except Exception as e:
+            logger.error(f"批量识别准备失败: {e}")
+            return None, None, None, str(e), None, None
+    
+    def _recognize_batch(self, pil_images: list, route: str = 'formula') -> list:
+        """
+        一次模型前向识别多张公式图片（mixed 路由需要逐张做版面分析）
+        
+        Returns:
+            与输入等长的 (LaTeX, 错误信息) 列表
+        """
+        recognize_batch = getattr(self.p2t, 'recognize_formula', None)
+        if recognize_batch is not None and route == 'formula':
+            try:
+                outputs = recognize_batch(pil_images, batch_size=len(pil_images))
+                if not isinstance(outputs, list):
+                    outputs = [outputs]
+                if len(outputs) == len(pil_images):
+                    return [(self._extract_latex(output), None) for output in outputs]
+                logger.warning("批量识别返回数量不匹配，改为逐张识别")
+            except Exception as e:
+                logger.warning(f"批量识别失败，改为逐张识别: {e}")
+        
+        # 逐张识别（回退时可以把错误定位到具体图片）
         results = []
-        for path in image_paths:
-            result = self.recognize_formula(path)
-            results.append({
-                'image_path': path,
-                'formula': result,
-                'success': result is not None
-            })
+        for pil_image in pil_images:
+            try:
+                results.append((self._extract_latex(self.p2t.recognize(pil_image)), None))
+            except Exception as e:
+                logger.error(f"公式识别失败: {e}")
+                results.append((None, str(e)))
         return results
     
     def validate_formula(self, latex_formula: str) -> bool:
@@ -210,6 +818,22 @@ class FormulaRecognizer:
         return any(symbol in latex_formula for symbol in math_symbols)
 
 
+def _pix2text_version() -> str:
+    """读取已安装的pix2text版本（不导入包本身）"""
+    try:
+        from importlib.metadata import version
+        return version('pix2text')
+    except Exception:
+        return 'unknown'
+
+
+def _warmup_image() -> np.ndarray:
+    """生成内置的预热样例：白底黑字的简单公式"""
+    image = np.full((64, 256), 255, dtype=np.uint8)
+    cv2.putText(image, 'E=mc2', (20, 45), cv2.FONT_HERSHEY_SIMPLEX, 1.2, 0, 2, cv2.LINE_AA)
+    return image
+
+
 # 测试函数
 def test_recognizer():
     """测试识别器功能"""
@@ -0,0 +1,122 @@
+"""
+推理路由
+根据宽高比、墨迹密度、连通域数和文本行数，低成本地判断图片是单个公式还是图文混排，
+单个公式直接交给公式识别模型，只有混排内容才走完整的版面分析
+"""
+
+import os
+import cv2
+from typing import Optional
+from preprocess import Preprocessor, default_preprocessor
+
+# formula：直接调用公式识别模型；mixed：Pix2Text 完整流程（版面分析 + 文字/公式识别）
+ROUTES = ('formula', 'mixed')
+
+# 特征提取时图片缩小到此最长边以内
+FEATURE_MAX_SIDE = 512
+
+
+class InferenceRouter:
+    """推理路由分类器"""
+
+    # 连通域数超过此值时视为混排内容（一行普通文字就有几十个字符）
+    MAX_FORMULA_COMPONENTS = 150
+    # 文本行数不少于 MIXED_MIN_LINES 且平均每行连通域数不少于 MIN_COMPONENTS_PER_LINE 时视为混排内容
+    # （分数、上下标也会形成多条水平带，但每条带上的连通域比一行文字少得多）
+    MIXED_MIN_LINES = 3
+    MIN_COMPONENTS_PER_LINE = 25
+    # 墨迹密度高于此值时多为照片或噪声，连通域统计不可靠，按单个公式处理
+    MAX_RELIABLE_DENSITY = 0.35
+
+    def __init__(self, default_route: str = 'auto', preprocessor: Optional[Preprocessor] = None):
+        """
+        Args:
+            default_route: 请求未指定路由时的默认值（auto / formula / mixed）
+            preprocessor: 用于提取墨迹掩码的预处理引擎
+
+        Raises:
+            ValueError: 未知的路由
+        """
+        self.default_route = self.normalize(default_route)
+        self.preprocessor = preprocessor or default_preprocessor
+
+    @classmethod
+    def from_env(cls) -> 'InferenceRouter':
+        """根据环境变量创建路由器（RECOGNITION_ROUTE，默认 auto）"""
+        return cls(default_route=os.environ.get('RECOGNITION_ROUTE', 'auto'))
+
+    @staticmethod
+    def normalize(route: Optional[str]) -> str:
+        """
+        校验并规范化路由名称，None 视为 auto
+
+        Raises:
+            ValueError: 未知的路由
+        """
+        route = (route or 'auto').strip().lower()
+        if route != 'auto' and route not in ROUTES:
+            raise ValueError(f"未知的识别路由: {route}，可选 auto、{'、'.join(ROUTES)}")
+        return route
+
+    def features(self, image) -> dict:
+        """提取分类特征：宽高比、墨迹密度、连通域数、文本行数"""
+        height, width = image.shape[:2]
+        mask, _ = self.preprocessor.ink_mask(image, FEATURE_MAX_SIDE)
+        density = cv2.countNonZero(mask) / max(1, mask.size)
+        components = cv2.connectedComponents(mask, connectivity=8)[0] - 1
+
+        # 水平投影中被空白行隔开的墨迹带数，近似文本行数
+        rows = cv2.reduce(mask, 1, cv2.REDUCE_MAX).ravel() > 0
+        lines = int(rows[0]) + int((rows[1:] & ~rows[:-1]).sum()) if rows.size else 0
+
+        return {
+            'aspect_ratio': round(width / max(1, height), 3),
+            'ink_density': round(density, 4),
+            'components': int(components),
+            'lines': lines,
+        }
+
+    def classify(self, image) -> tuple:
+        """
+        判断图片应走的路由
+
+        Returns:
+            (路由, 特征字典)
+        """
+        features = self.features(image)
+        route = 'formula'
+        if features['ink_density'] <= self.MAX_RELIABLE_DENSITY:
+            if features['components'] > self.MAX_FORMULA_COMPONENTS:
+                route = 'mixed'
+            elif (features['lines'] >= self.MIXED_MIN_LINES
+                  and features['components'] >= self.MIN_COMPONENTS_PER_LINE * features['lines']):
+                route = 'mixed'
+        return route, features
+
+    def choose(self, image, requested: Optional[str] = None, available: tuple = ROUTES) -> dict:
+        """
+        选择本次识别的路由
+
+        Args:
+            image: 已裁剪的图片数组
+            requested: 请求指定的路由（auto / formula / mixed），为None时使用默认路由
+            available: 当前加载的模型支持的路由（formula-only 模式下只有 formula）
+
+        Returns:
+            路由决策字典：route、forced（是否由请求或配置指定），自动分类时还包含 features；
+            指定的路由不可用时包含 fallback_from
+
+        Raises:
+            ValueError: 未知的路由
+        """
+        requested = self.normalize(requested) if requested is not None else self.default_route
+        if requested == 'auto':
+            route, features = self.classify(image)
+            decision = {'route': route, 'forced': False, 'features': features}
+        else:
+            decision = {'route': requested, 'forced': True}
+
+        if decision['route'] not in available:
+            decision['fallback_from'] = decision['route']
+            decision['route'] = available[0]
+        return decision
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+端到端识别性能基准测试
+用 matplotlib mathtext 把LaTeX语料渲染为不同分辨率、不同噪声的PNG，
+测量识别各阶段（解码、预处理、推理、清理、转换）的耗时，
+以及 recognize_formula、batch_recognize 和HTTP接口在不同并发度下的吞吐量。
+HTTP接口通过Flask测试客户端在进程内调用，全程不访问网络，只使用CPU
+
+用法示例：
+    python scripts/bench_recognition.py                                  # 全部测试项
+    python scripts/bench_recognition.py --count 20 --dpi 100,200 --noise 0,20
+    python scripts/bench_recognition.py --targets stages,batch --concurrency 1,4
+    python scripts/bench_recognition.py --output recognition_report.json
+"""
+
+import os
+
+# 必须在导入识别/转换模块之前设置：关闭结果缓存（否则重复图片不经过模型），
+# 禁止模型下载和GPU，使用无界面的matplotlib后端
+os.environ['RECOGNITION_CACHE_SIZE'] = '0'
+os.environ['RECOGNITION_CACHE_DIR'] = ''
+os.environ['CONVERSION_CACHE_SIZE'] = '0'
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import argparse
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import CorpusGenerator, percentile
+
+# 识别阶段（按执行顺序）
+STAGES = ('decode', 'auto_crop', 'routing', 'preprocess', 'inference', 'cleanup', 'conversion')
+TARGETS = ('stages', 'recognize_formula', 'batch', 'http')
+
+
+def render_formula(latex, dpi, noise, rng, margin=12):
+    """
+    用 mathtext 渲染公式并编码为PNG
+
+    Args:
+        latex: LaTeX公式（mathtext 支持的子集）
+        dpi: 渲染分辨率
+        noise: 高斯噪声标准差（灰度级），0 表示不加噪声
+        rng: numpy 随机数生成器
+
+    Returns:
+        PNG字节，mathtext 无法渲染时返回None
+    """
+    from matplotlib import mathtext
+
+    buffer = io.BytesIO()
+    try:
+        mathtext.math_to_image(f'${latex}$', buffer, dpi=dpi, format='png')
+    except Exception:
+        return None
+
+    image = cv2.imdecode(np.frombuffer(buffer.getvalue(), dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+
+    # 加白边模拟截图，再叠加噪声
+    image = cv2.copyMakeBorder(image, margin, margin, margin, margin, cv2.BORDER_CONSTANT, value=255)
+    if noise > 0:
+        noisy = image.astype(np.float32) + rng.normal(0, noise, image.shape)
+        image = np.clip(noisy, 0, 255).astype(np.uint8)
+
+    ok, encoded = cv2.imencode('.png', image)
+    return encoded.tobytes() if ok else None
+
+
+def build_images(count, dpis, noises, seed):
+    """
+    生成测试图片：每条公式在每种分辨率和噪声下各渲染一张
+
+    Returns:
+        (图片列表 [{'latex', 'dpi', 'noise', 'png'}], 渲染失败数)
+    """
+    generator = CorpusGenerator(seed)
+    rng = np.random.default_rng(seed)
+    formulas = [generator.short() if index % 2 == 0 else generator.medium() for index in range(count)]
+
+    images = []
+    failures = 0
+    for latex in formulas:
+        for dpi in dpis:
+            for noise in noises:
+                png = render_formula(latex, dpi, noise, rng)
+                if png is None:
+                    failures += 1
+                    continue
+                images.append({'latex': latex, 'dpi': dpi, 'noise': noise, 'png': png})
+    return images, failures
+
+
+def summarize(latencies, wall_time, errors):
+    """汇总一组调用的吞吐量和延迟分位数（毫秒）"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'count': count,
+        'errors': errors,
+        'throughput_per_sec': round(count / wall_time, 2) if wall_time > 0 else 0.0,
+        'mean_ms': round(sum(latencies) / count * 1000, 2) if count else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_concurrent(func, items, concurrency):
+    """以给定并发度调用 func(item)（返回是否成功），统计吞吐量和单次延迟"""
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            ok = func(item)
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, items))
+    wall_time = time.perf_counter() - wall_start
+    return summarize([elapsed for elapsed, _ in outcomes], wall_time,
+                     sum(1 for _, ok in outcomes if not ok))
+
+
+def bench_stages(recognizer, converter, images):
+    """逐张图片分阶段计时（顺序执行，不经过缓存和工作池）"""
+    def run(item):
+        """返回 (各阶段耗时, 清理后的LaTeX)"""
+        clock = time.perf_counter
+        start = clock()
+        image = recognizer.decode_image(item['png'])
+        decoded = clock()
+        image, _ = recognizer.crop_to_formula(image)
+        cropped = clock()
+        route = recognizer.router.choose(image, available=recognizer.available_routes)['route']
+        routed = clock()
+        processed = recognizer.preprocess_array(image)
+        preprocessed = clock()
+        try:
+            raw = recognizer._infer(recognizer._to_pil(processed), route)
+        except Exception:
+            raw = ''
+        inferred = clock()
+        latex = recognizer._clean_latex_formula(raw)
+        cleaned = clock()
+        if latex:
+            converter.convert_formula(latex, ('latex', 'mathml_word_compatible'))
+        converted = clock()
+        return (decoded - start, cropped - decoded, routed - cropped, preprocessed - routed, inferred - preprocessed,
+                cleaned - inferred, converted - cleaned), latex
+
+    # 预热：OpenCV、转换器等首次调用有初始化开销
+    run(images[0])
+
+    timings = {stage: [] for stage in STAGES}
+    errors = 0
+    matched = 0
+    for item in images:
+        elapsed, latex = run(item)
+        for stage, value in zip(STAGES, elapsed):
+            timings[stage].append(value)
+        if not latex:
+            errors += 1
+        elif latex.replace(' ', '') == item['latex'].replace(' ', ''):
+            matched += 1
+
+    total = sum(sum(values) for values in timings.values())
+    result = {'count': len(images), 'errors': errors, 'exact_matches': matched, 'stages': {}}
+    for stage, values in timings.items():
+        values.sort()
+        result['stages'][stage] = {
+            'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'share': round(sum(values) / total, 3) if total > 0 else 0.0,
+        }
+    return result
+
+
+def bench_recognize_formula(recognizer, images, concurrency_levels):
+    """从文件路径调用 recognize_formula，测量不同并发度"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bench_recognition_') as directory:
+        paths = []
+        for index, item in enumerate(images):
+            path = os.path.join(directory, f'formula_{index:05d}.png')
+            with open(path, 'wb') as f:
+                f.write(item['png'])
+            paths.append(path)
+
+        for concurrency in concurrency_levels:
+            print(f"⏱️  recognize_formula 并发 {concurrency}...", flush=True)
+            results[str(concurrency)] = run_concurrent(
+                lambda path: bool(recognizer.recognize_formula(path)), paths, concurrency)
+    return results
+
+
+def bench_batch(recognizer, images, batch_sizes):
+    """用原始字节调用 batch_recognize，测量不同模型批大小"""
+    results = {}
+    payloads = [item['png'] for item in images]
+    for batch_size in batch_sizes:
+        print(f"⏱️  batch_recognize 批大小 {batch_size}...", flush=True)
+        start = time.perf_counter()
+        outcomes = recognizer.batch_recognize(payloads, batch_size=batch_size)
+        wall_time = time.perf_counter() - start
+        results[str(batch_size)] = {
+            'count': len(outcomes),
+            'errors': sum(1 for outcome in outcomes if not outcome['success']),
+            'throughput_per_sec': round(len(outcomes) / wall_time, 2) if wall_time > 0 else 0.0,
+            'wall_s': round(wall_time, 3),
+        }
+    return results
+
+
+def bench_http(app_module, images, concurrency_levels):
+    """通过Flask测试客户端调用 /upload 和 /api/batch/recognize（进程内，不经过网络）"""
+    # 基准测试需要短时间内发出大量请求，放开本进程内的速率限制
+    app_module.RATE_LIMIT_MAX_REQUESTS = float('inf')
+    flask_app = app_module.app
+
+    def upload(item):
+        client = flask_app.test_client()
+        response = client.post('/upload', data={'file': (io.BytesIO(item['png']), 'formula.png')},
+                               content_type='multipart/form-data')
+        return response.status_code == 200 and response.get_json().get('success', False)
+
+    results = {'upload': {}}
+    for concurrency in concurrency_levels:
+        print(f"⏱️  POST /upload 并发 {concurrency}...", flush=True)
+        results['upload'][str(concurrency)] = run_concurrent(upload, images, concurrency)
+
+    print("⏱️  POST /api/batch/recognize...", flush=True)
+    client = flask_app.test_client()
+    chunk_size = app_module.BATCH_RECOGNIZE_MAX_ITEMS
+    succeeded = 0
+    start = time.perf_counter()
+    for offset in range(0, len(images), chunk_size):
+        chunk = images[offset:offset + chunk_size]
+        files = [(io.BytesIO(item['png']), f'formula_{index}.png') for index, item in enumerate(chunk)]
+        response = client.post('/api/batch/recognize', data={'files': files},
+                               content_type='multipart/form-data')
+        for line in response.get_data(as_text=True).splitlines():
+            record = json.loads(line)
+            if record.get('done'):
+                succeeded += record.get('succeeded', 0)
+    wall_time = time.perf_counter() - start
+    results['batch'] = {
+        'count': len(images),
+        'errors': len(images) - succeeded,
+        'throughput_per_sec': round(len(images) / wall_time, 2) if wall_time > 0 else 0.0,
+        'wall_s': round(wall_time, 3),
+    }
+    return results
+
+
+def parse_list(value, cast):
+    """解析逗号分隔的参数"""
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def print_summary(report):
+    """打印结果"""
+    results = report['results']
+    stages = results.get('stages')
+    if stages:
+        print(f"\n📊 分阶段耗时（{stages['count']} 张，识别失败 {stages['errors']}，"
+              f"与原公式完全一致 {stages['exact_matches']}）")
+        print(f"   {'阶段':<12} {'平均(ms)':>10} {'p50(ms)':>10} {'p99(ms)':>10} {'占比':>7}")
+        for stage, m in stages['stages'].items():
+            print(f"   {stage:<12} {m['mean_ms']:>10.3f} {m['p50_ms']:>10.3f} {m['p99_ms']:>10.3f} "
+                  f"{m['share']:>7.1%}")
+
+    for title, levels in (('recognize_formula', results.get('recognize_formula')),
+                          ('POST /upload', (results.get('http') or {}).get('upload'))):
+        if not levels:
+            continue
+        print(f"\n📊 {title}")
+        print(f"   {'并发':>4} {'张/秒':>10} {'p50(ms)':>10} {'p99(ms)':>10} {'失败':>6}")
+        for concurrency, m in levels.items():
+            print(f"   {concurrency:>4} {m['throughput_per_sec']:>10.2f} {m['p50_ms']:>10.2f} "
+                  f"{m['p99_ms']:>10.2f} {m['errors']:>6}")
+
+    for batch_size, m in (results.get('batch') or {}).items():
+        print(f"\n📊 batch_recognize 批大小 {batch_size}: {m['throughput_per_sec']:.2f} 张/秒，失败 {m['errors']}")
+    http_batch = (results.get('http') or {}).get('batch')
+    if http_batch:
+        print(f"\n📊 POST /api/batch/recognize: {http_batch['throughput_per_sec']:.2f} 张/秒，"
+              f"失败 {http_batch['errors']}")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='端到端公式识别性能基准测试')
+    parser.add_argument('--count', type=int, default=30, help='渲染的公式条数')
+    parser.add_argument('--dpi', default='100,200', help='逗号分隔的渲染分辨率')
+    parser.add_argument('--noise', default='0,20', help='逗号分隔的高斯噪声标准差（灰度级）')
+    parser.add_argument('--seed', type=int, default=0, help='语料和噪声的随机种子')
+    parser.add_argument('--targets', default=','.join(TARGETS),
+                        help=f"逗号分隔的测试项（{' / '.join(TARGETS)}）")
+    parser.add_argument('--concurrency', default='1,2,4', help='逗号分隔的并发度')
+    parser.add_argument('--batch-sizes', default='1,8', help='batch_recognize 的逗号分隔模型批大小')
+    parser.add_argument('--output', help='JSON报告输出路径')
+    args = parser.parse_args()
+
+    targets = parse_list(args.targets, str.strip)
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"未知的测试项: {', '.join(sorted(unknown))}")
+    concurrency_levels = parse_list(args.concurrency, int)
+
+    print("=" * 60)
+    print("端到端识别性能基准测试")
+    print("=" * 60)
+
+    images, render_failures = build_images(args.count, parse_list(args.dpi, int),
+                                           parse_list(args.noise, float), args.seed)
+    print(f"🖼️  渲染 {len(images)} 张图片（mathtext 无法渲染 {render_failures} 张）")
+    if not images:
+        print("❌ 没有可用的测试图片")
+        sys.exit(1)
+
+    from converter import FormulaConverter
+    from recognizer import FormulaRecognizer
+
+    app_module = None
+    if 'http' in targets:
+        # 导入app会在后台加载模型（按环境变量决定是否使用多进程工作池）
+        import app as app_module
+
+    started = time.perf_counter()
+    print("⏳ 等待识别模型加载（需已下载到本地）...", flush=True)
+    if app_module is not None and app_module.recognizer.worker_pool is None:
+        # 直接测试复用app中的本进程识别器，避免重复加载模型
+        recognizer, converter = app_module.recognizer, app_module.converter
+        recognizer.wait_until_ready()
+    else:
+        # 在主线程中加载并预热，计时开始前模型已完成惰性初始化
+        recognizer, converter = FormulaRecognizer(load_model=False), FormulaConverter()
+        if recognizer.load_model():
+            recognizer.warm_up()
+    if not recognizer.ready or (app_module is not None and not app_module.recognizer.wait_until_ready()):
+        print(f"❌ 识别模型不可用: {recognizer.load_error}")
+        sys.exit(1)
+    load_time = time.perf_counter() - started
+    print(f"✅ 模型就绪，耗时 {load_time:.2f}s")
+
+    results = {}
+    if 'stages' in targets:
+        print("⏱️  分阶段计时...", flush=True)
+        results['stages'] = bench_stages(recognizer, converter, images)
+    if 'recognize_formula' in targets:
+        results['recognize_formula'] = bench_recognize_formula(recognizer, images, concurrency_levels)
+    if 'batch' in targets:
+        results['batch'] = bench_batch(recognizer, images, parse_list(args.batch_sizes, int))
+    if 'http' in targets:
+        results['http'] = bench_http(app_module, images, concurrency_levels)
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'model_version': recognizer.model_version,
+            'model_load_s': round(load_time, 2),
+            'seed': args.seed,
+        },
+        'images': {
+            'count': len(images),
+            'formulas': args.count,
+            'dpi': parse_list(args.dpi, int),
+            'noise': parse_list(args.noise, float),
+            'render_failures': render_failures,
+        },
+        'results': results,
+    }
+    print_summary(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 报告已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
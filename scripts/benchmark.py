@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+转换性能基准测试
+按公式规模分桶生成可复现的LaTeX语料，分别测量各转换后端的吞吐量、延迟分位数和峰值内存，
+输出JSON报告，并可与保存的基线报告对比以发现性能回退
+
+用法示例：
+    python scripts/benchmark.py                                  # 全部后端，打印结果
+    python scripts/benchmark.py --output report.json             # 保存报告
+    python scripts/benchmark.py --baseline report.json           # 与基线对比，回退时退出码为1
+    python scripts/benchmark.py --backends word --size 2000      # 只测自定义转换器
+    python scripts/benchmark.py --dump-corpus corpus.json        # 导出语料
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 语料分桶：短行内公式、中等公式、多行长公式、深层嵌套公式
+BUCKETS = ('short', 'medium', 'long', 'nested')
+
+# 参与回退判断的指标：名称 → 是否越大越好
+GATED_METRICS = {'ops_per_sec': True, 'p50_us': False, 'peak_kib': False}
+# 计时指标受调度、频率调节等噪声影响，每轮样本数少于此值的分桶（如 SymPy 默认只测50条）
+# 不对吞吐量和延迟做回退判断，只判断峰值内存
+MIN_TIMED_SAMPLES = 200
+TIMED_METRICS = frozenset({'ops_per_sec', 'p50_us'})
+
+
+class CorpusGenerator:
+    """按固定随机种子生成LaTeX公式，相同种子生成相同语料"""
+
+    SYMBOLS = ['x', 'y', 'z', 'a', 'b', 'c', 'n', 'k', 't', 'r',
+               r'\alpha', r'\beta', r'\gamma', r'\theta', r'\lambda', r'\mu',
+               r'\pi', r'\sigma', r'\omega', r'\phi']
+    FUNCTIONS = [r'\sin', r'\cos', r'\tan', r'\log', r'\ln', r'\exp']
+    RELATIONS = ['=', r'\leq', r'\geq', r'\neq', r'\approx', '<', '>']
+    OPERATORS = ['+', '-', r'\cdot', r'\times', '']
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def atom(self):
+        """变量或数字"""
+        if self.random.random() < 0.3:
+            return str(self.random.randint(0, 99))
+        return self.random.choice(self.SYMBOLS)
+
+    def term(self, depth):
+        """单项；depth 为允许继续嵌套的层数"""
+        choice = self.random.randrange(10 if depth > 0 else 4)
+        if choice == 0:
+            return self.atom()
+        if choice == 1:
+            return f'{self.atom()}^{{{self.atom()}}}'
+        if choice == 2:
+            return f'{self.atom()}_{{{self.atom()}}}'
+        if choice == 3:
+            return f'{self.random.choice(self.FUNCTIONS)} {self.atom()}'
+        if choice == 4:
+            return rf'\frac{{{self.expression(depth - 1, 2)}}}{{{self.expression(depth - 1, 2)}}}'
+        if choice == 5:
+            return rf'\sqrt{{{self.expression(depth - 1, 2)}}}'
+        if choice == 6:
+            return f'({self.expression(depth - 1, 3)})^{{{self.atom()}}}'
+        if choice == 7:
+            return rf'\sum_{{i=1}}^{{n}} {self.term(depth - 1)}'
+        if choice == 8:
+            return rf'\int_{{0}}^{{1}} {self.term(depth - 1)} \, dx'
+        return f'{self.random.choice(self.FUNCTIONS)}({self.expression(depth - 1, 2)})'
+
+    def expression(self, depth, max_terms):
+        """若干项用运算符连接"""
+        terms = [self.term(depth) for _ in range(self.random.randint(1, max_terms))]
+        parts = [terms[0]]
+        for term in terms[1:]:
+            parts.append(self.random.choice(self.OPERATORS))
+            parts.append(term)
+        return ' '.join(part for part in parts if part)
+
+    def equation(self, depth, max_terms):
+        """关系式：左边 关系符 右边"""
+        return (f'{self.expression(depth, max_terms)} {self.random.choice(self.RELATIONS)} '
+                f'{self.expression(depth, max_terms)}')
+
+    def short(self):
+        return self.expression(0, 3)
+
+    def medium(self):
+        return self.equation(1, 3)
+
+    def long(self):
+        lines = [self.equation(1, 4) for _ in range(self.random.randint(3, 6))]
+        return r' \\ '.join(lines)
+
+    def nested(self):
+        formula = self.atom()
+        for _ in range(self.random.randint(8, 40)):
+            choice = self.random.randrange(4)
+            if choice == 0:
+                formula = rf'\frac{{{formula}}}{{{self.atom()}}}'
+            elif choice == 1:
+                formula = rf'\sqrt{{{formula} + {self.atom()}}}'
+            elif choice == 2:
+                formula = f'({formula})^{{{self.atom()}}}'
+            else:
+                formula = f'{self.atom()}^{{{formula}}}'
+        return formula
+
+    def build(self, size):
+        """生成语料：分桶名 → 公式列表"""
+        return {bucket: [getattr(self, bucket)() for _ in range(size)] for bucket in BUCKETS}
+
+
+def load_backends(names):
+    """
+    加载转换后端，未安装的后端跳过
+
+    Returns:
+        (后端名 → 转换函数, 不可用的后端名 → 原因)
+    """
+    backends = {}
+    unavailable = {}
+
+    if 'word' in names:
+        from final_converter import WordMathMLConverter
+        backends['word'] = WordMathMLConverter().convert
+
+    if 'latex2mathml' in names:
+        try:
+            from latex2mathml.converter import convert
+            backends['latex2mathml'] = convert
+        except ImportError as e:
+            unavailable['latex2mathml'] = str(e)
+
+    if 'sympy' in names:
+        try:
+            from sympy import mathml
+            from sympy.parsing.latex import parse_latex
+            backends['sympy'] = lambda formula: mathml(parse_latex(formula))
+        except ImportError as e:
+            unavailable['sympy'] = str(e)
+
+    return backends, unavailable
+
+
+def percentile(sorted_samples, fraction):
+    """最近秩分位数"""
+    if not sorted_samples:
+        return 0
+    index = min(len(sorted_samples) - 1, max(0, int(round(fraction * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def measure(func, formulas, repeat, warmup):
+    """
+    测量单个后端在一组公式上的性能
+
+    计时和内存分两遍测量：tracemalloc 会显著拖慢执行，不能与计时同时开启。
+    计时共 repeat 轮，每轮单独统计：吞吐量、均值和p50取最好的一轮（噪声只会让结果变差），
+    p99取各轮的中位数
+
+    Returns:
+        指标字典
+    """
+    for formula in formulas[:warmup]:
+        try:
+            func(formula)
+        except Exception:
+            pass
+
+    # 计时：每次调用单独计时，得到每一轮的延迟分布
+    rounds = []
+    errors = 0
+    for round_index in range(max(1, repeat)):
+        samples = []
+        gc.collect()
+        round_start = time.perf_counter()
+        for formula in formulas:
+            start = time.perf_counter_ns()
+            try:
+                func(formula)
+            except Exception:
+                if round_index == 0:
+                    errors += 1
+            samples.append(time.perf_counter_ns() - start)
+        total = time.perf_counter() - round_start
+        samples.sort()
+        rounds.append({
+            'ops_per_sec': len(samples) / total if total > 0 else 0.0,
+            'mean_us': sum(samples) / len(samples) / 1000 if samples else 0.0,
+            'p50_us': percentile(samples, 0.50) / 1000,
+            'p99_us': percentile(samples, 0.99) / 1000,
+        })
+
+    # 内存：单次转换的峰值内存，取最大值
+    peak = 0
+    tracemalloc.start()
+    try:
+        for formula in formulas:
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            try:
+                func(formula)
+            except Exception:
+                pass
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    p99s = sorted(item['p99_us'] for item in rounds)
+    return {
+        'count': len(formulas),
+        'errors': errors,
+        'ops_per_sec': round(max(item['ops_per_sec'] for item in rounds), 1),
+        'mean_us': round(min(item['mean_us'] for item in rounds), 2),
+        'p50_us': round(min(item['p50_us'] for item in rounds), 2),
+        'p99_us': round(p99s[len(p99s) // 2], 2),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def run_benchmark(corpus, backends, repeat, warmup, limits):
+    """
+    对每个后端、每个分桶运行基准测试
+
+    Args:
+        corpus: 分桶名 → 公式列表
+        backends: 后端名 → 转换函数
+        repeat: 计时轮数
+        warmup: 预热公式数
+        limits: 后端名 → 每个分桶最多测量的公式数（较慢的后端）
+
+    Returns:
+        后端名 → 分桶名 → 指标字典
+    """
+    results = {}
+    for name, func in backends.items():
+        results[name] = {}
+        for bucket, formulas in corpus.items():
+            limit = limits.get(name)
+            if limit:
+                formulas = formulas[:limit]
+            print(f"⏱️  {name:<13} {bucket:<7} ({len(formulas)} 条)...", flush=True)
+            results[name][bucket] = measure(func, formulas, repeat, warmup)
+    return results
+
+
+def corpus_stats(corpus):
+    """语料概况：每个分桶的条数和平均长度"""
+    return {
+        bucket: {
+            'count': len(formulas),
+            'mean_length': round(sum(map(len, formulas)) / len(formulas), 1) if formulas else 0.0,
+        }
+        for bucket, formulas in corpus.items()
+    }
+
+
+def compare_reports(report, baseline, threshold):
+    """
+    与基线报告对比
+
+    Args:
+        report: 本次报告
+        baseline: 基线报告
+        threshold: 允许的相对变差比例（如 0.25 表示 25%）
+
+    Returns:
+        回退列表，每项为 (后端, 分桶, 指标, 基线值, 本次值)；
+        样本数少于 MIN_TIMED_SAMPLES 的分桶不判断计时指标
+    """
+    regressions = []
+    for backend, buckets in report['results'].items():
+        for bucket, metrics in buckets.items():
+            base = baseline.get('results', {}).get(backend, {}).get(bucket)
+            if not base:
+                continue
+            timed = min(metrics.get('count', 0), base.get('count', 0)) >= MIN_TIMED_SAMPLES
+            for metric, higher_is_better in GATED_METRICS.items():
+                if metric in TIMED_METRICS and not timed:
+                    continue
+                old, new = base.get(metric), metrics.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                    regressions.append((backend, bucket, metric, old, new))
+    return regressions
+
+
+def print_results(report, baseline=None):
+    """打印结果表格，有基线时附带相对变化"""
+    header = f"{'后端':<13} {'分桶':<7} {'条数':>5} {'错误':>5} {'ops/s':>10} {'p50(µs)':>10} {'p99(µs)':>10} {'峰值(KiB)':>10}"
+    print("\n" + header)
+    print("-" * len(header))
+    for backend, buckets in report['results'].items():
+        for bucket, m in buckets.items():
+            line = (f"{backend:<13} {bucket:<7} {m['count']:>5} {m['errors']:>5} {m['ops_per_sec']:>10.1f} "
+                    f"{m['p50_us']:>10.2f} {m['p99_us']:>10.2f} {m['peak_kib']:>10.1f}")
+            base = (baseline or {}).get('results', {}).get(backend, {}).get(bucket)
+            if base and base.get('ops_per_sec'):
+                line += f"   ops/s {(m['ops_per_sec'] / base['ops_per_sec'] - 1) * 100:+.1f}%"
+            print(line)
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='LaTeX → MathML 转换性能基准测试')
+    parser.add_argument('--backends', default='word,latex2mathml,sympy',
+                        help='逗号分隔的后端列表（word / latex2mathml / sympy）')
+    parser.add_argument('--size', type=int, default=1000, help='每个分桶生成的公式数')
+    parser.add_argument('--seed', type=int, default=0, help='语料随机种子')
+    parser.add_argument('--corpus', help='从JSON文件读取语料（分桶名 → 公式列表），代替生成')
+    parser.add_argument('--dump-corpus', help='把语料写入JSON文件后退出')
+    parser.add_argument('--repeat', type=int, default=5, help='计时轮数（各指标取最好的一轮）')
+    parser.add_argument('--warmup', type=int, default=50, help='每个分桶预热的公式数')
+    parser.add_argument('--sympy-limit', type=int, default=50,
+                        help='SymPy 后端每个分桶最多测量的公式数（0 表示不限制）')
+    parser.add_argument('--output', help='JSON报告输出路径')
+    parser.add_argument('--baseline', help='基线报告路径，指标变差超过阈值时退出码为1')
+    parser.add_argument('--threshold', type=float, default=0.25, help='允许的相对变差比例')
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            corpus = json.load(f)
+    else:
+        corpus = CorpusGenerator(args.seed).build(args.size)
+
+    if args.dump_corpus:
+        with open(args.dump_corpus, 'w', encoding='utf-8') as f:
+            json.dump(corpus, f, ensure_ascii=False, indent=1)
+        print(f"✅ 语料已写入 {args.dump_corpus}")
+        return
+
+    names = [name.strip() for name in args.backends.split(',') if name.strip()]
+    backends, unavailable = load_backends(names)
+    for name, reason in unavailable.items():
+        print(f"⚠️  后端 {name} 不可用，已跳过: {reason}")
+    if not backends:
+        print("❌ 没有可用的转换后端")
+        sys.exit(1)
+
+    print("=" * 60)
+    print("转换性能基准测试")
+    print("=" * 60)
+    for bucket, stats in corpus_stats(corpus).items():
+        print(f"📚 {bucket:<7} {stats['count']} 条，平均长度 {stats['mean_length']} 字符")
+
+    results = run_benchmark(corpus, backends, args.repeat, args.warmup,
+                            {'sympy': args.sympy_limit})
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': None if args.corpus else args.seed,
+            'size': None if args.corpus else args.size,
+            'repeat': args.repeat,
+        },
+        'corpus': corpus_stats(corpus),
+        'unavailable': unavailable,
+        'results': results,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print_results(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 报告已写入 {args.output}")
+
+    if baseline is not None:
+        base_meta = baseline.get('meta', {})
+        if base_meta.get('python') != report['meta']['python']:
+            print("⚠️  基线报告的Python版本不同，对比结果仅供参考")
+        if (base_meta.get('seed'), base_meta.get('size')) != (report['meta']['seed'], report['meta']['size']):
+            print("⚠️  基线报告的语料参数（--seed / --size）不同，对比结果仅供参考")
+        untimed = [f"{backend}/{bucket}" for backend, buckets in report['results'].items()
+                   for bucket, metrics in buckets.items() if metrics['count'] < MIN_TIMED_SAMPLES]
+        if untimed:
+            print(f"ℹ️  样本数少于 {MIN_TIMED_SAMPLES} 的分桶只判断峰值内存: {', '.join(untimed)}")
+        regressions = compare_reports(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ 发现 {len(regressions)} 项性能回退（阈值 {args.threshold:.0%}）:")
+            for backend, bucket, metric, old, new in regressions:
+                print(f"   {backend} / {bucket} / {metric}: {old} → {new}")
+            sys.exit(1)
+        print(f"\n✅ 未发现超过 {args.threshold:.0%} 的性能回退")
+
+
+if __name__ == '__main__':
+    main()
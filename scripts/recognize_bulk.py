@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线批量识别（recognize-bulk）
+不经过HTTP服务，直接遍历图片目录或清单文件（每行一个图片路径），
+在多进程工作池中识别公式（每个进程只加载一次模型），由解码线程提前读取并解码后续图片，
+结果（LaTeX、Word兼容MathML）按输入顺序写入分片的JSONL文件。
+
+输出目录中的 checkpoint.json 记录已写入的条数、最后一条记录的路径和当前分片的字节偏移，
+进程被中断或强制结束后用相同的参数重新运行即可从断点继续，已写入的结果不会重复识别；
+续跑前会核对输入中对应位置的路径，目录或清单在两次运行之间有增删时拒绝续跑。
+运行期间在标准错误输出实时显示进度、吞吐量和预计剩余时间
+
+用法示例：
+    python scripts/recognize_bulk.py ./images -o ./out                    # 遍历目录（含子目录）
+    python scripts/recognize_bulk.py manifest.txt -o ./out --workers 8    # 清单文件，8个工作进程
+    python scripts/recognize_bulk.py ./images -o ./out --shard-size 50000 --route formula
+    python scripts/recognize_bulk.py ./images -o ./out --restart          # 丢弃已有结果重新开始
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 遍历目录时识别的图片扩展名（与 app.py 的上传白名单一致）
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+
+CHECKPOINT_NAME = 'checkpoint.json'
+CHECKPOINT_VERSION = 2
+SHARD_PATTERN = 'results-{:05d}.jsonl'
+SHARD_NAME = re.compile(r'^results-(\d+)\.jsonl$')
+
+
+def iter_directory(root: str):
+    """
+    递归遍历目录中的图片，按路径排序保证每次运行的顺序一致（断点续跑依赖此顺序）
+
+    Yields:
+        (相对于 root 的路径, 绝对路径)
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            logging.getLogger(__name__).error(f"无法读取目录: {directory}, {e}")
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.relpath(entry.path, root), entry.path
+        # 倒序入栈，出栈时按名称顺序深度优先
+        stack.extend(reversed(subdirectories))
+
+
+def iter_manifest(manifest: str):
+    """
+    逐行读取清单文件（空行和以 # 开头的行忽略），相对路径相对于清单所在目录
+
+    Yields:
+        (清单中的路径, 绝对路径)
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, 'r', encoding='utf-8') as f:
+        for line in f:
+            path = line.strip()
+            if path and not path.startswith('#'):
+                yield path, os.path.join(base, path)
+
+
+def iter_inputs(source: str):
+    """目录或清单文件中的图片"""
+    return iter_directory(source) if os.path.isdir(source) else iter_manifest(source)
+
+
+def input_path_at(source: str, index: int) -> Optional[str]:
+    """输入中第 index 项的记录路径，输入不足 index + 1 项时返回None"""
+    for position, (path, _) in enumerate(iter_inputs(source)):
+        if position == index:
+            return path
+    return None
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    """秒数格式化为 H:MM:SS，未知时返回 --:--:--"""
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class ShardWriter:
+    """
+    分片JSONL写入器
+    每个分片最多 shard_size 条记录，记录按输入顺序追加；
+    checkpoint 只在分片内容落盘后更新，恢复时把当前分片截断到检查点记录的偏移
+    """
+
+    def __init__(self, output_dir: str, shard_size: int):
+        self.output_dir = output_dir
+        self.shard_size = max(1, shard_size)
+        self.shard = 0
+        self.shard_records = 0
+        self._file = None
+
+    def resume(self, shard: int, offset: int, shard_records: int):
+        """
+        从检查点恢复：截断当前分片，删除检查点之后才创建的分片
+
+        Raises:
+            ValueError: 当前分片缺失或短于检查点记录的偏移（结果文件与检查点不一致）
+        """
+        path = self._path(shard)
+        size = os.path.getsize(path) if os.path.exists(path) else None
+        if offset and (size is None or size < offset):
+            raise ValueError(f"分片 {path} 缺失或短于检查点记录的 {offset} 字节")
+        self.shard = shard
+        self.shard_records = shard_records
+        self._file = open(path, 'w+b' if size is None else 'r+b')
+        self._file.truncate(offset)
+        self._file.seek(offset)
+
+        for name in os.listdir(self.output_dir):
+            match = SHARD_NAME.match(name)
+            if match and int(match.group(1)) > shard:
+                os.remove(os.path.join(self.output_dir, name))
+
+    def write(self, record: dict):
+        """追加一条记录，当前分片写满时切换到下一个分片"""
+        if self._file is None:
+            self._file = open(self._path(self.shard), 'wb')
+        elif self.shard_records >= self.shard_size:
+            self._file.close()
+            self.shard += 1
+            self.shard_records = 0
+            self._file = open(self._path(self.shard), 'wb')
+        self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.shard_records += 1
+
+    def sync(self) -> dict:
+        """把已写入的记录落盘，返回检查点中的分片状态"""
+        if self._file is None:
+            return {'shard': self.shard, 'shard_offset': 0, 'shard_records': 0}
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {'shard': self.shard, 'shard_offset': self._file.tell(), 'shard_records': self.shard_records}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _path(self, shard: int) -> str:
+        return os.path.join(self.output_dir, SHARD_PATTERN.format(shard))
+
+
+class Checkpoint:
+    """检查点文件，先写临时文件再原子替换，进程在任何时刻被结束都不会留下半个检查点"""
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, CHECKPOINT_NAME)
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, state: dict):
+        state = dict(state, version=CHECKPOINT_VERSION, updated_at=datetime.now().isoformat(timespec='seconds'))
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+class Progress:
+    """进度统计：本次运行的吞吐量取最近 window 秒的滑动平均，据此估计剩余时间"""
+
+    def __init__(self, done: int = 0, succeeded: int = 0, failed: int = 0, window: float = 30.0):
+        self.done = done
+        self.succeeded = succeeded
+        self.failed = failed
+        self.total = None
+        self.window = window
+        self.started = time.time()
+        self._initial = done
+        self._samples = deque([(self.started, done)])
+
+    def add(self, success: bool):
+        self.done += 1
+        if success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    def rate(self) -> float:
+        """最近 window 秒内每秒完成的图片数"""
+        now = time.time()
+        self._samples.append((now, self.done))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+        first_time, first_done = self._samples[0]
+        elapsed = now - first_time
+        return (self.done - first_done) / elapsed if elapsed > 0 else 0.0
+
+    def line(self) -> str:
+        rate = self.rate()
+        if self.total is not None:
+            remaining = max(0, self.total - self.done)
+            eta = remaining / rate if rate > 0 else None
+            position = f"{self.done}/{self.total} ({self.done / max(1, self.total):.1%})"
+        else:
+            eta = None
+            position = f"{self.done}/?"
+        return (f"已处理 {position}  成功 {self.succeeded}  失败 {self.failed}  "
+                f"{rate:.1f} 张/秒  已用 {format_duration(time.time() - self.started)}  "
+                f"剩余 {format_duration(eta)}")
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.started
+        processed = self.done - self._initial
+        return (f"本次处理 {processed} 张，耗时 {format_duration(elapsed)}，"
+                f"平均 {processed / elapsed if elapsed > 0 else 0:.1f} 张/秒；"
+                f"累计 {self.done} 张（成功 {self.succeeded}，失败 {self.failed}）")
+
+
+class BulkRecognizer:
+    """在解码线程中读取图片并提交给识别器，按输入顺序产出结果记录"""
+
+    def __init__(self, recognizer, converter, outputs, route: Optional[str] = None,
+                 preprocess: bool = True, threads: int = 4, prefetch: int = 64):
+        """
+        Args:
+            recognizer: FormulaRecognizer（使用工作池时只负责解码、裁剪和路由）
+            converter: FormulaConverter
+            outputs: 需要的输出格式（见 FormulaConverter.normalize_outputs）
+            route: 推理路由（auto / formula / mixed），None 使用 RECOGNITION_ROUTE
+            preprocess: 是否进行预处理
+            threads: 解码线程数
+            prefetch: 最多提前提交的图片数（在途结果的内存上限）
+        """
+        self.recognizer = recognizer
+        self.converter = converter
+        self.outputs = converter.normalize_outputs(outputs)
+        self.route = route
+        self.preprocess = preprocess
+        self.threads = max(1, threads)
+        self.prefetch = max(self.threads, prefetch)
+        self.stopping = threading.Event()
+
+    def process(self, index: int, path: str, full_path: str) -> dict:
+        """识别一张图片并转换，失败时记录 error 而不抛出"""
+        record = {'index': index, 'path': path, 'success': False}
+        image = self.recognizer.load_image(full_path)
+        if image is None:
+            record['error'] = '无法读取或解码图片'
+            return record
+
+        details = {}
+        try:
+            latex_formula = self.recognizer.recognize_image(image, self.preprocess, details, self.route)
+        except Exception as e:
+            record['error'] = f'公式识别失败: {e}'
+            return record
+        record['route'] = details.get('route', {}).get('route')
+        if not latex_formula:
+            record['error'] = '未识别出公式'
+            return record
+
+        try:
+            result = self.converter.convert_formula(latex_formula, self.outputs)
+        except Exception as e:
+            record['latex'] = latex_formula
+            record['error'] = f'公式转换失败: {e}'
+            return record
+        record.update({key: result.get(key, '') for key in sorted(self.outputs)})
+        record['success'] = True
+        return record
+
+    def run(self, inputs, start: int = 0):
+        """
+        按输入顺序产出结果记录
+
+        Args:
+            inputs: (记录路径, 绝对路径) 的可迭代对象
+            start: 起始序号（跳过前 start 项，断点续跑时使用）
+
+        Yields:
+            结果记录字典
+        """
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='bulk-decode')
+        try:
+            index = 0
+            for index, (path, full_path) in enumerate(inputs):
+                if index < start:
+                    continue
+                if self.stopping.is_set():
+                    break
+                pending.append(executor.submit(self.process, index, path, full_path))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending and not self.stopping.is_set():
+                yield pending.popleft().result()
+        finally:
+            # 中断时未开始的任务直接取消，已开始的等待结束（其结果不会写入，续跑时重新识别）
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+def count_inputs(source: str, progress: Progress):
+    """后台统计输入总数，用于显示进度百分比和剩余时间"""
+    total = 0
+    for _ in iter_inputs(source):
+        total += 1
+    progress.total = total
+
+
+def report_progress(progress: Progress, interval: float, stop: threading.Event):
+    """定期把进度写到标准错误输出（终端中原地刷新，重定向到文件时逐行输出）"""
+    interactive = sys.stderr.isatty()
+    while not stop.wait(interval):
+        if interactive:
+            sys.stderr.write('\r\033[K' + progress.line())
+        else:
+            sys.stderr.write(progress.line() + '\n')
+        sys.stderr.flush()
+    if interactive:
+        sys.stderr.write('\r\033[K')
+
+
+def wait_for_pool(pool, timeout: float) -> bool:
+    """等待工作池中至少一个进程加载完模型；所有进程都加载失败时立即返回"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if pool.ready:
+            return True
+        if pool.failed:
+            return False
+        time.sleep(0.2)
+    return pool.ready
+
+
+def build_state(args, outputs) -> dict:
+    """检查点中用于校验续跑参数的部分"""
+    return {
+        'source': os.path.abspath(args.input),
+        'outputs': sorted(outputs),
+        'route': args.route,
+        'preprocess': not args.no_preprocess,
+        'shard_size': args.shard_size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线批量识别公式图片，结果写入分片JSONL，支持断点续跑')
+    parser.add_argument('input', help='图片目录（递归遍历）或清单文件（每行一个图片路径）')
+    parser.add_argument('-o', '--output', required=True, help='输出目录（分片结果和检查点）')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='识别工作进程数，每个进程加载一份模型（默认物理核心数，0 表示在本进程中识别）')
+    parser.add_argument('--threads', type=int, default=None, help='解码线程数（默认工作进程数的2倍）')
+    parser.add_argument('--prefetch', type=int, default=None, help='最多提前提交的图片数（默认工作进程数的8倍）')
+    parser.add_argument('--outputs', default='latex,mathml_word_compatible',
+                        help='输出格式，逗号分隔（latex、mathml、mathml_word_compatible）')
+    parser.add_argument('--route', default=None, help='推理路由（auto、formula、mixed），默认读取 RECOGNITION_ROUTE')
+    parser.add_argument('--load-mode', default=None, help='模型加载模式（mixed、formula-only），默认读取 RECOGNITION_LOAD_MODE')
+    parser.add_argument('--no-preprocess', action='store_true', help='跳过识别前的预处理')
+    parser.add_argument('--shard-size', type=int, default=100000, help='每个分片的记录数')
+    parser.add_argument('--checkpoint-interval', type=float, default=10.0, help='检查点的最长保存间隔（秒）')
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='进度刷新间隔（秒）')
+    parser.add_argument('--no-count', action='store_true', help='不预先统计输入总数（不显示百分比和剩余时间）')
+    parser.add_argument('--restart', action='store_true', help='忽略已有的检查点和结果，从头开始')
+    parser.add_argument('--verbose', action='store_true', help='输出逐张图片的识别日志')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        parser.error(f"输入不存在: {args.input}")
+    if args.load_mode:
+        # 工作进程按环境变量加载模型，必须在创建工作池之前设置
+        os.environ['RECOGNITION_LOAD_MODE'] = args.load_mode
+
+    from converter import FormulaConverter
+    from recognizer import FormulaRecognizer
+    from routing import InferenceRouter
+    from worker_pool import RecognitionWorkerPool, physical_cpu_count
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        outputs = FormulaConverter.normalize_outputs(args.outputs)
+        if args.route is not None:
+            args.route = InferenceRouter.normalize(args.route)
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint = Checkpoint(args.output)
+    writer = ShardWriter(args.output, args.shard_size)
+    state = build_state(args, outputs)
+    saved = None if args.restart else checkpoint.load()
+    if saved is not None:
+        mismatched = [key for key in state if saved.get(key) != state[key]]
+        if mismatched:
+            print(f"❌ 输出目录中的检查点与本次参数不一致（{', '.join(mismatched)}），"
+                  f"请换一个输出目录或加 --restart 重新开始", file=sys.stderr)
+            return 2
+        if saved.get('completed'):
+            print(f"✅ 已全部完成（{saved['next_index']} 张），无需重新运行", file=sys.stderr)
+            return 0
+        # 续跑按位置跳过已完成的输入：核对最后一条已写入记录的路径，输入有增删时位置会错开
+        if saved['next_index']:
+            actual = input_path_at(args.input, saved['next_index'] - 1)
+            if saved.get('last_path') is None or actual != saved['last_path']:
+                print(f"❌ 输入在上次运行后发生了变化：第 {saved['next_index']} 项应为 "
+                      f"{saved.get('last_path')}，实际为 {actual}，请加 --restart 重新开始", file=sys.stderr)
+                return 2
+        try:
+            writer.resume(saved['shard'], saved['shard_offset'], saved['shard_records'])
+        except ValueError as e:
+            print(f"❌ 无法从检查点继续: {e}，请加 --restart 重新开始", file=sys.stderr)
+            return 2
+        print(f"↻ 从检查点继续：跳过已完成的 {saved['next_index']} 张", file=sys.stderr)
+    else:
+        # 先写入从头开始的检查点再清理旧的分片：任何时刻被结束，下次运行都不会沿用旧的检查点
+        checkpoint.save(dict(state, next_index=0, succeeded=0, failed=0, completed=False, last_path=None,
+                             shard=0, shard_offset=0, shard_records=0))
+        writer.resume(0, 0, 0)
+
+    progress = Progress()
+    last_path = None
+    if saved is not None:
+        progress = Progress(saved['next_index'], saved['succeeded'], saved['failed'])
+        last_path = saved.get('last_path')
+
+    workers = physical_cpu_count() if args.workers is None else max(0, args.workers)
+    pool = None
+    if workers:
+        # 提交方由预读窗口限流，不需要工作池的背压超时
+        pool = RecognitionWorkerPool(workers=workers, submit_timeout=24 * 3600,
+                                     result_timeout=float(os.environ.get('RECOGNITION_POOL_RESULT_TIMEOUT', '120')))
+        print(f"⏳ 正在启动 {workers} 个识别进程...", file=sys.stderr)
+        if not wait_for_pool(pool, timeout=600):
+            print("❌ 识别进程未能加载模型", file=sys.stderr)
+            pool.shutdown()
+            return 1
+        recognizer = FormulaRecognizer(worker_pool=pool)
+    else:
+        recognizer = FormulaRecognizer()
+        if not recognizer.ready:
+            print(f"❌ 模型加载失败: {recognizer.load_error}", file=sys.stderr)
+            return 1
+
+    threads = args.threads or max(2, workers * 2)
+    prefetch = args.prefetch or max(threads * 2, workers * 8)
+    bulk = BulkRecognizer(recognizer, FormulaConverter(), outputs, args.route,
+                          not args.no_preprocess, threads, prefetch)
+
+    # Ctrl+C 或 SIGTERM：停止提交新图片，写完当前记录后保存检查点退出；
+    # 再次收到信号时立即退出，续跑时以上一次保存的检查点为准
+    def handle_signal(signum, frame):
+        if bulk.stopping.is_set():
+            raise KeyboardInterrupt
+        bulk.stopping.set()
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    stop = threading.Event()
+    if not args.no_count:
+        threading.Thread(target=count_inputs, args=(args.input, progress), name='bulk-count', daemon=True).start()
+    reporter = threading.Thread(target=report_progress, args=(progress, args.progress_interval, stop),
+                                name='bulk-progress', daemon=True)
+    reporter.start()
+
+    def save(completed: bool = False):
+        checkpoint.save(dict(state, next_index=progress.done, succeeded=progress.succeeded,
+                             failed=progress.failed, completed=completed, last_path=last_path,
+                             **writer.sync()))
+
+    exit_code = 0
+    last_saved = time.time()
+    results = bulk.run(iter_inputs(args.input), start=progress.done)
+    try:
+        for record in results:
+            writer.write(record)
+            progress.add(record['success'])
+            last_path = record['path']
+            if bulk.stopping.is_set():
+                break
+            if time.time() - last_saved >= args.checkpoint_interval:
+                save()
+                last_saved = time.time()
+        if bulk.stopping.is_set():
+            save()
+            exit_code = 130
+        else:
+            save(completed=True)
+    except KeyboardInterrupt:
+        exit_code = 130
+    finally:
+        stop.set()
+        reporter.join()
+        results.close()
+        writer.close()
+        if pool is not None:
+            pool.shutdown()
+
+    if exit_code:
+        print("⏸ 已中断，用相同参数重新运行即可从检查点继续", file=sys.stderr)
+
+    print(progress.summary(), file=sys.stderr)
+    print(f"📁 结果目录: {os.path.abspath(args.output)}", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
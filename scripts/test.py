@@ -7,6 +7,10 @@
 
 import sys
 import os
+import time
+import signal
+import threading
+import subprocess
 
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -56,13 +60,126 @@ def test_basic_functionality():
         print(f"❌ 测试出错: {e}")
         return False
 
+# 导入耗时上限（秒）：app启动时会导入并构造转换器，需保持轻量
+IMPORT_TIME_BUDGETS = {
+    'final_converter': 'import final_converter',
+    'converter': 'import converter; converter.FormulaConverter()',
+}
+IMPORT_TIME_LIMIT = {'final_converter': 0.3, 'converter': 1.0}
+
+
+def test_import_time():
+    """测试转换模块的导入耗时（在独立进程中测量，避免模块缓存影响）"""
+    print("⏱️  测量模块导入耗时...")
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    
+    all_good = True
+    for name, statement in IMPORT_TIME_BUDGETS.items():
+        code = (
+            "import time; t = time.perf_counter(); "
+            f"{statement}; "
+            "print(time.perf_counter() - t)"
+        )
+        try:
+            output = subprocess.run([sys.executable, '-c', code], cwd=project_root,
+                                    capture_output=True, text=True, check=True).stdout
+            elapsed = float(output.strip().splitlines()[-1])
+        except (subprocess.CalledProcessError, ValueError, IndexError) as e:
+            print(f"❌ {name} 导入失败: {e}")
+            all_good = False
+            continue
+        
+        limit = IMPORT_TIME_LIMIT[name]
+        if elapsed <= limit:
+            print(f"✅ {name} 导入耗时 {elapsed * 1000:.0f}ms (上限 {limit * 1000:.0f}ms)")
+        else:
+            print(f"❌ {name} 导入耗时 {elapsed * 1000:.0f}ms，超过上限 {limit * 1000:.0f}ms")
+            all_good = False
+    
+    return all_good
+
+def test_mixed_route_resolution():
+    """测试整页文字截图走 mixed 路由时保持可读的分辨率，不被缩小到公式模型的输入高度"""
+    print("📄 测试A4文字页的裁剪与缩放...")
+    import cv2
+    import numpy as np
+    from recognizer import FormulaRecognizer
+    
+    recognizer = FormulaRecognizer(load_model=False)
+    # 150dpi 的A4页面，30行正文，字高约20像素
+    page = np.full((1754, 1240, 3), 255, np.uint8)
+    for row in range(30):
+        cv2.putText(page, 'The quick brown fox jumps over the lazy dog 0123', (60, 120 + row * 50),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 0), 2)
+    
+    image, decisions = recognizer.crop_to_formula(page)
+    routing = recognizer.choose_route(image, 'auto')
+    image = recognizer.fit_to_route(image, decisions, routing)
+    if routing['route'] != 'mixed':
+        print(f"❌ A4文字页未走 mixed 路由: {routing}")
+        return False
+    if decisions['scale'] != 1.0 or image.shape[0] < 1400:
+        print(f"❌ A4文字页被缩小到 {image.shape[1]}x{image.shape[0]}，正文无法辨认")
+        return False
+    print(f"✅ A4文字页走 mixed 路由，保持 {image.shape[1]}x{image.shape[0]} 分辨率")
+    return True
+
+def test_worker_pool_restart():
+    """测试提交过程中杀掉所有工作进程：每个任务都必须结束，名额不泄漏，工作池能恢复"""
+    print("🔁 测试工作进程全部崩溃后的恢复...")
+    import numpy as np
+    from concurrent.futures import wait
+    from worker_pool import RecognitionWorkerPool, PoolBusyError
+    
+    pool = RecognitionWorkerPool(workers=2, max_pending=8, submit_timeout=5, result_timeout=20)
+    futures = []
+    
+    def submit_loop():
+        image = np.full((32, 64), 255, dtype=np.uint8)
+        for _ in range(60):
+            try:
+                futures.append(pool.submit(image, preprocess=False, route='formula'))
+            except PoolBusyError:
+                pass
+            time.sleep(0.02)
+    
+    try:
+        submitter = threading.Thread(target=submit_loop)
+        submitter.start()
+        for _ in range(3):
+            time.sleep(0.4)
+            for worker in pool.stats()['worker_health']:
+                if worker['alive']:
+                    os.kill(worker['pid'], getattr(signal, 'SIGKILL', signal.SIGTERM))
+        submitter.join()
+        
+        _, not_done = wait(futures, timeout=pool.result_timeout + 5)
+        if not_done:
+            print(f"❌ {len(not_done)}/{len(futures)} 个任务在工作进程崩溃后没有结束")
+            return False
+        if pool.stats()['pending']:
+            print(f"❌ 任务结束后仍有 {pool.stats()['pending']} 个名额未释放")
+            return False
+        
+        try:
+            pool.recognize(np.full((32, 64), 255, dtype=np.uint8), preprocess=False, route='formula')
+        except Exception as e:
+            # 没有安装模型时工作进程会返回错误，能返回即说明工作池已恢复
+            print(f"ℹ️  重启后的识别返回错误: {e}")
+        restarts = sum(worker['restarts'] for worker in pool.stats()['worker_health'])
+        print(f"✅ {len(futures)} 个任务全部结束，工作进程重启 {restarts} 次")
+        return True
+    finally:
+        pool.shutdown()
+
 def main():
     """主函数"""
     print("=" * 60)
     print("公式识别器 - 快速测试")
     print("=" * 60)
     
-    if test_basic_functionality():
+    if (test_basic_functionality() and test_import_time() and test_mixed_route_resolution()
+            and test_worker_pool_restart()):
         print("\n🎉 所有测试通过！系统运行正常")
     else:
         print("\n❌ 测试失败，请检查环境配置")
@@ -0,0 +1,130 @@
+"""
+多公式切分
+推导过程等截图中常有多行公式，整张图一次送入模型时各行的输出会被拼在一起。
+这里用墨迹的水平投影把图片切成逐行的公式区域，各区域可以并行、成批地识别
+"""
+
+import os
+import cv2
+import numpy as np
+from typing import Optional
+from preprocess import Preprocessor, default_preprocessor
+
+
+class FormulaSegmenter:
+    """按水平投影把多行公式图片切分为逐行的区域"""
+
+    # 两条墨迹带之间的空白高度不小于字符高度的此倍数时才可能是行间距
+    # （分数线与分子分母之间、上下标与主体之间的空白明显更小）
+    MIN_GAP_RATIO = 0.6
+    # 一行公式至少包含一个高度不小于字符高度此倍数的连通域；不满足的带
+    # （求和上下限、上划线、重音符号等只含扁平或缩小的符号）并入相邻的区域
+    MIN_LINE_HEIGHT_RATIO = 0.7
+    # 面积小于此值（像素）的连通域视为噪点，不参与投影
+    MIN_COMPONENT_AREA = 3
+
+    def __init__(self, preprocessor: Optional[Preprocessor] = None, margin: int = 8,
+                 max_regions: int = 32):
+        """
+        Args:
+            preprocessor: 用于提取墨迹掩码的预处理引擎
+            margin: 区域四周保留的边距（原图像素）
+            max_regions: 单张图片最多切分出的区域数
+        """
+        self.preprocessor = preprocessor or default_preprocessor
+        self.margin = max(0, margin)
+        self.max_regions = max(1, max_regions)
+
+    @classmethod
+    def from_env(cls) -> 'FormulaSegmenter':
+        """根据环境变量创建切分器（SEGMENT_MAX_REGIONS，默认 32）"""
+        return cls(max_regions=int(os.environ.get('SEGMENT_MAX_REGIONS', '32')))
+
+    def regions(self, image: np.ndarray) -> list:
+        """
+        切分公式区域
+
+        Args:
+            image: BGR或灰度格式的NumPy数组
+
+        Returns:
+            从上到下排列的区域列表，每项为原图坐标下的 [x, y, 宽, 高]；
+            图片中没有可区分的墨迹时返回空列表
+
+        Raises:
+            ValueError: 区域数超过 max_regions
+        """
+        height, width = image.shape[:2]
+        if height == 0 or width == 0:
+            return []
+        mask, step = self.preprocessor.ink_mask(image)
+        ink = cv2.countNonZero(mask)
+        if ink == 0 or ink > mask.size // 2:
+            return []
+
+        # 去掉噪点后按连通域统计字符高度（取75分位数：中位数会被点、横线、上下标拉低）
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        keep = stats[:, cv2.CC_STAT_AREA] >= self.MIN_COMPONENT_AREA
+        keep[0] = False
+        if not keep.any():
+            return []
+        mask = np.where(keep[labels], 255, 0).astype(np.uint8)
+        components = stats[keep]
+        char_height = float(np.percentile(components[:, cv2.CC_STAT_HEIGHT], 75))
+
+        bands = self._merge_bands(self._bands(mask), components, char_height)
+        if len(bands) > self.max_regions:
+            raise ValueError(f"检测到 {len(bands)} 个公式区域，超过上限 {self.max_regions}")
+
+        boxes = []
+        for top, bottom in bands:
+            x, _, w, _ = cv2.boundingRect(mask[top:bottom])
+            # 映射回原图坐标并保留边距
+            x0 = max(0, x * step - self.margin)
+            y0 = max(0, top * step - self.margin)
+            x1 = min(width, (x + w) * step + self.margin)
+            y1 = min(height, bottom * step + self.margin)
+            boxes.append([x0, y0, x1 - x0, y1 - y0])
+        return boxes
+
+    @staticmethod
+    def _bands(mask: np.ndarray) -> list:
+        """水平投影中连续有墨迹的行段 [(起始行, 结束行)]"""
+        rows = cv2.reduce(mask, 1, cv2.REDUCE_MAX).ravel() > 0
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], rows, [False])).astype(np.int8)))
+        return [(int(start), int(end)) for start, end in zip(edges[::2], edges[1::2])]
+
+    def _merge_bands(self, bands: list, components: np.ndarray, char_height: float) -> list:
+        """合并行内的墨迹带：间距过小的相邻带合并，不含正常高度字符的带并入间距较小的一侧"""
+        min_gap = max(2.0, self.MIN_GAP_RATIO * char_height)
+        merged = []
+        for band in bands:
+            if merged and band[0] - merged[-1][1] < min_gap:
+                merged[-1] = (merged[-1][0], band[1])
+            else:
+                merged.append(band)
+
+        tops = components[:, cv2.CC_STAT_TOP]
+        heights = components[:, cv2.CC_STAT_HEIGHT]
+
+        def tallest(band):
+            inside = (tops >= band[0]) & (tops < band[1])
+            return heights[inside].max() if inside.any() else 0
+
+        while len(merged) > 1:
+            sizes = [tallest(band) for band in merged]
+            index = int(np.argmin(sizes))
+            if sizes[index] >= self.MIN_LINE_HEIGHT_RATIO * char_height:
+                break
+            # 每次只合并最弱的一条，合并后重新评估
+            if index == 0:
+                neighbor = 1
+            elif index == len(merged) - 1:
+                neighbor = index - 1
+            else:
+                gap_above = merged[index][0] - merged[index - 1][1]
+                gap_below = merged[index + 1][0] - merged[index][1]
+                neighbor = index - 1 if gap_above <= gap_below else index + 1
+            first, second = sorted((index, neighbor))
+            merged[first:second + 1] = [(merged[first][0], merged[second][1])]
+        return merged
@@ -0,0 +1,411 @@
+"""
+多进程公式识别工作池
+每个工作进程只加载一次Pix2Text模型，主进程通过共享内存传递图片数组，
+避免GIL竞争和大数组的pickle开销
+"""
+
+import os
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PoolBusyError(Exception):
+    """工作池积压任务过多（背压）"""
+
+
+class WorkerCrashedError(Exception):
+    """工作进程在处理任务时退出"""
+
+
+class TaskTimeoutError(Exception):
+    """任务在结果超时时间内没有完成"""
+
+
+def physical_cpu_count() -> int:
+    """物理核心数（Linux下读取/proc/cpuinfo，其他平台退化为逻辑核数）"""
+    try:
+        cores = set()
+        physical_id = core_id = None
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('physical id'):
+                    physical_id = line.split(':', 1)[1].strip()
+                elif line.startswith('core id'):
+                    core_id = line.split(':', 1)[1].strip()
+                elif not line.strip():
+                    if core_id is not None:
+                        cores.add((physical_id, core_id))
+                    physical_id = core_id = None
+        if core_id is not None:
+            cores.add((physical_id, core_id))
+        if cores:
+            return len(cores)
+    except OSError:
+        pass
+    return os.cpu_count() or 1
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """在工作进程中挂载共享内存，所有权归主进程，由主进程负责unlink"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 没有track参数；spawn子进程与主进程共用同一个资源回收器，
+        # 重复登记不会产生副作用，主进程unlink时会一并注销
+        return shared_memory.SharedMemory(name=name)
+
+
+def _worker_main(worker_index: int, generation: int, task_queue, result_queue):
+    """工作进程入口：加载一次模型，然后循环处理任务"""
+    # 终端的 Ctrl+C 会发给整个进程组；工作进程忽略它，由主进程决定何时调用 shutdown，
+    # 否则在途任务会以 WorkerCrashedError 失败，监控线程还会在关闭前重启工作进程
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from cache import RecognitionCache
+    from recognizer import FormulaRecognizer
+
+    # 结果缓存由主进程负责，工作进程内关闭
+    recognizer = FormulaRecognizer(cache=RecognitionCache(max_entries=0))
+    recognizer.warm_up()
+    result_queue.put(('ready', worker_index, generation, recognizer.p2t is not None, recognizer.load_error))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        task_id, shm_name, shape, dtype, preprocess, route = task
+        latex_formula = None
+        error = None
+        try:
+            shm = _attach_shared_memory(shm_name)
+            try:
+                image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                latex_formula = recognizer.run_recognition(image, preprocess, route)
+                del image  # 释放对共享缓冲区的引用后才能关闭
+            finally:
+                shm.close()
+        except Exception as e:
+            error = str(e)
+        result_queue.put(('result', worker_index, task_id, latex_formula, error))
+
+
+class _WorkerHandle:
+    """主进程中对单个工作进程的记录"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.task_queue = None
+        self.generation = 0   # 每次（重新）启动加一，用于忽略已退出进程的消息
+        self.ready = False
+        self.model_loaded = False
+        self.in_flight = {}
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.started_at = None
+        self.last_error = None
+
+    @property
+    def state(self) -> str:
+        """starting（启动或加载模型中）/ ready / failed（模型加载失败）/ dead"""
+        if self.process is None:
+            return 'starting'
+        if not self.process.is_alive():
+            return 'dead'
+        if not self.ready:
+            return 'starting'
+        return 'ready' if self.model_loaded else 'failed'
+
+    def health(self) -> dict:
+        alive = self.process is not None and self.process.is_alive()
+        return {
+            'index': self.index,
+            'pid': self.process.pid if self.process is not None else None,
+            'alive': alive,
+            'state': self.state,
+            'ready': alive and self.ready,
+            'model_loaded': self.model_loaded,
+            'in_flight': len(self.in_flight),
+            'completed': self.completed,
+            'failed': self.failed,
+            'restarts': self.restarts,
+            'uptime': round(time.time() - self.started_at, 1) if self.started_at else 0.0,
+            'last_error': self.last_error,
+        }
+
+
+class RecognitionWorkerPool:
+    """
+    多进程识别工作池
+
+    - 每个进程加载一次模型，任务按最少在途数分派
+    - 图片数组经共享内存传递，进程间只传递名称、形状和类型
+    - 在途任务数达到上限时提交方阻塞等待，超时抛出 PoolBusyError
+    - 崩溃的工作进程会被自动重启，其在途任务以 WorkerCrashedError 失败
+    - 提交后超过 result_timeout 仍未完成的任务以 TaskTimeoutError 失败并释放名额
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 submit_timeout: float = 30.0, result_timeout: Optional[float] = 120.0):
+        """
+        初始化工作池
+
+        Args:
+            workers: 工作进程数，默认为物理核心数
+            max_pending: 最大在途任务数，默认为每个进程4个
+            submit_timeout: 提交任务时等待空位的最长秒数
+            result_timeout: 任务从提交到完成的最长秒数，None 表示不限制
+        """
+        self.workers = max(1, workers or physical_cpu_count())
+        self.max_pending = max(1, max_pending or self.workers * 4)
+        self.submit_timeout = submit_timeout
+        self.result_timeout = result_timeout if result_timeout and result_timeout > 0 else None
+        self._context = mp.get_context('spawn')  # 避免fork后继承模型线程状态
+        self._result_queue = self._context.Queue()
+        self._handles = [_WorkerHandle(index) for index in range(self.workers)]
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._next_task_id = 0
+        self._closed = False
+        self.rejected = 0
+
+        for handle in self._handles:
+            self._start_worker(handle)
+
+        self._listener = threading.Thread(target=self._listen, name='worker-pool-listener', daemon=True)
+        self._listener.start()
+        self._monitor = threading.Thread(target=self._watch, name='worker-pool-monitor', daemon=True)
+        self._monitor.start()
+
+    @classmethod
+    def from_env(cls) -> Optional['RecognitionWorkerPool']:
+        """根据环境变量创建工作池（RECOGNITION_POOL=on 时启用）"""
+        if os.environ.get('RECOGNITION_POOL', '').lower() not in ('1', 'on', 'true', 'yes'):
+            return None
+        if mp.parent_process() is not None:
+            return None  # spawn方式会在子进程中重新导入主模块，子进程内不再嵌套创建工作池
+        workers = int(os.environ.get('RECOGNITION_WORKERS', '0')) or None
+        max_pending = int(os.environ.get('RECOGNITION_POOL_MAX_PENDING', '0')) or None
+        submit_timeout = float(os.environ.get('RECOGNITION_POOL_SUBMIT_TIMEOUT', '30'))
+        result_timeout = float(os.environ.get('RECOGNITION_POOL_RESULT_TIMEOUT', '120'))
+        return cls(workers=workers, max_pending=max_pending, submit_timeout=submit_timeout,
+                   result_timeout=result_timeout)
+
+    def submit(self, image: np.ndarray, preprocess: bool = True, route: str = 'mixed') -> Future:
+        """
+        提交识别任务
+
+        Args:
+            image: 图片数组
+            preprocess: 是否进行预处理
+            route: 推理路由（formula / mixed），见 routing.py
+
+        Returns:
+            结果为LaTeX字符串（或None）的Future
+
+        Raises:
+            PoolBusyError: 等待空位超时
+        """
+        if self._closed:
+            raise RuntimeError('工作池已关闭')
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise PoolBusyError('识别工作池繁忙，请稍后再试')
+
+        try:
+            image = np.ascontiguousarray(image)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+            np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+        except Exception:
+            self._slots.release()
+            raise
+
+        future = Future()
+        with self._lock:
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            handle = self._pick_worker()
+            self._tasks[task_id] = (future, shm, handle)
+            handle.in_flight[task_id] = time.time()
+            task_queue = handle.task_queue
+        task_queue.put((task_id, shm.name, image.shape, image.dtype.str, preprocess, route))
+        return future
+
+    def recognize(self, image: np.ndarray, preprocess: bool = True, route: str = 'mixed',
+                  timeout: Optional[float] = None) -> Optional[str]:
+        """同步识别，返回LaTeX公式；timeout 默认为 result_timeout"""
+        return self.submit(image, preprocess, route).result(timeout or self.result_timeout)
+
+    @property
+    def ready(self) -> bool:
+        """是否至少有一个工作进程已加载模型"""
+        return any(handle.state == 'ready' for handle in self._handles)
+
+    @property
+    def failed(self) -> bool:
+        """是否所有工作进程都已报告模型加载失败（重启也无法恢复，需检查模型和环境）"""
+        return all(handle.state == 'failed' for handle in self._handles)
+
+    def stats(self) -> dict:
+        """工作池及各工作进程的健康状态"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': len(self._tasks),
+                'rejected': self.rejected,
+                'worker_health': [handle.health() for handle in self._handles],
+            }
+
+    def shutdown(self, timeout: float = 5.0):
+        """停止所有工作进程并释放共享内存"""
+        self._closed = True
+        for handle in self._handles:
+            try:
+                handle.task_queue.put(None)
+            except Exception:
+                pass
+        for handle in self._handles:
+            handle.process.join(timeout)
+            if handle.process.is_alive():
+                handle.process.terminate()
+        with self._lock:
+            for task_id in list(self._tasks):
+                self._finish(task_id, error=RuntimeError('工作池已关闭'))
+
+    def _start_worker(self, handle: _WorkerHandle):
+        """启动工作进程（调用方不持有锁）"""
+        with self._lock:
+            generation, task_queue = self._renew_worker(handle)
+        self._spawn_worker(handle, generation, task_queue)
+
+    def _renew_worker(self, handle: _WorkerHandle):
+        """
+        为即将启动的进程换上新的任务队列并递增代数（调用方持有锁）
+
+        之后分派给该进程的任务都进入新队列，由新进程读取；
+        旧队列只可能残留已在同一临界区内判为失败的任务
+        """
+        handle.generation += 1
+        handle.task_queue = self._context.Queue()
+        handle.ready = False
+        handle.model_loaded = False
+        return handle.generation, handle.task_queue
+
+    def _spawn_worker(self, handle: _WorkerHandle, generation: int, task_queue):
+        """启动进程；spawn需要数百毫秒，不持锁以免阻塞 submit / stats"""
+        process = self._context.Process(
+            target=_worker_main,
+            args=(handle.index, generation, task_queue, self._result_queue),
+            name=f'recognition-worker-{handle.index}',
+            daemon=True,
+        )
+        process.start()
+        with self._lock:
+            handle.process = process
+            handle.started_at = time.time()
+        logger.info(f"识别工作进程已启动: #{handle.index} pid={process.pid}")
+
+    def _pick_worker(self) -> _WorkerHandle:
+        """选择在途任务最少的存活进程（调用方持有锁）"""
+        alive = [handle for handle in self._handles
+                 if handle.process is not None and handle.process.is_alive()] or self._handles
+        return min(alive, key=lambda handle: (handle.state != 'ready', len(handle.in_flight)))
+
+    def _finish(self, task_id: int, result: Optional[str] = None, error: Optional[Exception] = None):
+        """完成任务并释放共享内存与背压名额（调用方持有锁）"""
+        entry = self._tasks.pop(task_id, None)
+        if entry is None:
+            return
+        future, shm, handle = entry
+        handle.in_flight.pop(task_id, None)
+        try:
+            shm.close()
+            shm.unlink()
+        except OSError:
+            pass
+        self._slots.release()
+        if error is not None:
+            handle.failed += 1
+            handle.last_error = str(error)
+            future.set_exception(error)
+        else:
+            handle.completed += 1
+            future.set_result(result)
+
+    def _listen(self):
+        """接收工作进程返回的消息"""
+        while not self._closed:
+            try:
+                message = self._result_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            kind, worker_index = message[0], message[1]
+            with self._lock:
+                handle = self._handles[worker_index]
+                if kind == 'ready':
+                    _, _, generation, model_loaded, load_error = message
+                    if handle.generation == generation:
+                        handle.ready = True
+                        handle.model_loaded = model_loaded
+                        if not model_loaded:
+                            handle.last_error = load_error
+                            logger.error(f"识别工作进程 #{handle.index} 模型加载失败: {load_error}")
+                elif kind == 'result':
+                    _, _, task_id, latex_formula, error = message
+                    self._finish(task_id, latex_formula, RuntimeError(error) if error else None)
+
+    def _watch(self):
+        """监控工作进程，崩溃后重启并让其在途任务失败；同时让超时的任务失败"""
+        while not self._closed:
+            time.sleep(1.0)
+            restarts = []
+            with self._lock:
+                if self.result_timeout is not None:
+                    deadline = time.time() - self.result_timeout
+                    for handle in self._handles:
+                        for task_id, submitted_at in list(handle.in_flight.items()):
+                            if submitted_at < deadline:
+                                self._finish(task_id, error=TaskTimeoutError(
+                                    f'识别任务超过 {self.result_timeout:g} 秒未完成'))
+                for handle in self._handles:
+                    if self._closed or handle.process is None or handle.process.is_alive():
+                        continue
+                    exitcode = handle.process.exitcode
+                    logger.error(f"识别工作进程 #{handle.index} 已退出 (exitcode={exitcode})，正在重启")
+                    for task_id in list(handle.in_flight):
+                        self._finish(task_id, error=WorkerCrashedError(
+                            f'识别工作进程 #{handle.index} 异常退出 (exitcode={exitcode})'))
+                    handle.restarts += 1
+                    handle.last_error = f'exitcode={exitcode}'
+                    # 与让在途任务失败在同一临界区内换上新队列，此后提交的任务不会落入无人读取的旧队列
+                    restarts.append((handle, *self._renew_worker(handle)))
+            # 在锁外启动新进程，启动期间 submit / stats 不被阻塞
+            for handle, generation, task_queue in restarts:
+                if self._closed:
+                    break
+                try:
+                    self._spawn_worker(handle, generation, task_queue)
+                except Exception as e:
+                    # 进程仍记为已退出，下一轮会再次重启，期间分派给它的任务照常判为失败
+                    logger.error(f"识别工作进程 #{handle.index} 重启失败: {e}")